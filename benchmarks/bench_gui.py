@@ -0,0 +1,372 @@
+"""GUI rendering benchmark on the offscreen Qt platform.
+
+Times the main window's folder and submission rendering, drag-drop moves,
+exclusion, previews and filtering for a synthetic account. The sessions are
+filled in memory, so no server or network is needed:
+
+    python benchmarks/bench_gui.py --submissions 5000 --json results.json
+    python benchmarks/bench_gui.py --submissions 5000 --baseline results.json
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+
+import time
+
+# Must be set before Qt is loaded
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtCore, QtWidgets
+
+# Import fa2wzl from this checkout, also without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fa2wzl.fa import models as fa_models
+from fa2wzl.fa.session import FASession
+from fa2wzl.gui import MainWindow
+from fa2wzl.logging import logger
+from fa2wzl.thumbnails import ThumbnailCache
+from fa2wzl.wzl import models as wzl_models
+from fa2wzl.wzl.session import WZLSession
+
+from standin import StandInAccount, thumbnail_png
+
+# Nothing listens here, so any request the benchmark makes fails at once
+UNREACHABLE_ROOT = "http://127.0.0.1:9"
+
+THUMBNAIL_URL = "http://thumbnails.invalid/%s/%d.png"
+
+
+def _make(cls, session, **attributes):
+    obj = cls()
+    obj._session = session
+    for name, value in attributes.items():
+        setattr(obj, name, value)
+    return obj
+
+
+def fa_session(account):
+    """Build an FA session with everything already loaded.
+
+    Args:
+        account (StandInAccount): The synthetic account
+
+    Returns:
+        FASession: The session
+    """
+    sess = FASession(account.username, root=UNREACHABLE_ROOT)
+
+    for stand_in in account.fa_submissions:
+        sub = _make(fa_models.Submission, sess, id=stand_in.id,
+                    title=stand_in.title, type=stand_in.type,
+                    rating=stand_in.rating, category=stand_in.category,
+                    description="", tags=list(stand_in.tags),
+                    thumbnail_url=THUMBNAIL_URL % ("fa", stand_in.id),
+                    media_url=THUMBNAIL_URL % ("fa", stand_in.id))
+        sess._submissions[sub.id] = sub
+
+    root_folders = []
+    for stand_in in account.fa_groups + account.fa_folders:
+        folder = _make(fa_models.Folder, sess, id=stand_in.id,
+                       title=stand_in.title, children=[],
+                       submissions=[sess._submissions[s.id] for s in
+                                    stand_in.submissions])
+        sess._folders[folder.id] = folder
+
+        parent = sess._folders.get(stand_in.parent_id)
+        if parent is None:
+            root_folders.append(folder)
+        else:
+            parent.children.append(folder)
+
+    sess._root_folders = root_folders
+    sess._gallery = [sess._submissions[s.id] for s in account.fa_submissions
+                     if not s.scraps]
+    sess._scraps = [sess._submissions[s.id] for s in account.fa_submissions
+                    if s.scraps]
+
+    return sess
+
+
+def wzl_session(account):
+    """Build a Weasyl session with everything already loaded.
+
+    Args:
+        account (StandInAccount): The synthetic account
+
+    Returns:
+        WZLSession: The session
+    """
+    sess = WZLSession("", root=UNREACHABLE_ROOT)
+    sess._username = account.username
+
+    for stand_in in account.wzl_submissions:
+        sub = _make(wzl_models.Submission, sess, id=stand_in.id,
+                    title=stand_in.title, type=stand_in.type,
+                    thumbnail_url=THUMBNAIL_URL % ("wzl", stand_in.id))
+        sess._submissions[sub.id] = sub
+
+    root_folders = []
+    for stand_in in account.wzl_folders:
+        folder = _make(wzl_models.Folder, sess, id=stand_in.id,
+                       title=stand_in.title, children=[],
+                       submissions=[sess._submissions[s.id] for s in
+                                    stand_in.submissions])
+        sess._folders[folder.id] = folder
+
+        parent = sess._folders.get(stand_in.parent_id)
+        if parent is None:
+            root_folders.append(folder)
+        else:
+            parent.children.append(folder)
+
+    sess._root_folders = root_folders
+    sess._gallery_submissions = list(sess._submissions.values())
+
+    return sess
+
+
+def create_missing_folders(account):
+    """Add the FA folders missing on Weasyl, as Create Folders would.
+
+    Args:
+        account (StandInAccount): The synthetic account
+    """
+    existing = {f.title: f for f in account.wzl_folders}
+    groups = {g.id: g for g in account.fa_groups}
+
+    for fa_folder in account.fa_groups + account.fa_folders:
+        if fa_folder.title in existing:
+            continue
+
+        parent_id = None
+        if fa_folder.parent_id is not None:
+            parent_id = existing[groups[fa_folder.parent_id].title].id
+
+        existing[fa_folder.title] = account.add_wzl_folder(fa_folder.title,
+                                                           parent_id)
+
+
+def _wait(app, condition, timeout=30):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise RuntimeError("Timed out waiting for the window")
+        app.processEvents()
+        time.sleep(0.001)
+
+
+def _measure(app, func, repeat):
+    # Deferred layout and painting are part of what the user waits for
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        app.processEvents()
+        times.append(time.perf_counter() - start)
+
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "max": max(times),
+    }
+
+
+def run(args, app):
+    account = StandInAccount(submissions=args.submissions,
+                             groups=args.groups,
+                             folders_per_group=args.folders_per_group,
+                             migrated_ratio=args.migrated_ratio)
+    if not args.no_create_folders:
+        create_missing_folders(account)
+
+    fa_sess = fa_session(account)
+    wzl_sess = wzl_session(account)
+
+    window = MainWindow(fa_sess, wzl_sess)
+    window.show()
+
+    cache_dir = tempfile.TemporaryDirectory()
+    cache = ThumbnailCache(cache_dir.name)
+    for sub in fa_sess.gallery + fa_sess.scraps:
+        cache.put(sub.thumbnail_url, thumbnail_png(sub.id))
+    for sub in wzl_sess.gallery:
+        cache.put(sub.thumbnail_url, thumbnail_png(sub.id))
+    window.preview_service.cache = cache
+
+    results = {}
+    try:
+        _wait(app, window.btnCreateFolders.isEnabled)
+        results["render_folders"] = _measure(
+            app, lambda i: window._render_folders(), args.repeat)
+
+        window.stackedWidget.setCurrentIndex(2)
+        window._submissions_loaded(window._match_submissions())
+        model = window.wzl_submission_model
+        view = window.wzlSubmissions
+
+        results["render_submissions"] = _measure(
+            app, lambda i: window._render_submissions(), args.repeat)
+
+        # Rendering again keeps opened folders open, which costs more
+        view.expandAll()
+        results["render_submissions_expanded"] = _measure(
+            app, lambda i: window._render_submissions(), args.repeat)
+        window._render_submissions()
+        view.collapseAll()
+        view.expandToDepth(0)
+
+        # Drag new submissions from the root into a folder and back
+        folders = [f for f in wzl_sess.folders if model.nodes.get(f)]
+        root_new = [s for s in model.new_submissions()
+                    if model.nodes.get(s) is not None and
+                    model.nodes[s].parent is model.root]
+        batch = root_new[:args.move_batch]
+
+        def move(i):
+            target = model.index_of(model.nodes[folders[0]]) \
+                if i % 2 == 0 else QtCore.QModelIndex()
+            indexes = [model.index_of(model.nodes[s]) for s in batch
+                       if model.nodes[s].parent is not None]
+            model.dropMimeData(model.mimeData(indexes),
+                               QtCore.Qt.MoveAction, -1, -1, target)
+
+        if batch and folders:
+            results["move_submissions"] = _measure(app, move,
+                                                   args.repeat * 2)
+
+        def exclude(i):
+            subs = model.new_submissions()[:args.move_batch]
+            window._exclude_submissions(subs)
+
+        results["exclude_submissions"] = _measure(app, exclude, args.repeat)
+
+        # Every preview is on disk, but new to the in-memory cache
+        shown = []
+        window.preview_service.preview_ready.connect(shown.append)
+        proxy = view.model()
+        rows = [r for r in range(proxy.rowCount())
+                if proxy.flags(proxy.index(r, 0)) &
+                QtCore.Qt.ItemIsSelectable]
+
+        def preview(i):
+            del shown[:]
+            view.selectionModel().select(
+                proxy.index(rows[i % len(rows)], 0),
+                QtCore.QItemSelectionModel.ClearAndSelect |
+                QtCore.QItemSelectionModel.Rows)
+            _wait(app, lambda: shown)
+
+        if rows:
+            results["preview"] = _measure(app, preview,
+                                          min(args.repeat * 5, len(rows)))
+
+        # Every keystroke of a query, as it is typed
+        def type_query(i):
+            window.submissionFilter.setText(args.query[:i % len(args.query)
+                                                       + 1])
+
+        results["filter_keystroke"] = _measure(app, type_query,
+                                               len(args.query) * args.repeat)
+        window.submissionFilter.clear()
+
+        results["submissions"] = len(account.fa_submissions)
+        results["new_submissions"] = len(model.new_submissions())
+    finally:
+        window.close()
+        cache_dir.cleanup()
+
+    return results
+
+
+def _timings(results):
+    return {name: value for name, value in results.items()
+            if isinstance(value, dict)}
+
+
+def compare_baseline(results, baseline, tolerance):
+    """Find timings that got slower than a baseline.
+
+    Args:
+        results: The new results
+        baseline: Results of an earlier run
+        tolerance (float): Allowed slowdown, 0.2 being 20%
+
+    Returns:
+        list: Names of the regressed timings
+    """
+    regressed = []
+
+    print()
+    print("%-30s %10s %10s %8s" % ("Median vs baseline", "Baseline",
+                                   "Now", "Ratio"))
+    for name, timing in sorted(_timings(results).items()):
+        old = baseline.get(name)
+        if not isinstance(old, dict) or not old.get("median"):
+            continue
+
+        ratio = timing["median"] / old["median"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressed.append(name)
+            flag = " slower"
+
+        print("%-30s %9.2fms %9.2fms %7.2fx%s" % (
+            name, old["median"] * 1000, timing["median"] * 1000, ratio,
+            flag))
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--submissions", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--folders-per-group", type=int, default=4)
+    parser.add_argument("--migrated-ratio", type=float, default=0.3)
+    parser.add_argument("--no-create-folders", action="store_true",
+                        help="Leave FA folders missing on Weasyl")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--move-batch", type=int, default=20,
+                        help="Submissions moved or excluded at once")
+    parser.add_argument("--query", default="commission",
+                        help="Filter typed one character at a time")
+    parser.add_argument("--json", metavar="PATH",
+                        help="Also write the results to this file")
+    parser.add_argument("--baseline", metavar="PATH",
+                        help="Compare with the results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Slowdown over the baseline reported as a "
+                             "regression")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+
+    app = QtWidgets.QApplication(sys.argv[:1])
+    results = run(args, app)
+
+    print("%-30s %10s %10s %10s" % ("Path", "Min", "Median", "Max"))
+    for name, timing in sorted(_timings(results).items()):
+        print("%-30s %9.2fms %9.2fms %9.2fms" % (
+            name, timing["min"] * 1000, timing["median"] * 1000,
+            timing["max"] * 1000))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if compare_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""End-to-end migration benchmark against the local stand-in server.
+
+Measures scan (including folder creation), match and upload throughput
+of the Worker stages for a synthetic account, without touching the real
+sites:
+
+    python benchmarks/bench_migration.py --submissions 1000 --latency 0.01
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import time
+
+# Import fa2wzl from this checkout, also without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fa2wzl import metrics
+from fa2wzl.fa.session import FASession
+from fa2wzl.logging import logger
+from fa2wzl.ratelimit import RateLimiter
+from fa2wzl.tracing import Tracer
+from fa2wzl.worker import Worker
+from fa2wzl.wzl.session import WZLSession
+
+from standin import StandInAccount, StandInServer
+
+
+def _limiter(rate):
+    if rate <= 0:
+        # Effectively unlimited
+        return RateLimiter(1e9, burst=1e9)
+    return RateLimiter(rate, burst=1)
+
+
+def run(args):
+    account = StandInAccount(submissions=args.submissions,
+                             groups=args.groups,
+                             folders_per_group=args.folders_per_group,
+                             migrated_ratio=args.migrated_ratio,
+                             media_size=args.media_size)
+
+    server = StandInServer(account, latency=args.latency,
+                           throttle_every=args.throttle_every,
+                           retry_after=args.retry_after)
+
+    results = {}
+    metrics.registry.reset()
+
+    with server:
+        fa_sess = FASession(account.username,
+                            page_limiter=_limiter(args.fa_rate),
+                            root=server.fa_root)
+        fa_sess.login("", "")
+
+        wzl_sess = WZLSession("", read_limiter=_limiter(args.wzl_rate),
+                              write_limiter=_limiter(args.wzl_rate),
+                              root=server.wzl_root)
+
+        tracer = Tracer()
+        worker = Worker(fa_sess, wzl_sess, tracer=tracer)
+
+        start = time.monotonic()
+        worker.map_folders()
+        # Maps the folders again once they are created
+        worker.create_folders()
+        worker.map_submissions()
+        scan_time = time.monotonic() - start
+
+        # Matching again on the loaded objects measures it without I/O
+        start = time.monotonic()
+        worker.map_folders()
+        worker.map_submissions()
+        match_time = time.monotonic() - start
+
+        to_create = worker.submissions_to_create[:args.uploads]
+        worker.submissions_to_create = to_create
+
+        start = time.monotonic()
+        worker.create_all(0)
+        upload_time = time.monotonic() - start
+
+    fa_count = len(account.fa_submissions)
+
+    results["submissions"] = fa_count
+    results["scan_seconds"] = scan_time
+    results["scan_per_second"] = fa_count / scan_time if scan_time else 0
+    results["match_seconds"] = match_time
+    results["match_per_second"] = fa_count / match_time if match_time else 0
+    results["uploads"] = len(to_create)
+    results["upload_seconds"] = upload_time
+    results["upload_per_second"] = \
+        len(to_create) / upload_time if upload_time else 0
+    results["spans"] = tracer.summary()
+    results["http"] = {endpoint: {
+        "requests": data["requests"],
+        "latency_sum": data["latency_sum"],
+        "wait_seconds": data["wait_seconds"],
+    } for endpoint, data in metrics.registry.snapshot().items()}
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--submissions", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=3)
+    parser.add_argument("--folders-per-group", type=int, default=4)
+    parser.add_argument("--migrated-ratio", type=float, default=0.3)
+    parser.add_argument("--media-size", type=int, default=64 * 1024)
+    parser.add_argument("--uploads", type=int, default=50,
+                        help="Upload at most this many submissions")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the server waits before responding")
+    parser.add_argument("--throttle-every", type=int, default=0,
+                        help="Answer every Nth Weasyl request with 429")
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument("--fa-rate", type=float, default=0,
+                        help="FA pages per second, 0 for unlimited")
+    parser.add_argument("--wzl-rate", type=float, default=0,
+                        help="Weasyl requests per second, 0 for unlimited")
+    parser.add_argument("--json", metavar="PATH",
+                        help="Also write the results to this file")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+
+    results = run(args)
+
+    print("%-10s %10s %12s" % ("Stage", "Seconds", "Items/s"))
+    for stage in ["scan", "match", "upload"]:
+        print("%-10s %10.3f %12.1f" % (stage, results[stage + "_seconds"],
+                                       results[stage + "_per_second"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Job queue run by several local processes against the stand-in server.
+
+Queues the migration of a synthetic account, has worker processes take
+the jobs, and checks that every new submission was uploaded exactly once:
+
+    python benchmarks/bench_queue.py --processes 4 --submissions 200
+
+With --stall, one more worker stops for a while before each upload
+without sending heartbeats, so its leases run out and other workers take
+its jobs over, as when a host hangs.
+"""
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+
+import time
+
+# Import fa2wzl from this checkout, also without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fa2wzl.fa.session import FASession
+from fa2wzl.jobqueue import CRAWL, JobQueue, QueueWorker
+from fa2wzl.logging import logger
+from fa2wzl.ratelimit import RateLimiter
+from fa2wzl.tracing import Tracer
+from fa2wzl.worker import Worker
+from fa2wzl.wzl.session import WZLSession
+
+from standin import StandInAccount, StandInServer
+
+
+class StallingQueueWorker(QueueWorker):
+    """Waits before each upload, e.g. as if its host hung."""
+
+    def __init__(self, *args, **kwargs):
+        self.stall = kwargs.pop("stall")
+        super(StallingQueueWorker, self).__init__(*args, **kwargs)
+
+    def _upload(self, job, worker):
+        time.sleep(self.stall)
+        return super(StallingQueueWorker, self)._upload(job, worker)
+
+
+def _unlimited():
+    return RateLimiter(1e9, burst=1e9)
+
+
+def work(queue_path, spool_dir, username, fa_root, wzl_root, lease,
+         stall=0.0):
+    """Run queue jobs until the queue is done, in a worker process."""
+    logger.setLevel(logging.WARNING)
+
+    def make_worker(account):
+        fa_sess = FASession(account, page_limiter=_unlimited(), root=fa_root)
+        fa_sess.login("", "")
+        wzl_sess = WZLSession("", read_limiter=_unlimited(),
+                              write_limiter=_unlimited(), root=wzl_root)
+        return Worker(fa_sess, wzl_sess, tracer=Tracer())
+
+    queue = JobQueue(queue_path, retry_seconds=0.1)
+    if stall > 0:
+        # No heartbeat arrives before the lease runs out
+        worker = StallingQueueWorker(queue, make_worker, spool_dir,
+                                     lease_seconds=lease,
+                                     heartbeat_seconds=10 * (lease + stall),
+                                     stall=stall)
+    else:
+        worker = QueueWorker(queue, make_worker, spool_dir,
+                             lease_seconds=lease,
+                             heartbeat_seconds=lease / 5)
+
+    worker.run(poll_seconds=0.05)
+
+
+def run(args):
+    account = StandInAccount(submissions=args.submissions,
+                             migrated_ratio=args.migrated_ratio,
+                             media_size=args.media_size)
+    existing = {sub.title for sub in account.wzl_submissions}
+    expected = {sub.title for sub in account.fa_submissions} - existing
+
+    directory = tempfile.mkdtemp(prefix="fa2wzl-queue-")
+    queue_path = os.path.join(directory, "queue.db")
+    spool_dir = os.path.join(directory, "spool")
+
+    queue = JobQueue(queue_path)
+    queue.put(CRAWL, account.username)
+
+    # Processes start fresh, so they do not inherit the server threads
+    context = multiprocessing.get_context("spawn")
+
+    with StandInServer(account, latency=args.latency) as server:
+        common = (queue_path, spool_dir, account.username, server.fa_root,
+                  server.wzl_root, args.lease)
+        processes = [context.Process(target=work, args=common)
+                     for _ in range(args.processes)]
+        if args.stall > 0:
+            processes.append(context.Process(target=work,
+                                             args=common + (args.stall,)))
+
+        start = time.monotonic()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        seconds = time.monotonic() - start
+
+    uploads = collections.Counter(sub.title for sub in account.wzl_submissions
+                                  if sub.title not in existing)
+
+    return {
+        "processes": len(processes),
+        "seconds": seconds,
+        "expected": len(expected),
+        "uploaded": len(uploads),
+        "missing": sorted(expected - set(uploads)),
+        "duplicates": sorted(title for title, count in uploads.items()
+                             if count > 1),
+        "failures": [list(failure) for failure in queue.failures()],
+        "jobs": queue.counts(),
+        "exit_codes": [process.exitcode for process in processes],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--submissions", type=int, default=100)
+    parser.add_argument("--migrated-ratio", type=float, default=0.3)
+    parser.add_argument("--media-size", type=int, default=16 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the server waits before responding")
+    parser.add_argument("--lease", type=float, default=2.0,
+                        help="Seconds a job is leased for")
+    parser.add_argument("--stall", type=float, default=0.0,
+                        help="Add a worker that waits this long before each "
+                             "upload, longer than the lease to lose it")
+    parser.add_argument("--json", metavar="PATH",
+                        help="Also write the results to this file")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+
+    results = run(args)
+
+    print("%d processes, %.3f seconds" % (results["processes"],
+                                          results["seconds"]))
+    print("Uploaded %d of %d, %d missing, %d duplicated, %d failed jobs" % (
+        results["uploaded"], results["expected"], len(results["missing"]),
+        len(results["duplicates"]), len(results["failures"])))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if results["missing"] or results["duplicates"] or results["failures"] \
+            or any(results["exit_codes"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
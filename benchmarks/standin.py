@@ -0,0 +1,672 @@
+import email.parser
+import email.policy
+import html
+import itertools
+import json
+import random
+import re
+import struct
+import threading
+import zlib
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import time
+
+from fa2wzl.logging import logger
+
+FA_CATEGORIES = ["Artwork (Digital)", "Artwork (Traditional)", "Story",
+                 "Poetry", "Music", "Photography", "Crafting"]
+"""list: Categories assigned to generated FA submissions"""
+
+FA_TYPES = [("image", "visual"), ("text", "literary"), ("audio", "multimedia")]
+"""list: Pairs of FA and Weasyl type names of generated submissions"""
+
+FA_RATINGS = ["general", "mature", "adult"]
+"""list: Ratings assigned to generated FA submissions"""
+
+
+THUMBNAIL_SIZE = 120
+"""int: Width and height of generated thumbnails"""
+
+
+def thumbnail_png(id, size=THUMBNAIL_SIZE):
+    """Make a solid colour PNG thumbnail, the colour depending on the ID.
+
+    Args:
+        id (int): The submission ID
+        size (int): Width and height in pixels
+
+    Returns:
+        bytes: The PNG file
+    """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + \
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    color = bytes(((id * 67) % 256, (id * 131) % 256, (id * 197) % 256))
+    rows = (b"\x00" + color * size) * size
+
+    return b"\x89PNG\r\n\x1a\n" + \
+        chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(rows)) + \
+        chunk(b"IEND", b"")
+
+
+def media_bytes(id, size, ext=None):
+    """Generate the contents of a media file.
+
+    Args:
+        id (int): The submission ID
+        size (int): Length in bytes
+        ext (str, optional): The file extension; PNG files start with a
+            real image, so they can be decoded
+
+    Returns:
+        bytes: Data that differs between submissions and between offsets,
+        so misplaced ranges are noticed
+    """
+    head = thumbnail_png(id) if ext == "png" else b""
+    size = max(0, size - len(head))
+    if not size:
+        return head
+    return head + random.Random(id).getrandbits(size * 8).to_bytes(
+        size, "little")
+
+
+class StandInSubmission(object):
+    def __init__(self, id, title, type, rating, category, tags, scraps):
+        self.id = id
+        self.title = title
+        self.type = type
+        self.rating = rating
+        self.category = category
+        self.tags = tags
+        self.scraps = scraps
+
+
+class StandInFolder(object):
+    def __init__(self, id, title, parent_id=None):
+        self.id = id
+        self.title = title
+        self.parent_id = parent_id
+        self.submissions = []
+
+
+class StandInAccount(object):
+    """A synthetic account present on both sites.
+
+    Attributes:
+        username (str): The username on both sites
+        fa_groups: List of FA folder groups
+        fa_folders: List of FA folders, each inside a group
+        fa_submissions: List of FA submissions
+        wzl_folders: List of Weasyl folders, subfolders included
+        wzl_submissions: List of Weasyl submissions
+        media_size (int): Size in bytes of every media file
+    """
+
+    def __init__(self, submissions=200, groups=3, folders_per_group=4,
+                 scraps_ratio=0.1, migrated_ratio=0.3, media_size=64 * 1024,
+                 username="standin", seed=0):
+        """Generate an account.
+
+        Args:
+            submissions (int): Number of FA submissions
+            groups (int): Number of FA folder groups
+            folders_per_group (int): Number of FA folders in each group
+            scraps_ratio (float): Share of submissions put in scraps
+            migrated_ratio (float): Share of submissions and folders that
+                already exist on Weasyl
+            media_size (int): Size in bytes of every media file
+            username (str): The username on both sites
+            seed (int): Seed for the random generator
+        """
+        rand = random.Random(seed)
+
+        self.username = username
+        self.media_size = media_size
+
+        self.fa_groups = []
+        self.fa_folders = []
+        self.fa_submissions = []
+        self.wzl_folders = []
+        self.wzl_submissions = []
+
+        self._lock = threading.Lock()
+        self._next_wzl_id = 1
+
+        folder_id = 1
+        for g in range(groups):
+            group = StandInFolder(folder_id, "Group %d" % g)
+            folder_id += 1
+            self.fa_groups.append(group)
+
+            for f in range(folders_per_group):
+                folder = StandInFolder(folder_id, "Folder %d-%d" % (g, f),
+                                       group.id)
+                folder_id += 1
+                self.fa_folders.append(folder)
+
+        for i in range(submissions):
+            type, wzl_type = FA_TYPES[rand.randrange(len(FA_TYPES))]
+            sub = StandInSubmission(
+                id=1000 + i,
+                title="Submission %d %s" % (i, rand.choice(
+                    ["sketch", "commission", "story", "song", "study"])),
+                type=type,
+                rating=rand.choice(FA_RATINGS),
+                category=rand.choice(FA_CATEGORIES),
+                tags=["tag%d" % rand.randrange(50) for _ in range(5)],
+                scraps=rand.random() < scraps_ratio,
+            )
+            self.fa_submissions.append(sub)
+
+            if self.fa_folders and not sub.scraps and rand.random() < 0.5:
+                rand.choice(self.fa_folders).submissions.append(sub)
+
+            if rand.random() < migrated_ratio:
+                self.add_wzl_submission(sub.title, wzl_type)
+
+        for group in self.fa_groups:
+            if rand.random() < migrated_ratio:
+                self.add_wzl_folder(group.title)
+
+    def _wzl_id(self):
+        with self._lock:
+            id = self._next_wzl_id
+            self._next_wzl_id += 1
+            return id
+
+    def add_wzl_folder(self, title, parent_id=None):
+        folder = StandInFolder(self._wzl_id(), title, parent_id)
+        self.wzl_folders.append(folder)
+        return folder
+
+    def add_wzl_submission(self, title, type, folder_id=None):
+        sub = StandInSubmission(self._wzl_id(), title, type, None, None, [],
+                                False)
+        self.wzl_submissions.append(sub)
+
+        for folder in self.wzl_folders:
+            if folder.id == folder_id:
+                folder.submissions.append(sub)
+
+        return sub
+
+
+class StandInServer(object):
+    """Serves a StandInAccount as FurAffinity and Weasyl over local HTTP.
+
+    This lets the sessions and the worker run without touching the real
+    sites, e.g. for benchmarks.
+
+    FurAffinity is served below ``fa_root`` and Weasyl below ``wzl_root``;
+    pass these as ``root`` to the sessions.
+
+    Attributes:
+        account (StandInAccount): The account being served
+        latency (float): Seconds to delay every response
+        throttle_every (int): Answer every Nth Weasyl request with a 429,
+            0 to disable
+        retry_after (float): Retry-After value sent with a 429
+        fa_page_size (int): Submissions per FA gallery page
+        wzl_page_size (int): Submissions per Weasyl gallery page
+        fa_logins: Set of FA login cookie values that are logged in
+        media_drop_after (int): Bytes of a media file sent before closing
+            the connection, for requests of the whole file, 0 to disable
+    """
+
+    def __init__(self, account, latency=0.0, throttle_every=0,
+                 retry_after=1, fa_page_size=48, wzl_page_size=100,
+                 media_drop_after=0, host="127.0.0.1", port=0):
+        """Create a stand-in server; call start to begin serving.
+
+        Args:
+            account (StandInAccount): The account to serve
+            latency (float): Seconds to delay every response
+            throttle_every (int): Answer every Nth Weasyl request with 429
+            retry_after (float): Retry-After value sent with a 429
+            fa_page_size (int): Submissions per FA gallery page
+            wzl_page_size (int): Submissions per Weasyl gallery page
+            media_drop_after (int): Bytes of a media file sent before
+                closing the connection, 0 to disable
+            host (str): Address to bind to
+            port (int): Port to bind to, 0 to pick a free one
+        """
+        self.account = account
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.fa_page_size = fa_page_size
+        self.wzl_page_size = wzl_page_size
+        self.media_drop_after = media_drop_after
+
+        self.fa_logins = set()
+        self._login_ids = itertools.count(1)
+
+        self._wzl_requests = 0
+        self._lock = threading.Lock()
+
+        stand_in = self
+
+        class Handler(_Handler):
+            server_state = stand_in
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    @property
+    def fa_root(self):
+        return self.base + "/fa"
+
+    @property
+    def wzl_root(self):
+        return self.base + "/wzl"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        logger.debug("Stand-in server running on %s" % self.base)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _should_throttle(self):
+        if not self.throttle_every:
+            return False
+
+        with self._lock:
+            self._wzl_requests += 1
+            return self._wzl_requests % self.throttle_every == 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="text/html",
+              headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers or []:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_json(self, obj):
+        self._send(200, json.dumps(obj), "application/json")
+
+    def _redirect(self, location):
+        self._send(303, headers=[("Location", location)])
+
+    def _form(self):
+        body = self._body
+        content_type = self.headers.get("Content-Type", "")
+
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser(
+                policy=email.policy.HTTP).parsebytes(
+                b"Content-Type: " + content_type.encode("latin-1") +
+                b"\r\n\r\n" + body)
+
+            fields = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                fields[name] = part.get_payload(decode=True)
+            return fields
+
+        return {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+
+    def _dispatch(self, method):
+        state = self.server_state
+
+        if state.latency:
+            time.sleep(state.latency)
+
+        # Always consume the body, so keep-alive connections stay usable
+        # even when the request is rejected
+        length = int(self.headers.get("Content-Length", 0))
+        self._body = self.rfile.read(length)
+
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path.startswith("/fa/"):
+            routes = _FA_ROUTES
+            path = url.path[3:]
+        elif url.path.startswith("/wzl/"):
+            # Redirect targets are never throttled, as the request that
+            # caused the redirect has already succeeded
+            throttled = method == "POST" or url.path.startswith("/wzl/api/")
+            if throttled and state._should_throttle():
+                self._send(429, headers=[
+                    ("Retry-After", str(state.retry_after))])
+                return
+            routes = _WZL_ROUTES
+            path = url.path[4:]
+        else:
+            routes = []
+            path = url.path
+
+        for route_method, pattern, func in routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                func(self, state, query, *match.groups())
+                return
+
+        self._send(404, "Not found")
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_HEAD(self):
+        self._dispatch("HEAD")
+
+    # FurAffinity
+
+    def fa_captcha(self, state, query):
+        self._send(200, b"\xff\xd8\xff\xe0" + b"\x00" * 256, "image/jpeg")
+
+    def _fa_login_cookie(self):
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        return cookie["a"].value if "a" in cookie else None
+
+    def fa_login(self, state, query):
+        with state._lock:
+            login = "standin-%d" % next(state._login_ids)
+            state.fa_logins.add(login)
+
+        self._send(200, "<html><body>Logged in</body></html>", headers=[
+            ("Set-Cookie", "a=%s; Path=/" % login),
+            ("Set-Cookie", "b=%s; Path=/" % login),
+        ])
+
+    def fa_logout(self, state, query):
+        with state._lock:
+            state.fa_logins.discard(self._fa_login_cookie())
+
+        self._send(200, "<html><body>Logged out</body></html>")
+
+    def fa_settings(self, state, query):
+        # Only account pages check the login, like the site does
+        if self._fa_login_cookie() not in state.fa_logins:
+            self._send(302, headers=[("Location", "/fa/login/")])
+            return
+
+        self._send(200, "<html><body><a id=\"my-username\">~%s</a>"
+                        "</body></html>" % html.escape(state.account.username))
+
+    def fa_folders(self, state, query):
+        account = state.account
+        rows = []
+
+        for group in account.fa_groups:
+            rows.append('<div class="group-row group-%d"><strong>%s</strong>'
+                        '</div>' % (group.id, html.escape(group.title)))
+
+        for folder in account.fa_folders:
+            rows.append('<div class="folder-row folder-%d group-%d">'
+                        '<span class="folder-name"><strong>%s</strong>'
+                        '</span></div>' % (folder.id, folder.parent_id,
+                                           html.escape(folder.title)))
+
+        self._send(200, "<html><body>%s</body></html>" % "".join(rows))
+
+    def _fa_gallery_page(self, state, submissions, page):
+        size = state.fa_page_size
+        page_subs = submissions[(page - 1) * size:page * size]
+        host = self.headers.get("Host")
+
+        items = []
+        for sub in page_subs:
+            items.append(
+                '<figure id="sid-%d" class="r-%s t-%s"><b><u>'
+                '<a href="/fa/view/%d/"><img src="//%s/fa/thumb/%d.jpg">'
+                '</a></u></b><figcaption><p><a><span>%s</span></a></p>'
+                '</figcaption></figure>' % (
+                    sub.id, sub.rating, sub.type, sub.id, host, sub.id,
+                    html.escape(sub.title)))
+
+        if not items:
+            items.append('<p id="no-images">There are no submissions.</p>')
+
+        self._send(200, '<html><body><section class="gallery">%s</section>'
+                        '</body></html>' % "".join(items))
+
+    def fa_gallery(self, state, query, user, page):
+        subs = [s for s in reversed(state.account.fa_submissions)
+                if not s.scraps]
+        self._fa_gallery_page(state, subs, int(page))
+
+    def fa_scraps(self, state, query, user, page):
+        subs = [s for s in reversed(state.account.fa_submissions)
+                if s.scraps]
+        self._fa_gallery_page(state, subs, int(page))
+
+    def fa_folder(self, state, query, user, folder_id, page):
+        for folder in state.account.fa_folders:
+            if folder.id == int(folder_id):
+                self._fa_gallery_page(state, folder.submissions, int(page))
+                return
+
+        self._fa_gallery_page(state, [], int(page))
+
+    def fa_view(self, state, query, id):
+        subs = [s for s in state.account.fa_submissions if s.id == int(id)]
+        if not subs:
+            self._send(404, "Not found")
+            return
+
+        sub = subs[0]
+        host = self.headers.get("Host")
+        ext = {"image": "png", "text": "txt", "audio": "mp3"}[sub.type]
+
+        tags = "".join('<a href="/fa/search/@keywords %s">%s</a>' % (t, t)
+                       for t in sub.tags)
+
+        body = (
+            '<html><body><div id="submission_page">'
+            '<img id="submissionImg" alt="%s" src="//%s/fa/thumb/%d.jpg">'
+            '<div class="submission button">'
+            '<a href="//%s/fa/media/%d.%s">Download</a></div>'
+            '<div class="rating-box %s">%s</div>'
+            '<div class="p20">Description of %s</div>'
+            '<div class="tags-row"><span>Category: %s &gt; General Furry'
+            '</span><span class="tags">%s</span></div>'
+            '</div></body></html>' % (
+                html.escape(sub.title, quote=True), host, sub.id, host,
+                sub.id, ext, sub.rating, sub.rating,
+                html.escape(sub.title), html.escape(sub.category), tags))
+
+        self._send(200, body)
+
+    def fa_media(self, state, query, id, ext):
+        body = media_bytes(int(id), state.account.media_size, ext)
+        headers = [("Accept-Ranges", "bytes")]
+
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match is not None:
+            start = int(match.group(1))
+            if start >= len(body):
+                self._send(416, headers=headers + [
+                    ("Content-Range", "bytes */%d" % len(body))])
+                return
+
+            self._send(206, body[start:], "application/octet-stream",
+                       headers + [("Content-Range", "bytes %d-%d/%d" % (
+                           start, len(body) - 1, len(body)))])
+            return
+
+        if state.media_drop_after and state.media_drop_after < len(body) \
+                and self.command == "GET":
+            # Promise the whole file, then drop the connection
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body[:state.media_drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self._send(200, body, "application/octet-stream", headers)
+
+    def fa_thumb(self, state, query, id):
+        self._send(200, thumbnail_png(int(id)), "image/png")
+
+    # Weasyl
+
+    def wzl_whoami(self, state, query):
+        self._send_json({"login": state.account.username, "userid": 1})
+
+    def wzl_view(self, state, query, user):
+        account = state.account
+        folders = []
+
+        for folder in account.wzl_folders:
+            if folder.parent_id is not None:
+                continue
+
+            folders.append({
+                "folder_id": folder.id,
+                "title": folder.title,
+                "subfolders": [
+                    {"folder_id": sub.id, "title": sub.title}
+                    for sub in account.wzl_folders
+                    if sub.parent_id == folder.id
+                ],
+            })
+
+        self._send_json({"login": account.username, "folders": folders})
+
+    def wzl_gallery(self, state, query, user):
+        account = state.account
+
+        if "folderid" in query:
+            folder_id = int(query["folderid"])
+            subs = []
+            for folder in account.wzl_folders:
+                if folder.id == folder_id:
+                    subs = list(folder.submissions)
+        else:
+            subs = list(account.wzl_submissions)
+
+        subs.sort(key=lambda s: s.id, reverse=True)
+
+        if "nextid" in query:
+            next_id = int(query["nextid"])
+            subs = [s for s in subs if s.id < next_id]
+
+        page = subs[:state.wzl_page_size]
+        more = len(subs) > len(page)
+        host = self.headers.get("Host")
+
+        self._send_json({
+            "submissions": [{
+                "submitid": s.id,
+                "title": s.title,
+                "subtype": s.type,
+                "media": {"thumbnail": [
+                    {"url": "http://%s/wzl/thumb/%d.jpg" % (host, s.id)}]},
+            } for s in page],
+            "nextid": page[-1].id if more else None,
+            "backid": None,
+        })
+
+    def wzl_create_folder(self, state, query):
+        form = self._form()
+        title = form.get("title")
+        parent_id = form.get("parentid")
+
+        if isinstance(title, bytes):
+            title = title.decode("utf-8")
+
+        parent_id = int(parent_id) if parent_id else None
+        state.account.add_wzl_folder(title, parent_id)
+
+        self._send(200, "<html><body>Created</body></html>")
+
+    def wzl_submit(self, state, query, type):
+        form = self._form()
+        title = form.get("title", b"")
+        folder_id = form.get("folderid")
+
+        if isinstance(title, bytes):
+            title = title.decode("utf-8")
+        if isinstance(folder_id, bytes):
+            folder_id = folder_id.decode("utf-8")
+
+        sub = state.account.add_wzl_submission(
+            title, type, int(folder_id) if folder_id else None)
+
+        if type == "literary":
+            self._redirect("/wzl/manage/thumbnail?submitid=%d" % sub.id)
+        else:
+            self._redirect("/wzl/submission/%d" % sub.id)
+
+    def wzl_thumbnail_form(self, state, query):
+        self._send(200, "<html><body>Thumbnail</body></html>")
+
+    def wzl_submission(self, state, query, id):
+        self._send(200, "<html><body>Submission %s</body></html>" % id)
+
+    def wzl_thumb(self, state, query, id):
+        self._send(200, thumbnail_png(int(id)), "image/png")
+
+
+_FA_ROUTES = [
+    ("GET", r"/captcha\.jpg", _Handler.fa_captcha),
+    ("POST", r"/login/", _Handler.fa_login),
+    ("GET", r"/logout/", _Handler.fa_logout),
+    ("GET", r"/controls/settings/", _Handler.fa_settings),
+    ("GET", r"/controls/folders/submissions/", _Handler.fa_folders),
+    ("GET", r"/gallery/([^/]+)/folder/(\d+)/-/(\d+)/", _Handler.fa_folder),
+    ("GET", r"/gallery/([^/]+)/(\d+)/", _Handler.fa_gallery),
+    ("GET", r"/scraps/([^/]+)/(\d+)/", _Handler.fa_scraps),
+    ("GET", r"/view/(\d+)/", _Handler.fa_view),
+    ("GET", r"/media/(\d+)\.(\w+)", _Handler.fa_media),
+    ("HEAD", r"/media/(\d+)\.(\w+)", _Handler.fa_media),
+    ("GET", r"/thumb/(\d+)\.jpg", _Handler.fa_thumb),
+]
+
+_WZL_ROUTES = [
+    ("GET", r"/api/whoami", _Handler.wzl_whoami),
+    ("GET", r"/api/users/([^/]+)/view", _Handler.wzl_view),
+    ("GET", r"/api/users/([^/]+)/gallery", _Handler.wzl_gallery),
+    ("POST", r"/control/createfolder", _Handler.wzl_create_folder),
+    ("POST", r"/submit/(visual|literary|multimedia)", _Handler.wzl_submit),
+    ("GET", r"/manage/thumbnail", _Handler.wzl_thumbnail_form),
+    ("POST", r"/manage/thumbnail", _Handler.wzl_thumbnail_form),
+    ("GET", r"/submission/(\d+)", _Handler.wzl_submission),
+    ("GET", r"/thumb/(\d+)\.jpg", _Handler.wzl_thumb),
+]
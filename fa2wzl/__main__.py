@@ -0,0 +1,5 @@
+from fa2wzl.cli import main
+
+# Guarded, as preprocessing processes import the main module again
+if __name__ == "__main__":
+    main()
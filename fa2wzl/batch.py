@@ -0,0 +1,168 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+
+from fa2wzl import constants
+from fa2wzl.logging import logger
+from fa2wzl.ratelimit import BandwidthLimiter, RateLimiter
+from fa2wzl.thumbnails import ThumbnailCache, default_cache_dir
+
+
+class BatchRunner(object):
+    """Migrates many accounts in one process.
+
+    The sessions of all accounts share one FA page limiter, the Weasyl read
+    and write limiters, the bandwidth limits and the connection pools for
+    pages and for media, so the batch as a whole stays within the sites'
+    limits however many accounts it has. Their workers share one thumbnail
+    cache. Cookies and API keys stay with each account's session.
+
+    Accounts run on their own threads. The limiters hand out their tokens in
+    the order they are asked for, so accounts take turns instead of one
+    account's crawl starving the others, and one account's upload interval
+    is spent uploading for the others.
+
+    Attributes:
+        workers (int): Accounts migrated at the same time
+        page_limiter (RateLimiter): Shared limiter for FA pages
+        read_limiter (RateLimiter): Shared limiter for Weasyl API reads
+        write_limiter (RateLimiter): Shared limiter for Weasyl writes
+        download_limiter (BandwidthLimiter): Shared limit for media
+            downloads, which can be changed while running
+        upload_limiter (BandwidthLimiter): Shared limit for uploads, which
+            can be changed while running
+        adapter (HTTPAdapter): Connection pools shared by all sessions
+        media_adapter (HTTPAdapter): Connection pools shared by all media
+            downloads
+        thumbnail_cache (ThumbnailCache): Thumbnails shared by all workers
+        listeners: Callables called with an event name and a dict of details,
+            which include the account name. Worker events are passed on, and
+            "account_finished" has the error if the account failed.
+    """
+
+    def __init__(self, workers=constants.BATCH_WORKERS,
+                 download_rate=constants.DOWNLOAD_BYTES_PER_SECOND,
+                 upload_rate=constants.UPLOAD_BYTES_PER_SECOND):
+        """Create a batch runner.
+
+        Args:
+            workers (int, optional): Accounts migrated at the same time
+            download_rate (int, optional): Bytes per second all downloads
+                may use together, 0 for no limit
+            upload_rate (int, optional): Bytes per second all uploads may
+                use together, 0 for no limit
+        """
+        self.workers = workers
+
+        self.page_limiter = RateLimiter(
+            constants.FA_PAGE_REQUESTS_PER_MINUTE, per=60,
+            burst=constants.FA_PAGE_REQUESTS_PER_MINUTE)
+        self.read_limiter = RateLimiter(constants.WZL_API_READS_PER_SECOND,
+                                        burst=constants.WZL_API_READ_BURST)
+        self.write_limiter = RateLimiter(constants.WZL_API_WRITES_PER_MINUTE,
+                                         per=60,
+                                         burst=constants.WZL_API_WRITE_BURST)
+        self.download_limiter = BandwidthLimiter(download_rate)
+        self.upload_limiter = BandwidthLimiter(upload_rate)
+
+        # Every running account may hold a connection to each site
+        self.adapter = HTTPAdapter(
+            pool_connections=constants.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=max(constants.HTTP_POOL_MAXSIZE, workers * 2))
+        self.media_adapter = HTTPAdapter(
+            pool_connections=constants.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=workers * constants.MEDIA_CONCURRENCY)
+
+        self.thumbnail_cache = ThumbnailCache(default_cache_dir())
+
+        self.listeners = []
+
+        self._lock = threading.Lock()
+        self._accounts = []
+
+    @property
+    def fa_session_options(self):
+        """dict: Keyword arguments sharing the budgets with an FASession"""
+        return {
+            "page_limiter": self.page_limiter,
+            "download_limiter": self.download_limiter,
+            "adapter": self.adapter,
+            "media_adapter": self.media_adapter,
+        }
+
+    @property
+    def wzl_session_options(self):
+        """dict: Keyword arguments sharing the budgets with a WZLSession"""
+        return {
+            "read_limiter": self.read_limiter,
+            "write_limiter": self.write_limiter,
+            "upload_limiter": self.upload_limiter,
+            "adapter": self.adapter,
+        }
+
+    def _notify(self, event, **data):
+        """Tell the listeners about progress.
+
+        Args:
+            event (str): The event name
+            **data: Event details
+        """
+        for listener in list(self.listeners):
+            listener(event, data)
+
+    def add(self, name, worker, migrate):
+        """Add an account to the batch.
+
+        Args:
+            name (str): The account name used in events
+            worker (Worker): The account's worker, with sessions made with
+                fa_session_options and wzl_session_options, and using
+                thumbnail_cache
+            migrate: Callable taking the worker, running its stages
+        """
+        def forward(event, data):
+            self._notify(event, account=name, **data)
+
+        worker.listeners.append(forward)
+
+        with self._lock:
+            self._accounts.append((name, worker, migrate))
+
+    def _run_account(self, name, worker, migrate):
+        try:
+            migrate(worker)
+        except Exception as e:
+            logger.exception("Migrating %s failed" % name)
+            self._notify("account_finished", account=name, error=e)
+            return e
+
+        self._notify("account_finished", account=name, error=None)
+        return None
+
+    def run(self):
+        """Migrate all accounts, continuing past accounts that fail.
+
+        Returns:
+            dict: Account names to the exception they failed with, or None
+        """
+        with self._lock:
+            accounts = list(self._accounts)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [(name, executor.submit(self._run_account, name,
+                                              worker, migrate))
+                       for name, worker, migrate in accounts]
+
+            return {name: future.result() for name, future in futures}
+
+    @property
+    def rate_limit_stats(self):
+        """dict: Wait statistics of the shared limiters"""
+        return {
+            "fa_page": self.page_limiter.stats,
+            "wzl_read": self.read_limiter.stats,
+            "wzl_write": self.write_limiter.stats,
+            "download": self.download_limiter.stats,
+            "upload": self.upload_limiter.stats,
+        }
@@ -0,0 +1,832 @@
+"""Command-line migration runner.
+
+Runs the migration without a user interface, e.g. from cron on a server:
+
+    fa2wzl plan config.json plan.json
+    fa2wzl check accounts.json --batch --window 8
+    fa2wzl run config.json --plan plan.json --json
+    fa2wzl batch accounts.json --upload-limit 500K
+    fa2wzl queue add queue.db accounts.json
+    fa2wzl queue work queue.db accounts.json
+
+The configuration is a JSON file:
+
+    {
+        "fa": {"username": "...", "cookies": {"a": "...", "b": "..."}},
+        "weasyl": {"api_key": "..."},
+        "interval_minutes": 5,
+        "schedule": {"per_hour": 12, "burst": 3, "hours": ["22:00-06:00"],
+                     "type_minutes": {"literary": 30}, "concurrent": 1},
+        "create_folders": true,
+        "exclude": [123, 456],
+        "trace_report": "trace.txt"
+    }
+
+The FA cookies are those of a browser logged in to the site, as logging in
+needs a CAPTCHA solved. Without them, the cookies and API key the GUI saved
+are used, if FA2WZL_LOGIN_PASSPHRASE holds the passphrase of its login store;
+"login_store" can name another store file. "root" can be set for either site
+to use another server. "schedule" sets further limits on when uploads
+start: a rate per hour with a burst, the local hours they may start in,
+minutes between uploads of the same Weasyl type, and how many run at once.
+A batch file has a list of such configurations as "accounts", each
+optionally with a "plan" file. Queued accounts are only spaced by
+"interval_minutes", as their uploads may run in several processes.
+
+Only the standard library is imported until a command runs, and Qt never
+is, so starting up stays quick.
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+
+from fa2wzl import constants
+from fa2wzl.exceptions import AuthenticationError, ConfigError
+from fa2wzl.plan import (check_submissions, estimate, load_plan, make_plan,
+                         select_submissions)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError("Cannot read %s: %s" % (path, e))
+
+
+def check_config(config, where):
+    """Check an account configuration and fill in defaults.
+
+    Args:
+        config: The parsed configuration
+        where (str): Where it came from, for error messages
+
+    Returns:
+        dict: The configuration
+
+    Raises:
+        ConfigError: If the configuration is incomplete
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("%s must hold a JSON object" % where)
+
+    fa = config.get("fa") or {}
+    weasyl = config.get("weasyl") or {}
+
+    if not fa.get("username"):
+        raise ConfigError("%s: fa.username is missing" % where)
+    if "cookies" in fa and not isinstance(fa["cookies"], dict):
+        raise ConfigError("%s: fa.cookies must be an object" % where)
+
+    # Missing secrets may still be in the login store
+    config["fa"] = fa
+    config["weasyl"] = weasyl
+
+    config.setdefault("interval_minutes", 0)
+    config.setdefault("create_folders", True)
+    config["exclude"] = set(config.get("exclude") or ())
+
+    schedule = config.setdefault("schedule", {})
+    if not isinstance(schedule, dict):
+        raise ConfigError("%s: schedule must be an object" % where)
+    if not isinstance(schedule.get("type_minutes", {}), dict):
+        raise ConfigError("%s: schedule.type_minutes must be an object" %
+                          where)
+
+    return config
+
+
+def load_config(path):
+    """Read and check a configuration file.
+
+    Args:
+        path (str): The JSON file
+
+    Returns:
+        dict: The configuration
+
+    Raises:
+        ConfigError: If the file is missing, unreadable or incomplete
+    """
+    return check_config(_read_json(path), path)
+
+
+def load_batch(path):
+    """Read and check a batch file.
+
+    It is a JSON object with a list of account configurations as accounts.
+    An account can name its plan file as plan.
+
+    Args:
+        path (str): The JSON file
+
+    Returns:
+        list: The account configurations
+
+    Raises:
+        ConfigError: If the file or an account in it is invalid
+    """
+    batch = _read_json(path)
+
+    if not isinstance(batch, dict) or \
+            not isinstance(batch.get("accounts"), list):
+        raise ConfigError("%s must have a list of accounts" % path)
+
+    return [check_config(config, "%s account %d" % (path, i + 1))
+            for i, config in enumerate(batch["accounts"])]
+
+
+_BANDWIDTH_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def bandwidth(value):
+    """Parse a bandwidth limit given on the command line.
+
+    Args:
+        value (str): Bytes per second, optionally with a K, M or G suffix
+
+    Returns:
+        int: Bytes per second
+
+    Raises:
+        ArgumentTypeError: If the value is not a limit
+    """
+    number = value.strip().upper()
+    unit = number[-1:] if number[-1:] in _BANDWIDTH_UNITS else ""
+    number = number[:len(number) - len(unit)]
+
+    try:
+        rate = int(float(number) * _BANDWIDTH_UNITS[unit])
+    except (ValueError, OverflowError):
+        rate = -1
+    if rate < 0:
+        raise argparse.ArgumentTypeError("%r is not a bandwidth, e.g. 500K "
+                                         "or 2M" % value)
+
+    return rate
+
+
+def _bandwidth_options(args):
+    from fa2wzl.ratelimit import BandwidthLimiter
+
+    # The sessions of all accounts of a process share one limit
+    download = BandwidthLimiter(args.download_limit)
+    upload = BandwidthLimiter(args.upload_limit)
+    return {"download_limiter": download}, {"upload_limiter": upload}
+
+
+def _report_bandwidth(reporter, fa_options, wzl_options):
+    reporter.emit("bandwidth",
+                  download=fa_options["download_limiter"].stats,
+                  upload=wzl_options["upload_limiter"].stats)
+
+
+def _open_sessions(config, fa_options=None, wzl_options=None):
+    from fa2wzl.fa.session import FASession
+    from fa2wzl.wzl.session import WZLSession
+
+    fa = config["fa"]
+    weasyl = config["weasyl"]
+
+    fa_kwargs = dict(fa_options or {})
+    wzl_kwargs = dict(wzl_options or {})
+    if fa.get("root"):
+        fa_kwargs["root"] = fa["root"]
+    if weasyl.get("root"):
+        wzl_kwargs["root"] = weasyl["root"]
+
+    cookies = fa.get("cookies")
+    api_key = weasyl.get("api_key")
+
+    if cookies is None or not api_key:
+        from fa2wzl.logins import store_from_environment
+
+        store = store_from_environment(config.get("login_store"))
+        login = store.load(fa["username"]) if store is not None else None
+        if login is None:
+            raise ConfigError("No FA cookies for %s in the configuration "
+                              "or the login store" % fa["username"])
+
+        cookies = cookies if cookies is not None else login["cookies"]
+        api_key = api_key or login.get("wzl_api_key")
+        if not api_key:
+            raise ConfigError("No Weasyl API key for %s in the "
+                              "configuration or the login store" %
+                              fa["username"])
+
+    fa_sess = FASession(fa["username"], **fa_kwargs)
+    fa_sess.set_cookies(cookies)
+
+    # One page request tells whether the cookies are still any good,
+    # before anything else is done with them
+    if not fa_sess.check_login():
+        raise AuthenticationError()
+
+    wzl_sess = WZLSession(api_key, **wzl_kwargs)
+
+    return fa_sess, wzl_sess
+
+
+def _make_worker(config, fa_options=None, wzl_options=None,
+                 preprocessor=None, thumbnail_cache=None):
+    from fa2wzl.thumbnails import ThumbnailCache, default_cache_dir
+    from fa2wzl.tracing import Tracer
+    from fa2wzl.worker import Worker
+
+    fa_sess, wzl_sess = _open_sessions(config, fa_options, wzl_options)
+    tracer = Tracer(report_path=config.get("trace_report"))
+
+    # Thumbnails the GUI has shown are not downloaded again
+    if thumbnail_cache is None:
+        thumbnail_cache = ThumbnailCache(default_cache_dir())
+
+    return Worker(fa_sess, wzl_sess, tracer, preprocessor, thumbnail_cache)
+
+
+def make_scheduler(config, args):
+    """Build the upload scheduler of an account.
+
+    Options given on the command line override the configuration.
+
+    Args:
+        config (dict): The account configuration
+        args: The parsed command line
+
+    Returns:
+        UploadScheduler: The scheduler
+
+    Raises:
+        ConfigError: If a time window is invalid
+    """
+    from fa2wzl.schedule import (FixedInterval, HourlyRate, TimeWindows,
+                                 TypeSpacing, UploadScheduler)
+
+    schedule = config["schedule"]
+
+    def option(name):
+        value = getattr(args, name, None)
+        return value if value is not None else schedule.get(name)
+
+    policies = []
+
+    interval = args.interval if args.interval is not None \
+        else config["interval_minutes"]
+    if interval > 0:
+        policies.append(FixedInterval(60 * interval))
+
+    per_hour = option("per_hour")
+    if per_hour:
+        try:
+            policies.append(HourlyRate(per_hour, option("burst") or
+                                       constants.UPLOAD_BURST))
+        except ValueError as e:
+            raise ConfigError(str(e))
+
+    hours = option("hours")
+    if hours:
+        try:
+            policies.append(TimeWindows(hours))
+        except ValueError as e:
+            raise ConfigError(str(e))
+
+    type_minutes = schedule.get("type_minutes")
+    if type_minutes:
+        policies.append(TypeSpacing({type: 60 * minutes for type, minutes
+                                     in type_minutes.items()}))
+
+    return UploadScheduler(policies, option("concurrent") or
+                           constants.UPLOAD_CONCURRENCY)
+
+
+def _make_preprocessor(args):
+    if not args.preprocess:
+        return None
+
+    from fa2wzl.preprocess import Preprocessor
+    return Preprocessor(args.preprocess)
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+
+def _describe(value):
+    # Models become their ID and title, which is all a log line needs
+    if hasattr(value, "id") and hasattr(value, "title"):
+        return {"id": value.id, "title": value.title}
+    if isinstance(value, Exception):
+        return repr(value)
+    return value
+
+
+class Reporter(object):
+    """Worker listener printing progress to a stream.
+
+    Attributes:
+        json (bool): Whether to print one JSON object per line instead of text
+    """
+
+    def __init__(self, stream=None, json=False):
+        self.stream = stream if stream is not None else sys.stdout
+        self.json = json
+
+        # Batches report from several threads
+        self._lock = threading.Lock()
+
+    def __call__(self, event, data):
+        self.emit(event, **data)
+
+    def emit(self, event, **data):
+        """Print an event.
+
+        Args:
+            event (str): The event name
+            **data: Event details
+        """
+        if self.json:
+            record = {"event": event}
+            record.update((k, _describe(v)) for k, v in data.items())
+            line = json.dumps(record, sort_keys=True)
+        else:
+            line = self._text(event, data)
+
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def _text(self, event, data):
+        if "account" in data:
+            data = dict(data)
+            return "%s: %s" % (data.pop("account"), self._text(event, data))
+
+        if event == "stage_started":
+            return "%s..." % data["stage"]
+        if event == "stage_finished":
+            return "%s done" % data["stage"]
+        if event in ("submission_started", "submission_finished"):
+            sub = data["submission"]
+            verb = "Uploading" if event == "submission_started" \
+                else "Uploaded"
+            return "[%d/%d] %s #%d: %s" % (data["index"] + 1, data["total"],
+                                           verb, sub.id, sub.title)
+        if event == "submission_downloaded":
+            sub = data["submission"]
+            return "[%d/%d] Downloaded #%d: %s (%d KiB)" % (
+                data["index"] + 1, data["total"], sub.id, sub.title,
+                data["size"] // 1024)
+        if event == "error" and data["submission"] is None:
+            return "Failed: %s" % data["error"]
+        if event in ("submission_skipped", "error"):
+            sub = data["submission"]
+            verb = "Skipped" if event == "submission_skipped" else "Failed"
+            line = "[%d/%d] %s #%d: %s" % (data["index"] + 1, data["total"],
+                                           verb, sub.id, sub.title)
+            if data["error"] is not None:
+                line += " (%s)" % data["error"]
+            return line
+        if event == "waiting":
+            line = "Waiting %d seconds" % data["seconds"]
+            if data.get("eta") is not None:
+                line += ", all done in about %s" % _duration(data["eta"])
+            return line
+        if event == "cancelled":
+            return "Cancelled with %d of %d submissions left" % (
+                data["total"] - data["index"], data["total"])
+        if event == "problem":
+            return "#%d %s: %s: %s" % (data["id"], data["title"],
+                                       data["level"], data["message"])
+        if event == "check_finished":
+            line = "%d submissions, %d folders, %d MiB: %d errors, %d " \
+                   "warnings; about %s" % (
+                       data["submissions"], data["folders_to_create"],
+                       data["media_bytes"] // 1024 ** 2, data["errors"],
+                       data["warnings"],
+                       _duration(data["estimate"]["total_seconds"]))
+            if "fits" in data:
+                line += ", %s the window" % (
+                    "fits" if data["fits"] else "does NOT fit")
+            return line
+        if event == "bandwidth":
+            return "Downloaded %d KiB at %.0f KiB/s, uploaded %d KiB at " \
+                   "%.0f KiB/s" % tuple(
+                       value / 1024 for direction in ("download", "upload")
+                       for value in (data[direction]["bytes"],
+                                     data[direction]["bytes_per_second"]))
+
+        details = " ".join("%s=%s" % (k, _describe(v))
+                           for k, v in sorted(data.items()))
+        return ("%s %s" % (event, details)).strip()
+
+
+def plan_command(args, reporter):
+    config = load_config(args.config)
+    worker = _make_worker(config)
+    worker.listeners.append(reporter)
+
+    plan = make_plan(worker, config["exclude"])
+
+    with open(args.plan, "w") as f:
+        json.dump(plan, f, indent=2)
+
+    reporter.emit("plan_written", path=args.plan,
+                  folders=len(plan["folders_to_create"]),
+                  submissions=len(plan["submissions"]))
+
+
+def migrate(worker, config, plan=None, scheduler=None):
+    """Run all stages of a migration.
+
+    Args:
+        worker (Worker): The worker, with its sessions
+        config (dict): The account configuration
+        plan (dict, optional): A plan to create the submissions of, instead
+            of scanning the galleries
+        scheduler (UploadScheduler, optional): Decides when uploads start,
+            instead of the configured interval
+    """
+    worker.map_folders()
+    if config["create_folders"]:
+        worker.create_folders()
+
+    select_submissions(worker, config, plan)
+
+    worker.create_all(config["interval_minutes"], scheduler)
+
+
+def run_command(args, reporter):
+    config = load_config(args.config)
+    plan = load_plan(args.plan) if args.plan else None
+    scheduler = make_scheduler(config, args)
+
+    fa_options, wzl_options = _bandwidth_options(args)
+    preprocessor = _make_preprocessor(args)
+    worker = _make_worker(config, fa_options, wzl_options, preprocessor)
+    worker.listeners.append(reporter)
+
+    try:
+        migrate(worker, config, plan, scheduler)
+    finally:
+        if preprocessor is not None:
+            preprocessor.close()
+        _report_bandwidth(reporter, fa_options, wzl_options)
+
+
+def batch_command(args, reporter):
+    from fa2wzl.batch import BatchRunner
+
+    configs = load_batch(args.batch)
+    runner = BatchRunner(args.workers, args.download_limit,
+                         args.upload_limit)
+    runner.listeners.append(reporter)
+
+    # Check every plan before anything is migrated
+    plans = [load_plan(config["plan"]) if config.get("plan") else None
+             for config in configs]
+
+    # The processes are shared by all accounts
+    preprocessor = _make_preprocessor(args)
+
+    # Every account has its own schedule; bad ones are found up front
+    schedulers = [make_scheduler(config, args) for config in configs]
+
+    for config, plan, scheduler in zip(configs, plans, schedulers):
+        worker = _make_worker(config, runner.fa_session_options,
+                              runner.wzl_session_options, preprocessor,
+                              runner.thumbnail_cache)
+        runner.add(config["fa"]["username"], worker,
+                   lambda worker, config=config, plan=plan,
+                   scheduler=scheduler: migrate(worker, config, plan,
+                                                scheduler))
+
+    try:
+        errors = runner.run()
+    finally:
+        if preprocessor is not None:
+            preprocessor.close()
+    _report_bandwidth(reporter, runner.fa_session_options,
+                      runner.wzl_session_options)
+
+    failed = sorted(name for name, error in errors.items()
+                    if error is not None)
+    reporter.emit("batch_finished", accounts=len(errors), failed=failed)
+    if failed:
+        sys.exit(1)
+
+
+def _check_account(worker, config, plan, args):
+    # A run without a plan scans the same gallery pages again
+    pages = []
+
+    def count_pages(event, data):
+        if event == "submissions_page":
+            pages.append(data["listing"])
+
+    worker.fa_sess.listeners.append(count_pages)
+    try:
+        worker.map_folders()
+        select_submissions(worker, config, plan)
+    finally:
+        worker.fa_sess.listeners.remove(count_pages)
+
+    return check_submissions(worker, make_scheduler(config, args),
+                             config["create_folders"],
+                             bool(args.preprocess),
+                             len(pages) if plan is None else 0)
+
+
+def check_command(args, reporter):
+    from fa2wzl.batch import BatchRunner
+
+    if args.batch:
+        configs = load_batch(args.config)
+        if not configs:
+            raise ConfigError("%s has no accounts" % args.config)
+    else:
+        configs = [load_config(args.config)]
+        if args.plan:
+            configs[0]["plan"] = args.plan
+
+    plans = [load_plan(config["plan"]) if config.get("plan") else None
+             for config in configs]
+
+    # Accounts are checked with the limits a batch of them would share
+    runner = BatchRunner(args.workers, args.download_limit,
+                         args.upload_limit)
+
+    reports = []
+    for config, plan in zip(configs, plans):
+        worker = _make_worker(config, runner.fa_session_options,
+                              runner.wzl_session_options,
+                              thumbnail_cache=runner.thumbnail_cache)
+        worker.listeners.append(reporter)
+
+        report = _check_account(worker, config, plan, args)
+        report["estimate"] = estimate(worker, [report["costs"]])
+        reports.append(report)
+
+        for problem in report["problems"]:
+            reporter.emit("problem", account=report["fa_username"],
+                          **problem)
+
+    summary = {
+        "accounts": len(reports),
+        "submissions": sum(r["submissions"] for r in reports),
+        "folders_to_create": sum(r["folders_to_create"] for r in reports),
+        "errors": sum(1 for r in reports for p in r["problems"]
+                      if p["level"] == "error"),
+        "warnings": sum(1 for r in reports for p in r["problems"]
+                        if p["level"] == "warning"),
+        "media_bytes": sum(r["costs"]["media_bytes"] for r in reports),
+        "estimate": estimate(worker, [r["costs"] for r in reports],
+                             min(args.workers, len(reports))),
+    }
+    if args.window is not None:
+        summary["window_seconds"] = 3600 * args.window
+        summary["fits"] = summary["estimate"]["total_seconds"] <= \
+            summary["window_seconds"]
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"summary": summary, "accounts": reports}, f,
+                      indent=2)
+
+    reporter.emit("check_finished", **summary)
+    if summary["errors"] or not summary.get("fits", True):
+        sys.exit(1)
+
+
+def queue_add_command(args, reporter):
+    from fa2wzl.jobqueue import CRAWL, JobQueue
+
+    configs = load_batch(args.batch)
+    queue = JobQueue(args.queue)
+
+    # The policies of a schedule only hold within one process
+    for i, config in enumerate(configs):
+        schedule = config["schedule"]
+        if any(schedule.get(name) for name in
+               ("per_hour", "hours", "type_minutes")) or \
+                schedule.get("concurrent", 1) != 1:
+            raise ConfigError("%s account %d: the queue only spaces uploads "
+                              "by interval_minutes, not by schedule" % (
+                                  args.batch, i + 1))
+
+    for config in configs:
+        options = {
+            "create_folders": config["create_folders"],
+            "exclude": sorted(config["exclude"]),
+            "interval_minutes": config["interval_minutes"],
+        }
+        added = queue.put(CRAWL, config["fa"]["username"], payload=options,
+                          replace=True)
+        reporter.emit("job_added", kind=CRAWL,
+                      account=config["fa"]["username"], added=added)
+
+
+def queue_work_command(args, reporter):
+    from fa2wzl.jobqueue import JobQueue, QueueWorker
+
+    configs = {config["fa"]["username"]: config
+               for config in load_batch(args.batch)}
+    fa_options, wzl_options = _bandwidth_options(args)
+
+    def make_worker(account):
+        if account not in configs:
+            raise ConfigError("No configuration for account %r" % account)
+        return _make_worker(configs[account], fa_options, wzl_options)
+
+    queue = JobQueue(args.queue)
+    worker = QueueWorker(queue, make_worker,
+                         args.spool or args.queue + ".spool",
+                         kinds=args.kinds, lease_seconds=args.lease,
+                         heartbeat_seconds=min(
+                             constants.JOB_HEARTBEAT_SECONDS, args.lease / 5))
+    worker.listeners.append(reporter)
+
+    try:
+        worker.run(exit_when_idle=not args.keep_running)
+    finally:
+        _report_bandwidth(reporter, fa_options, wzl_options)
+
+
+def queue_status_command(args, reporter):
+    from fa2wzl.jobqueue import JobQueue
+
+    queue = JobQueue(args.queue)
+
+    for kind, states in queue.counts().items():
+        reporter.emit("jobs", kind=kind, **states)
+    for kind, account, fa_id, error in queue.failures():
+        reporter.emit("job_failed", kind=kind, account=account, fa_id=fa_id,
+                      error=error)
+
+
+def _add_bandwidth_arguments(parser):
+    parser.add_argument("--download-limit", type=bandwidth,
+                        default=constants.DOWNLOAD_BYTES_PER_SECOND,
+                        metavar="BYTES",
+                        help="Bytes per second for media downloads, e.g. "
+                             "2M; 0 for no limit")
+    parser.add_argument("--upload-limit", type=bandwidth,
+                        default=constants.UPLOAD_BYTES_PER_SECOND,
+                        metavar="BYTES",
+                        help="Bytes per second for uploads, e.g. 500K; 0 "
+                             "for no limit")
+
+
+def _add_preprocess_argument(parser):
+    parser.add_argument("--preprocess", type=int, nargs="?", default=0,
+                        const=constants.PREPROCESS_WORKERS,
+                        metavar="PROCESSES",
+                        help="Check files against Weasyl's limits and "
+                             "convert oversized images before uploading, "
+                             "in this many processes")
+
+
+def _add_schedule_arguments(parser):
+    parser.add_argument("--per-hour", type=float, metavar="UPLOADS",
+                        help="Upload at most this many submissions an hour")
+    parser.add_argument("--burst", type=int, metavar="UPLOADS",
+                        help="Uploads the hourly rate allows at once")
+    parser.add_argument("--hours", action="append", metavar="HH:MM-HH:MM",
+                        help="Only start uploads in this window of the "
+                             "local day; can be repeated")
+    parser.add_argument("--concurrent", type=int, metavar="UPLOADS",
+                        help="Uploads running at the same time, for "
+                             "accounts where notifications do not matter")
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog="fa2wzl",
+        description="Migrate a FurAffinity gallery to Weasyl.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print progress as one JSON object per line")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="Log more to stderr, twice for debug output")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    plan = commands.add_parser(
+        "plan", help="Write what would be created, changing nothing")
+    plan.add_argument("config", help="The JSON configuration")
+    plan.add_argument("plan", help="The plan file to write")
+    plan.set_defaults(func=plan_command)
+
+    check = commands.add_parser(
+        "check", help="Check every submission a run would create and "
+                      "estimate how long it takes, changing nothing")
+    check.add_argument("config", help="The JSON configuration, or a batch "
+                                      "file with --batch")
+    check.add_argument("--batch", action="store_true",
+                       help="Check all accounts of a batch file")
+    check.add_argument("--plan", help="Check the submissions of this plan "
+                                      "instead of scanning the galleries")
+    check.add_argument("--interval", type=float, metavar="MINUTES",
+                       help="Wait between uploads, overrides the "
+                            "configuration")
+    check.add_argument("--workers", type=int,
+                       default=constants.BATCH_WORKERS,
+                       help="Accounts the batch migrates at the same time")
+    check.add_argument("--window", type=float, metavar="HOURS",
+                       help="Fail unless the run fits in this many hours")
+    check.add_argument("--report", help="Write the full report to this "
+                                        "JSON file")
+    _add_bandwidth_arguments(check)
+    _add_schedule_arguments(check)
+    _add_preprocess_argument(check)
+    check.set_defaults(func=check_command)
+
+    run = commands.add_parser("run", help="Create folders and submissions")
+    run.add_argument("config", help="The JSON configuration")
+    run.add_argument("--plan", help="Create the submissions of this plan "
+                                    "instead of scanning the galleries")
+    run.add_argument("--interval", type=float, metavar="MINUTES",
+                     help="Wait between uploads, overrides the "
+                          "configuration")
+    _add_bandwidth_arguments(run)
+    _add_schedule_arguments(run)
+    _add_preprocess_argument(run)
+    run.set_defaults(func=run_command)
+
+    batch = commands.add_parser(
+        "batch", help="Migrate many accounts, sharing the rate limits")
+    batch.add_argument("batch", help="JSON file with a list of account "
+                                     "configurations as accounts")
+    batch.add_argument("--workers", type=int,
+                       default=constants.BATCH_WORKERS,
+                       help="Accounts migrated at the same time")
+    batch.add_argument("--interval", type=float, metavar="MINUTES",
+                       help="Wait between uploads of an account, overrides "
+                            "the configurations")
+    _add_bandwidth_arguments(batch)
+    _add_schedule_arguments(batch)
+    _add_preprocess_argument(batch)
+    batch.set_defaults(func=batch_command)
+
+    queue = commands.add_parser(
+        "queue", help="Share the work through a job queue, e.g. between "
+                      "processes on several hosts")
+    queue_commands = queue.add_subparsers(dest="queue_command")
+    queue_commands.required = True
+
+    add = queue_commands.add_parser("add", help="Queue accounts to migrate")
+    add.add_argument("queue", help="The SQLite queue file")
+    add.add_argument("batch", help="JSON file with a list of account "
+                                   "configurations as accounts")
+    add.set_defaults(func=queue_add_command)
+
+    work = queue_commands.add_parser("work", help="Run jobs from the queue")
+    work.add_argument("queue", help="The SQLite queue file")
+    work.add_argument("batch", help="JSON file with the configurations of "
+                                    "the queued accounts")
+    work.add_argument("--spool", help="Where downloads wait for their "
+                                      "upload, shared by all workers")
+    work.add_argument("--kinds", nargs="+",
+                      choices=["crawl", "prefetch", "transfer", "upload"],
+                      help="Only run these kinds of jobs")
+    work.add_argument("--lease", type=float,
+                      default=constants.JOB_LEASE_SECONDS, metavar="SECONDS",
+                      help="Time after which the jobs of a dead worker are "
+                           "run by others")
+    work.add_argument("--keep-running", action="store_true",
+                      help="Wait for more jobs once the queue is done")
+    _add_bandwidth_arguments(work)
+    work.set_defaults(func=queue_work_command)
+
+    status = queue_commands.add_parser("status", help="Count queued jobs")
+    status.add_argument("queue", help="The SQLite queue file")
+    status.set_defaults(func=queue_status_command)
+
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+
+    from fa2wzl.logging import logger
+    logger.setLevel([logging.WARNING, logging.INFO,
+                     logging.DEBUG][min(args.verbose, 2)])
+
+    reporter = Reporter(json=args.json)
+
+    try:
+        args.func(args, reporter)
+    except ConfigError as e:
+        print("fa2wzl: %s" % e, file=sys.stderr)
+        sys.exit(2)
+    except AuthenticationError:
+        reporter.emit("failed", error="Authentication failed")
+        sys.exit(1)
+    except Exception as e:
+        logger.exception("Migration failed")
+        reporter.emit("failed", error=repr(e))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
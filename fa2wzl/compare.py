@@ -1,4 +1,5 @@
 import difflib
+import threading
 from itertools import groupby
 
 from fa2wzl.logging import logger
@@ -185,6 +186,121 @@ def map_submissions(fa_submissions, wzl_submissions):
     return [(m[1], m[0]) for m in mappings]
 
 
+class SubmissionMatcher(object):
+    """Maps FA submissions to Weasyl submissions as they are scanned.
+
+    Submissions can be added in batches, e.g. a listing page at a time,
+    the listings of each site at the same time. As long as every listing's
+    pages are added in order, the mapping always equals what
+    map_submissions would return for everything added so far, with the FA
+    gallery before the scraps. Each batch is only compared with the
+    submissions of the other site.
+    """
+
+    MIN_SCORE = 0.7
+    """float: Lowest similarity of titles considered the same submission"""
+
+    FA_LISTINGS = ("gallery", "scraps")
+    """tuple: FA listings in the order map_submissions gets them"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fa = {}
+        self._fa_position = {}
+        self._fa_counts = {}
+        self._wzl = {}
+        self._wzl_order = []
+        self._best = {}
+
+    def _better(self, fa_sub, ratio, best):
+        # Ties go to the FA submission listed first, as in match_objects
+        if best is None or ratio > best[1]:
+            return True
+        return ratio == best[1] and \
+            self._fa_position[fa_sub] < self._fa_position[best[0]]
+
+    def add_fa(self, fa_submissions, listing="gallery"):
+        """Add FA submissions.
+
+        Args:
+            fa_submissions: List of FA submissions, following those added
+                before from the same listing
+            listing (str, optional): One of FA_LISTINGS
+
+        Returns:
+            bool: Whether the mapping may have changed
+        """
+        changed = False
+
+        with self._lock:
+            rank = self.FA_LISTINGS.index(listing)
+
+            for fa_sub in fa_submissions:
+                type = convert_submission_type(fa_sub.type)
+                self._fa.setdefault(type, []).append(fa_sub)
+
+                count = self._fa_counts.get(listing, 0)
+                self._fa_counts[listing] = count + 1
+                self._fa_position[fa_sub] = rank, count
+
+                for wzl_sub in self._wzl.get(type, []):
+                    ratio = difflib.SequenceMatcher(
+                        a=wzl_sub.title, b=fa_sub.title).ratio()
+
+                    best = self._best.get(wzl_sub)
+                    if self._better(fa_sub, ratio, best):
+                        self._best[wzl_sub] = fa_sub, ratio
+                        changed = changed or ratio >= self.MIN_SCORE
+
+        return changed
+
+    def add_wzl(self, wzl_submissions):
+        """Add Weasyl submissions.
+
+        Args:
+            wzl_submissions: List of Weasyl submissions
+
+        Returns:
+            bool: Whether the mapping may have changed
+        """
+        changed = False
+
+        with self._lock:
+            for wzl_sub in wzl_submissions:
+                self._wzl.setdefault(wzl_sub.type, []).append(wzl_sub)
+                self._wzl_order.append(wzl_sub)
+
+                for fa_sub in self._fa.get(wzl_sub.type, []):
+                    ratio = difflib.SequenceMatcher(
+                        a=wzl_sub.title, b=fa_sub.title).ratio()
+
+                    best = self._best.get(wzl_sub)
+                    if self._better(fa_sub, ratio, best):
+                        self._best[wzl_sub] = fa_sub, ratio
+
+                best = self._best.get(wzl_sub)
+                changed = changed or (best is not None and
+                                      best[1] >= self.MIN_SCORE)
+
+        return changed
+
+    def mapping(self):
+        """Get the current mapping.
+
+        Returns:
+            list: Pairs of FA submissions and matched Weasyl submissions
+        """
+        with self._lock:
+            # Later Weasyl submissions win FA submissions matched twice
+            equivs = {}
+            for wzl_sub in self._wzl_order:
+                best = self._best.get(wzl_sub)
+                if best is not None and best[1] >= self.MIN_SCORE:
+                    equivs[best[0]] = wzl_sub
+
+        return list(equivs.items())
+
+
 def get_unmapped_folders(fa_folders, mapping):
     """Return the FA folders that have not been matched to a WZL folder.
 
@@ -226,22 +342,18 @@ def get_unmapped_submissions(fa_submissions, mapping):
     return subs - mapped
 
 
-def associate_submissions_with_folders(fa_sess, unmapped_submissions,
-                                       folder_mapping):
-    """Associate new submissions to folders on Weasyl.
+def first_folders(fa_sess, submissions):
+    """Find the folder each submission is placed by on FA.
 
     Args:
         fa_sess: The FA session
-        unmapped_submissions: List of submissions to create
-        folder_mapping: The mapping list of fa to weasyl folders
+        submissions: List of FA submissions
 
     Yields:
-        Pairs of FA submissions and the Weasyl folders to add them to
+        Pairs of FA submissions and the first FA folder they are in, for
+        submissions that are in a folder
     """
-    mapping_dict = {fa_folder: wzl_folder for fa_folder, wzl_folder in
-                    folder_mapping}
-
-    for sub in unmapped_submissions:
+    for sub in submissions:
 
         # Get the folders the submission is in
         # TODO: would be easier with a reverse relationship of submissions to
@@ -259,7 +371,26 @@ def associate_submissions_with_folders(fa_sess, unmapped_submissions,
         if len(in_folders) > 0:
             # only associate it with the first folder it's in
             # (weasyl does not support multiple folder membership)
-            yield (sub, mapping_dict[in_folders[0]])
+            yield (sub, in_folders[0])
+
+
+def associate_submissions_with_folders(fa_sess, unmapped_submissions,
+                                       folder_mapping):
+    """Associate new submissions to folders on Weasyl.
+
+    Args:
+        fa_sess: The FA session
+        unmapped_submissions: List of submissions to create
+        folder_mapping: The mapping list of fa to weasyl folders
+
+    Yields:
+        Pairs of FA submissions and the Weasyl folders to add them to
+    """
+    mapping_dict = {fa_folder: wzl_folder for fa_folder, wzl_folder in
+                    folder_mapping}
+
+    for sub, folder in first_folders(fa_sess, unmapped_submissions):
+        yield (sub, mapping_dict[folder])
 
 
 def create_unmapped_folders(fa_sess, wzl_sess, mapping, exclude=None):
@@ -9,3 +9,157 @@ USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.75.
 
 WZL_ROOT = "https://www.weasyl.com"
 """Str: The base URL for weasyl"""
+
+WZL_API_READS_PER_SECOND = 2
+"""float: Sustained rate of Weasyl API read requests"""
+
+WZL_API_READ_BURST = 5
+"""int: Weasyl API read requests allowed back to back"""
+
+WZL_API_WRITES_PER_MINUTE = 6
+"""float: Sustained rate of Weasyl folder and submission writes"""
+
+WZL_API_WRITE_BURST = 3
+"""int: Weasyl writes allowed back to back"""
+
+WZL_THROTTLE_RETRIES = 5
+"""int: How many times to retry a request Weasyl answered with 429"""
+
+WZL_RETRY_AFTER_DEFAULT = 30
+"""float: Seconds to back off on a 429 without a Retry-After header"""
+
+HTTP_CONNECT_TIMEOUT = 10
+"""float: Seconds to wait for a connection to be established"""
+
+HTTP_READ_TIMEOUT = 60
+"""float: Seconds to wait between bytes received from the server"""
+
+HTTP_MAX_RETRIES = 4
+"""int: How many times to retry a failed idempotent request"""
+
+HTTP_BACKOFF_BASE = 1
+"""float: Base delay in seconds for exponential backoff between retries"""
+
+HTTP_BACKOFF_MAX = 60
+"""float: Upper bound in seconds for a single backoff delay"""
+
+HTTP_POOL_CONNECTIONS = 4
+"""int: Number of per-host connection pools to keep"""
+
+HTTP_POOL_MAXSIZE = 8
+"""int: Maximum connections kept open per host"""
+
+CIRCUIT_BREAKER_THRESHOLD = 5
+"""int: Consecutive failures to a host before further requests are refused"""
+
+CIRCUIT_BREAKER_RESET_SECONDS = 120
+"""float: Seconds an open circuit waits before allowing a trial request"""
+
+MEDIA_CONCURRENCY = 2
+"""int: Media downloads running at the same time, apart from page requests"""
+
+MEDIA_CHUNK_SIZE = 256 * 1024
+"""int: Bytes of a media download read and written at a time"""
+
+MEDIA_MAX_RESUMES = 5
+"""int: Times a dropped media download is resumed before giving up"""
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+"""int: Bytes of an upload body sent at a time"""
+
+DOWNLOAD_BYTES_PER_SECOND = 0
+"""int: Bandwidth limit for media downloads, 0 for none"""
+
+UPLOAD_BYTES_PER_SECOND = 0
+"""int: Bandwidth limit for submission uploads, 0 for none"""
+
+BANDWIDTH_BURST_SECONDS = 1.0
+"""float: Seconds of bandwidth that can be used at once after a pause"""
+
+BANDWIDTH_IDLE_SECONDS = 1.0
+"""float: Gap between transfers not counted when measuring throughput"""
+
+ESTIMATE_BYTES_PER_SECOND = 1024 ** 2
+"""int: Transfer speed assumed by estimates where no bandwidth limit is set"""
+
+WZL_FILE_LIMITS = {
+    "visual": {"jpg": 50 * 1024 ** 2, "jpeg": 50 * 1024 ** 2,
+               "png": 50 * 1024 ** 2, "gif": 50 * 1024 ** 2},
+    "literary": {"txt": 2 * 1024 ** 2, "pdf": 10 * 1024 ** 2,
+                 "htm": 10 * 1024 ** 2, "html": 10 * 1024 ** 2},
+    "multimedia": {"mp3": 15 * 1024 ** 2, "swf": 15 * 1024 ** 2},
+}
+"""dict: Largest file Weasyl accepts, by submission type and extension"""
+
+WZL_THUMBNAIL_LIMIT = 10 * 1024 ** 2
+"""int: Largest custom thumbnail Weasyl accepts, in bytes"""
+
+WZL_THUMBNAIL_SIZE = 250
+"""int: Largest width and height of a thumbnail made for Weasyl"""
+
+JPEG_QUALITIES = (90, 80, 70)
+"""tuple: JPEG qualities tried in turn to bring an image under the limit"""
+
+IMAGE_SCALE_STEP = 0.75
+"""float: Factor an image is shrunk by while it is still over the limit"""
+
+PREPROCESS_WORKERS = 2
+"""int: Processes checking and converting files before upload"""
+
+PREPROCESS_LOOKAHEAD = 2
+"""int: Submissions downloaded and prepared ahead of the one uploading"""
+
+UPLOAD_BURST = 1
+"""int: Uploads an hourly upload rate allows at once after a pause"""
+
+UPLOAD_CONCURRENCY = 1
+"""int: Uploads of an account running at the same time"""
+
+DETAIL_PREFETCH_WORKERS = 4
+"""int: Submission pages loaded at the same time when checking a plan"""
+
+BATCH_WORKERS = 4
+"""int: Accounts a batch migrates at the same time"""
+
+JOB_LEASE_SECONDS = 300
+"""float: How long a leased job is held without a heartbeat"""
+
+JOB_HEARTBEAT_SECONDS = 60
+"""float: Interval between heartbeats extending a running job's lease"""
+
+JOB_MAX_ATTEMPTS = 5
+"""int: Times a job is tried before it is marked as failed"""
+
+JOB_RETRY_SECONDS = 30
+"""float: Base delay before a failed job is tried again, doubled each time"""
+
+JOB_POLL_SECONDS = 5
+"""float: How long a queue worker sleeps when no job is ready"""
+
+LOGIN_STORE_PASSPHRASE_ENV = "FA2WZL_LOGIN_PASSPHRASE"
+"""str: Environment variable with the passphrase of the login store"""
+
+LOGIN_STORE_KDF_ITERATIONS = 480000
+"""int: PBKDF2 iterations deriving the login store key from the
+passphrase"""
+
+THUMBNAIL_CACHE_ITEMS = 512
+"""int: Thumbnails kept in memory by the thumbnail cache"""
+
+PREVIEW_PIXMAP_ITEMS = 128
+"""int: Decoded preview images kept by the GUI"""
+
+PREVIEW_PREFETCH_ROWS = 2
+"""int: Rows above and below the selection to prefetch previews for"""
+
+GUI_TASK_WORKERS = 4
+"""int: Background tasks the GUI runs at the same time"""
+
+LOG_MAX_LINES = 5000
+"""int: Lines kept by the log panel, older lines are dropped"""
+
+LOG_FLUSH_INTERVAL = 50
+"""int: Milliseconds between log panel updates"""
+
+FILTER_INCREMENTAL_ROWS = 100
+"""int: Most changed rows refiltered one by one, more refilter every row"""
@@ -0,0 +1,157 @@
+"""Events a Worker reports as it runs.
+
+Subscribers of a worker get these objects. Its listeners get the name and
+data of each instead, like those of the sessions, so the command line,
+batches and the GUI follow one stream of progress.
+"""
+
+
+class Event(object):
+    """Something that happened during a run.
+
+    Subclasses name their details in fields; each is an attribute.
+
+    Attributes:
+        name (str): The event name given to listeners
+        fields (tuple): Names of the details
+    """
+    name = None
+    fields = ()
+
+    def __init__(self, **data):
+        unknown = set(data) - set(self.fields)
+        if unknown:
+            raise TypeError("%s has no fields %s" % (
+                type(self).__name__, ", ".join(sorted(unknown))))
+
+        for field in self.fields:
+            setattr(self, field, data.get(field))
+
+    @property
+    def data(self):
+        """dict: The details by field name"""
+        return {field: getattr(self, field) for field in self.fields}
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, " ".join(
+            "%s=%r" % item for item in sorted(self.data.items())))
+
+
+class StageStarted(Event):
+    """A stage such as map_folders or create_all started.
+
+    Attributes:
+        stage (str): The stage name
+    """
+    name = "stage_started"
+    fields = ("stage",)
+
+
+class StageFinished(Event):
+    """A stage finished, also when its uploads were cancelled.
+
+    Attributes:
+        stage (str): The stage name
+    """
+    name = "stage_finished"
+    fields = ("stage",)
+
+
+class ItemDownloaded(Event):
+    """The files of a submission are downloaded and ready to upload.
+
+    Attributes:
+        submission: The FA submission
+        index (int): Its position among the submissions to create
+        total (int): The number of submissions to create
+        file_name (str): The name it is uploaded with
+        size (int): The length of the file in bytes
+    """
+    name = "submission_downloaded"
+    fields = ("submission", "index", "total", "file_name", "size")
+
+
+class ItemStarted(Event):
+    """A submission started uploading.
+
+    Attributes:
+        submission: The FA submission
+        index (int): Its position among the submissions to create
+        total (int): The number of submissions to create
+    """
+    name = "submission_started"
+    fields = ("submission", "index", "total")
+
+
+class ItemUploaded(Event):
+    """A submission was created on Weasyl.
+
+    Attributes:
+        submission: The FA submission
+        index (int): Its position among the submissions to create
+        total (int): The number of submissions to create
+        seconds (float): How long the upload took
+    """
+    name = "submission_finished"
+    fields = ("submission", "index", "total", "seconds")
+
+
+class ItemSkipped(Event):
+    """A submission was left out.
+
+    Attributes:
+        submission: The FA submission
+        index (int): Its position among the submissions to create
+        total (int): The number of submissions to create
+        error (Exception): Why Weasyl would refuse its files, None if it
+            was excluded while running
+    """
+    name = "submission_skipped"
+    fields = ("submission", "index", "total", "error")
+
+
+class Waiting(Event):
+    """The next upload waits for the schedule.
+
+    Attributes:
+        seconds (float): How long it waits
+        index (int): The position of the submission waiting
+        total (int): The number of submissions to create
+        eta (float): Seconds until all uploads are done
+    """
+    name = "waiting"
+    fields = ("seconds", "index", "total", "eta")
+
+
+class Error(Event):
+    """Uploading failed and stopped; no StageFinished follows.
+
+    Attributes:
+        submission: The FA submission, None if the error is not of one
+        index (int): Its position among the submissions to create, or None
+        total (int): The number of submissions to create, or None
+        error (Exception): What went wrong
+    """
+    name = "error"
+    fields = ("submission", "index", "total", "error")
+
+
+class Paused(Event):
+    """The run was paused; uploads in progress still finish."""
+    name = "paused"
+
+
+class Resumed(Event):
+    """The run was resumed."""
+    name = "resumed"
+
+
+class Cancelled(Event):
+    """The uploads were cancelled before all were done.
+
+    Attributes:
+        index (int): The position of the first submission not uploaded
+        total (int): The number of submissions to create
+    """
+    name = "cancelled"
+    fields = ("index", "total")
@@ -7,4 +7,34 @@ class AuthenticationError(Exception):
 class ScraperError(Exception):
     """Raised if scraping a page fails.
     """
-    pass
\ No newline at end of file
+    pass
+
+class CircuitOpenError(Exception):
+    """Raised when a host has failed too often and requests are refused.
+    """
+    pass
+
+class MediaError(Exception):
+    """Raised when a download stays incomplete or is corrupt.
+    """
+    pass
+
+class ValidationError(Exception):
+    """Raised when a file cannot be made into something Weasyl accepts.
+    """
+    pass
+
+class LoginStoreError(Exception):
+    """Raised when the login store cannot be read and must not be written.
+    """
+    pass
+
+class ConfigError(Exception):
+    """Raised when a configuration or plan file is invalid.
+    """
+    pass
+
+class LeaseLostError(Exception):
+    """Raised when another queue worker took over a job.
+    """
+    pass
@@ -1,3 +1,5 @@
+import threading
+
 from fa2wzl.mapping import MappedAttribute
 
 
@@ -28,6 +30,10 @@ class Folder(object):
     children = MappedAttribute(_folder_loader)
     submissions = MappedAttribute(_folder_content_loader)
 
+    def __init__(self):
+        # Loads wait for each other, but not for scans of the session
+        self._load_lock = threading.RLock()
+
     def __repr__(self):
         return "<Folder #%r: %r>" % (self.id, self.title)
 
@@ -58,5 +64,9 @@ class Submission(object):
     thumbnail_url = MappedAttribute(None)
     media_url = MappedAttribute(_submission_loader)
 
+    def __init__(self):
+        # Loads wait for each other, but not for scans of the session
+        self._load_lock = threading.RLock()
+
     def __repr__(self):
         return "<Submission #%r: %r>" % (self.id, self.title)
@@ -1,15 +1,18 @@
-import datetime
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from urllib.parse import urlparse
 
 import requests
-import time
-
 from lxml import html
 
-from fa2wzl import constants, exceptions
+from fa2wzl import constants, exceptions, transport
 from fa2wzl.fa.models import Folder, Submission
 from fa2wzl.logging import logger
+from fa2wzl.mapping import loaded_value
+from fa2wzl.media import MediaFetcher
+from fa2wzl.ratelimit import BandwidthLimiter, RateLimiter
 
 
 class FASession(object):
@@ -20,23 +23,74 @@ class FASession(object):
         gallery: List of submission objects in the user's gallery
         scraps: List of submission objects in the user's scraps
         folders: List of folders in the user's gallery
+        listeners: Callables called with an event name and a dict of details
+            as folders and submissions are scanned, possibly from another
+            thread. "folders_loaded" has the root folders as folders.
+            "submissions_page" has the listing ("gallery", "scraps" or a
+            folder), the page's submissions and the total found so far.
+            "submissions_done" has the listing and its submissions.
 
     """
 
-    def __init__(self, username):
+    def __init__(self, username, page_limiter=None, metrics=None,
+                 root=constants.FA_ROOT, adapter=None, download_limiter=None,
+                 media_adapter=None):
         """Construct a new FA session.
 
         Args:
             username (str): The username to use
+            page_limiter (RateLimiter, optional): Limiter for non-static
+                pages
+            metrics (Metrics, optional): Where to record request metrics
+            root (str, optional): The URL base of the site
+            adapter (HTTPAdapter, optional): Connection pools shared with
+                other sessions
+            download_limiter (BandwidthLimiter, optional): Bandwidth limit
+                for media downloads
+            media_adapter (HTTPAdapter, optional): Connection pools for
+                media downloads shared with other sessions
         """
         self.username = username
+        self.root = root
+
+        # Scheme for the protocol-relative links on the site
+        self._scheme = urlparse(root).scheme + ":"
+
+        if page_limiter is None:
+            page_limiter = RateLimiter(
+                constants.FA_PAGE_REQUESTS_PER_MINUTE, per=60,
+                burst=constants.FA_PAGE_REQUESTS_PER_MINUTE)
 
-        self._requests = requests.Session()
+        self.page_limiter = page_limiter
+
+        self._requests = transport.Transport(metrics=metrics,
+                                             adapter=adapter)
+        self.metrics = self._requests.metrics
         self._requests.headers["User-Agent"] = constants.USER_AGENT
-        self._requests.headers["Referer"] = constants.FA_ROOT + "/"
+        self._requests.headers["Referer"] = self.root + "/"
+
+        # Media comes from static servers, through its own connections
+        if download_limiter is None:
+            download_limiter = BandwidthLimiter(
+                constants.DOWNLOAD_BYTES_PER_SECOND)
+        self.download_limiter = download_limiter
+
+        self.media = MediaFetcher(cookies=self._requests.cookies,
+                                  metrics=self.metrics,
+                                  limiter=download_limiter,
+                                  adapter=media_adapter)
+        self.media.headers["Referer"] = self.root + "/"
 
-        self._rate_limit_start = datetime.datetime.now()
-        self._rate_limit_count = 0
+        # Guards the folder and submission registries, only held briefly
+        self.lock = threading.RLock()
+
+        # Each listing scans under its own lock, so it is loaded once and
+        # other listings and details load meanwhile
+        self._folders_lock = threading.RLock()
+        self._gallery_lock = threading.RLock()
+        self._scraps_lock = threading.RLock()
+
+        self.listeners = []
 
         self._folders = {}
         self._submissions = {}
@@ -45,31 +99,30 @@ class FASession(object):
         self._scraps = None
         self._root_folders = None
 
-    def _limited_call(self, func, *args, **kwargs):
+    def _limited_call(self, endpoint, func, *args, **kwargs):
         """Rate limit calls to a function.
+
+        Args:
+            endpoint (str): Logical endpoint name, passed on to func
+            func: Callable that takes an endpoint keyword argument
         """
+        waited = self.page_limiter.acquire()
 
-        # Check seconds that have passed
-        now = datetime.datetime.now()
-        diff = (now - self._rate_limit_start).total_seconds()
+        if waited > 0:
+            logger.debug("Hit rate limit, waited %d seconds" % waited)
+            self.metrics.record_wait(endpoint, waited)
 
-        if diff >= 60:
-            # If greater than a minute, reset the rate limit
-            self._rate_limit_count = 0
-            self._rate_limit_start = now
-        else:
-            # Check if the per-minute limit has been exceeded
-            if self._rate_limit_count >= constants.FA_PAGE_REQUESTS_PER_MINUTE:
-                # Wait until next minute, then reset the count/time
-                wait_time = 60 - diff
-                logger.debug("Hit rate limit, waiting %d seconds" % wait_time)
-                time.sleep(wait_time)
-                self._rate_limit_count = 0
-                self._rate_limit_start = datetime.datetime.now()
+        return func(*args, endpoint=endpoint, **kwargs)
 
-        self._rate_limit_count += 1
+    def _notify(self, event, **data):
+        """Tell the listeners about scan progress.
 
-        return func(*args, **kwargs)
+        Args:
+            event (str): The event name
+            **data: Event details
+        """
+        for listener in list(self.listeners):
+            listener(event, data)
 
     def _html_get(self, *args, **kwargs):
         res = self._requests.get(*args, **kwargs)
@@ -89,8 +142,8 @@ class FASession(object):
         Returns:
             bytes: A JPEG image.
         """
-        res = self._limited_call(self._requests.get,
-                                 constants.FA_ROOT + "/captcha.jpg")
+        res = self._limited_call("fa.captcha", self._requests.get,
+                                 self.root + "/captcha.jpg")
         data = res.content
         return data
 
@@ -116,7 +169,7 @@ class FASession(object):
         Raises:
             AuthenticationError: If login fails
         """
-        url = constants.FA_ROOT + "/login/"
+        url = self.root + "/login/"
         data = {
             "action": "login",
             "name": self.username,
@@ -126,7 +179,8 @@ class FASession(object):
         }
 
         logger.info("Logging in as %s" % self.username)
-        self._limited_call(self._requests.post, url, data=data)
+        self._limited_call("fa.login", self._requests.post, url,
+                           data=data)
 
         if "a" not in self._requests.cookies or \
                         "b" not in self._requests.cookies:
@@ -138,15 +192,186 @@ class FASession(object):
         """Log out of the site.
         """
         logger.info("Logging out")
-        self._limited_call(self._requests.get, constants.FA_ROOT + "/logout/")
+        self._limited_call("fa.logout", self._requests.get,
+                           self.root + "/logout/")
+
+    def set_cookies(self, cookies):
+        """Use the cookies of a session logged in elsewhere, e.g. a browser.
+
+        Lets runs without a user to solve the CAPTCHA act as logged in.
+
+        Args:
+            cookies: Dict of cookie names to values, including "a" and "b"
+
+        Raises:
+            AuthenticationError: If the login cookies are missing
+        """
+        if "a" not in cookies or "b" not in cookies:
+            raise exceptions.AuthenticationError()
+
+        for name, value in cookies.items():
+            self._requests.cookies.set(name, value)
+
+    @property
+    def cookies(self):
+        """dict: The cookies of the session, e.g. to keep a login"""
+        return self._requests.cookies.get_dict()
+
+    def check_login(self):
+        """Check whether the session is logged in with one page request.
+
+        Returns:
+            bool: Whether the site still accepts the login
+
+        Raises:
+            ScraperError: If the site answers with anything else, e.g. while
+                it is down, which says nothing about the login
+        """
+        res = self._limited_call("fa.check_login", self._requests.get,
+                                 self.root + "/controls/settings/",
+                                 allow_redirects=False)
+
+        if res.status_code == 200:
+            return True
+
+        # The site redirects to the login page when logged out
+        if res.is_redirect and \
+                "/login" in urlparse(res.headers["Location"]).path:
+            return False
+
+        raise exceptions.ScraperError("Cannot check the login, FA answered "
+                                      "%d" % res.status_code)
+
+    def submission(self, id):
+        """Get a submission by its ID without scanning the gallery.
+
+        Its details are loaded when they are first read.
+
+        Args:
+            id (int): The submission ID
+
+        Returns:
+            Submission: The submission
+        """
+        with self.lock:
+            sub = self._submissions.get(id)
+            if sub is None:
+                sub = Submission()
+                sub._session = self
+                sub.id = id
+                self._submissions[id] = sub
+
+        return sub
+
+    def _folder(self, id):
+        with self.lock:
+            folder = self._folders.get(id)
+            if folder is None:
+                folder = Folder()
+                folder._session = self
+                folder.id = id
+                self._folders[id] = folder
+
+        return folder
+
+    def fetch_media(self, url):
+        """Download a file from the site's static servers.
+
+        These are not rate limited like pages. Dropped downloads are
+        resumed.
+
+        Args:
+            url (str): The URL of the media
+
+        Returns:
+            bytes: The file contents
+        """
+        return self.media.fetch(url, endpoint="fa.media")
+
+    def download_media(self, url, path, **checks):
+        """Download a file from the site's static servers to disk.
+
+        A partial file left by an earlier attempt is resumed.
+
+        Args:
+            url (str): The URL of the media
+            path (str): Where to save it
+            **checks: The expected length and sha256, as for
+                MediaFetcher.download
+
+        Returns:
+            tuple: The length and the SHA-256 hex digest of the file
+        """
+        return self.media.download(url, path, endpoint="fa.media", **checks)
+
+    def media_size(self, url):
+        """Find the length of a media file without downloading it.
+
+        Args:
+            url (str): The URL of the media
+
+        Returns:
+            int: The length in bytes, None if unknown
+        """
+        return self.media.size(url, endpoint="fa.media_size")
+
+    def prefetch(self, submissions,
+                 workers=constants.DETAIL_PREFETCH_WORKERS):
+        """Load the details of many submissions at once.
+
+        Reading a detail loads it while holding the submission's lock, one
+        submission at a time. This loads them on several threads, so the
+        page latencies overlap; the page limiter still paces the requests.
+
+        Args:
+            submissions: The submissions
+            workers (int, optional): Pages loaded at the same time
+
+        Returns:
+            dict: Submissions whose details could not be loaded, to the
+            error
+        """
+        pending = [sub for sub in submissions
+                   if loaded_value(sub, "description") is None]
+
+        def load(sub):
+            try:
+                # Like a read of the detail, so a page read meanwhile waits
+                # for this load instead of loading the page again
+                with sub._load_lock:
+                    if loaded_value(sub, "description") is None:
+                        self._load_submission(sub.id)
+            except (exceptions.ScraperError, exceptions.CircuitOpenError,
+                    requests.RequestException) as e:
+                return sub, e
+            return sub, None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return {sub: error for sub, error in executor.map(load, pending)
+                    if error is not None}
+
+    def fetch_thumbnail(self, url):
+        """Download a thumbnail without waiting behind media downloads.
+
+        Args:
+            url (str): The URL of the thumbnail
+
+        Returns:
+            bytes: The file contents
+        """
+        return self.media.get(url, endpoint="fa.thumbnail")
 
     def _load_folders(self):
+        with self._folders_lock:
+            self._read_folders()
+
+    def _read_folders(self):
         logger.debug("Loading folders")
 
-        self._root_folders = []
+        root_folders = []
 
-        url = constants.FA_ROOT + "/controls/folders/submissions/"
-        doc = self._limited_call(self._html_get, url)
+        url = self.root + "/controls/folders/submissions/"
+        doc = self._limited_call("fa.folders", self._html_get, url)
 
         # get groups
         for group_el in doc.cssselect(".group-row"):
@@ -156,18 +381,13 @@ class FASession(object):
                 id_match = re.search("group-([0-9]+)", group_el.get("class"))
                 id = int(id_match.group(1))
 
-                group = self._folders.get(id)
-                if group is None:
-                    group = Folder()
-                    group._session = self
-                    group.id = id
-                    self._folders[id] = group
+                group = self._folder(id)
 
                 group.title = title
                 group.children = []
                 group.submissions = []
 
-                self._root_folders.append(group)
+                root_folders.append(group)
 
             except (IndexError, ValueError):
                 raise exceptions.ScraperError()
@@ -184,30 +404,33 @@ class FASession(object):
                 id = int(id_match.group(1))
                 parent_id = int(group_match.group(1))
 
-                folder = self._folders.get(id)
-                if folder is None:
-                    folder = Folder()
-                    folder._session = self
-                    folder.id = id
-                    self._folders[id] = folder
+                folder = self._folder(id)
 
                 folder.title = title
                 folder.children = []
 
-                parent = self._folders.get(parent_id)
+                with self.lock:
+                    parent = self._folders.get(parent_id)
                 if parent is None:
-                    self._root_folders.append(folder)
+                    root_folders.append(folder)
                 else:
                     parent.children.append(folder)
 
             except (IndexError, ValueError):
                 raise exceptions.ScraperError()
 
-    def _scan_submission_page(self, url_format):
+        # Only publish the folders once complete
+        self._root_folders = root_folders
+
+        self._notify("folders_loaded", folders=list(root_folders))
+
+    def _scan_submission_page(self, url_format, endpoint, listing):
         """Return submissions found in pages of a base url.
 
         Args:
             url_format (str): URL, with a %d that holds the page id
+            endpoint (str): Logical endpoint name of the pages
+            listing: What is scanned, passed on to the listeners
 
         Returns:
             A list of submission objects.
@@ -219,10 +442,10 @@ class FASession(object):
             page = 1
             while True:
                 url = url_format % page
-                doc = self._limited_call(self._html_get, url)
+                doc = self._limited_call(endpoint, self._html_get, url)
                 logger.debug("Scanning submissions from %s" % url)
 
-                count = 0
+                found = []
 
                 for el in doc.cssselect(".gallery > *"):
                     if el.get("id") == "no-images":
@@ -234,12 +457,7 @@ class FASession(object):
 
                     id = int(id_str)
 
-                    submission = self._submissions.get(id)
-                    if submission is None:
-                        submission = Submission()
-                        submission._session = self
-                        submission.id = id
-                        self._submissions[id] = submission
+                    submission = self.submission(id)
 
                     submission.title = str(
                         el.cssselect("span")[0].text_content())
@@ -264,65 +482,66 @@ class FASession(object):
                     else:
                         raise exceptions.ScraperError()
 
-                    submission.thumbnail_url = "https:" + el.cssselect("img")[
-                        0].get("src")
+                    submission.thumbnail_url = self._scheme + el.cssselect(
+                        "img")[0].get("src")
 
-                    submissions.append(submission)
-                    count += 1
+                    found.append(submission)
 
-                if count == 0:
+                if not found:
                     break
 
-                logger.debug("Found %d submissions" % count)
+                submissions.extend(found)
+
+                logger.debug("Found %d submissions" % len(found))
+                self._notify("submissions_page", listing=listing,
+                             submissions=found, total=len(submissions))
 
                 page += 1
 
         except (IndexError, ValueError):
             raise exceptions.ScraperError()
 
+        self._notify("submissions_done", listing=listing,
+                     submissions=list(submissions))
+
         return submissions
 
     def _scan_gallery(self):
         logger.debug("Scanning gallery")
-        url = constants.FA_ROOT + "/gallery/%s/%%d/" % self.username
-        submissions = self._scan_submission_page(url)
+        url = self.root + "/gallery/%s/%%d/" % self.username
+        submissions = self._scan_submission_page(url, "fa.gallery_page",
+                                                 "gallery")
         return submissions
 
     def _scan_scraps(self):
         logger.debug("Scanning scraps")
-        url = constants.FA_ROOT + "/scraps/%s/%%d/" % self.username
-        submissions = self._scan_submission_page(url)
+        url = self.root + "/scraps/%s/%%d/" % self.username
+        submissions = self._scan_submission_page(url, "fa.scraps_page",
+                                                 "scraps")
         return submissions
 
     def _scan_folder(self, folder):
         logger.debug("Scanning folder %r" % folder)
 
-        url = constants.FA_ROOT + "/gallery/%s/folder/%d/-/%%d/" % (
+        url = self.root + "/gallery/%s/folder/%d/-/%%d/" % (
             self.username, folder.id)
-        submissions = self._scan_submission_page(url)
-
-        folder.submissions = []
+        submissions = self._scan_submission_page(url, "fa.folder_page",
+                                                 folder)
 
-        for sub in submissions:
-            folder.submissions.append(sub)
+        folder.submissions = submissions
 
     def _load_submission(self, id):
         # TODO: can also update containing folder info here
-        url = constants.FA_ROOT + "/view/%d/" % id
-        doc = self._limited_call(self._html_get, url)
+        url = self.root + "/view/%d/" % id
+        doc = self._limited_call("fa.view_page", self._html_get, url)
 
-        sub = self._submissions.get(id)
-        if sub is None:
-            sub = Submission()
-            sub._session = self
-            sub.id = id
-            self._submissions[id] = sub
+        sub = self.submission(id)
 
         try:
             sub.title = doc.cssselect("#submissionImg")[0].get("alt")
             for el in doc.cssselect(".submission.button a"):
                 if str(el.text_content()) == "Download":
-                    sub.media_url = "https:" + el.get("href")
+                    sub.media_url = self._scheme + el.get("href")
 
             rating_classes = doc.cssselect(".rating-box")[0].classes
             if "adult" in rating_classes:
@@ -359,20 +578,27 @@ class FASession(object):
 
     @property
     def gallery(self):
+        # Only lock when loading, so reads never wait behind a scan
         if self._gallery is None:
-            self._gallery = self._scan_gallery()
+            with self._gallery_lock:
+                if self._gallery is None:
+                    self._gallery = self._scan_gallery()
         return list(self._gallery)
 
     @property
     def scraps(self):
         if self._scraps is None:
-            self._scraps = self._scan_scraps()
+            with self._scraps_lock:
+                if self._scraps is None:
+                    self._scraps = self._scan_scraps()
 
         return list(self._scraps)
 
     @property
     def folders(self):
         if self._root_folders is None:
-            self._load_folders()
+            with self._folders_lock:
+                if self._root_folders is None:
+                    self._load_folders()
 
         return list(self._root_folders)
@@ -105,15 +105,13 @@ class Ui_MainWindow(object):
         self.groupBox_12.setObjectName("groupBox_12")
         self.verticalLayout_13 = QtWidgets.QVBoxLayout(self.groupBox_12)
         self.verticalLayout_13.setObjectName("verticalLayout_13")
-        self.faFolders = QtWidgets.QTreeWidget(self.groupBox_12)
+        self.faFolders = QtWidgets.QTreeView(self.groupBox_12)
         self.faFolders.setDragEnabled(False)
         self.faFolders.setDragDropMode(QtWidgets.QAbstractItemView.DragOnly)
         self.faFolders.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
         self.faFolders.setAutoExpandDelay(-1)
         self.faFolders.setItemsExpandable(True)
-        self.faFolders.setColumnCount(1)
         self.faFolders.setObjectName("faFolders")
-        self.faFolders.headerItem().setText(0, "Folder Name")
         self.faFolders.header().setMinimumSectionSize(150)
         self.verticalLayout_13.addWidget(self.faFolders)
         self.horizontalLayout_9.addWidget(self.groupBox_12)
@@ -130,7 +128,6 @@ class Ui_MainWindow(object):
         self.wzlFolders.setAutoExpandDelay(-1)
         self.wzlFolders.setItemsExpandable(True)
         self.wzlFolders.setObjectName("wzlFolders")
-        self.wzlFolders.headerItem().setText(0, "Folder Name")
         self.wzlFolders.header().setMinimumSectionSize(150)
         self.verticalLayout_14.addWidget(self.wzlFolders)
         self.horizontalLayout_9.addWidget(self.groupBox_13)
@@ -161,15 +158,19 @@ class Ui_MainWindow(object):
         self.label_24.setWordWrap(True)
         self.label_24.setObjectName("label_24")
         self.verticalLayout_15.addWidget(self.label_24)
+        self.submissionFilter = QtWidgets.QLineEdit(self.submissionPage_2)
+        self.submissionFilter.setClearButtonEnabled(True)
+        self.submissionFilter.setObjectName("submissionFilter")
+        self.verticalLayout_15.addWidget(self.submissionFilter)
         self.horizontalLayout_11 = QtWidgets.QHBoxLayout()
         self.horizontalLayout_11.setObjectName("horizontalLayout_11")
         self.groupBox_15 = QtWidgets.QGroupBox(self.submissionPage_2)
         self.groupBox_15.setObjectName("groupBox_15")
         self.verticalLayout_16 = QtWidgets.QVBoxLayout(self.groupBox_15)
         self.verticalLayout_16.setObjectName("verticalLayout_16")
-        self.faSubmissions = QtWidgets.QTreeWidget(self.groupBox_15)
+        self.faSubmissions = ObjectTree(self.groupBox_15)
+        self.faSubmissions.setUniformRowHeights(True)
         self.faSubmissions.setObjectName("faSubmissions")
-        self.faSubmissions.headerItem().setText(0, "Submission Title")
         self.faSubmissions.header().setMinimumSectionSize(150)
         self.verticalLayout_16.addWidget(self.faSubmissions)
         self.horizontalLayout_11.addWidget(self.groupBox_15)
@@ -182,8 +183,8 @@ class Ui_MainWindow(object):
         self.wzlSubmissions.setDragEnabled(True)
         self.wzlSubmissions.setDragDropMode(QtWidgets.QAbstractItemView.DragDrop)
         self.wzlSubmissions.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.wzlSubmissions.setUniformRowHeights(True)
         self.wzlSubmissions.setObjectName("wzlSubmissions")
-        self.wzlSubmissions.headerItem().setText(0, "Submission Title")
         self.wzlSubmissions.header().setMinimumSectionSize(150)
         self.verticalLayout_17.addWidget(self.wzlSubmissions)
         self.horizontalLayout_11.addWidget(self.groupBox_16)
@@ -249,7 +250,7 @@ class Ui_MainWindow(object):
         self.waitProgress.setTextVisible(False)
         self.waitProgress.setObjectName("waitProgress")
         self.verticalLayout_19.addWidget(self.waitProgress)
-        self.log = QtWidgets.QTextEdit(self.progressPage_2)
+        self.log = LogView(self.progressPage_2)
         self.log.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.log.setReadOnly(True)
         self.log.setObjectName("log")
@@ -286,14 +287,13 @@ class Ui_MainWindow(object):
         self.label_21.setText(_translate("MainWindow", "<html><head/><body><p>Copy your gallery folder structure from FurAffinity to Weasyl. The tree on the right shows the final structure. Items in green will be created. You may drag a new folder onto an existing folder to merge them together.</p></body></html>"))
         self.groupBox_12.setTitle(_translate("MainWindow", "FurAffinity Folders"))
         self.groupBox_13.setTitle(_translate("MainWindow", "Weasyl Folders"))
-        self.wzlFolders.headerItem().setText(1, _translate("MainWindow", "FA Folders"))
         self.btnResetFolders.setText(_translate("MainWindow", "Reset"))
         self.btnCreateFolders.setText(_translate("MainWindow", "Create Folders"))
         self.label_23.setText(_translate("MainWindow", "<html><head/><body><p><span style=\" font-size:20pt;\">Submissions</span></p></body></html>"))
         self.label_24.setText(_translate("MainWindow", "<html><head/><body><p>Copy submissions from FurAffinity to Weasyl. The final result will be displayed on the right. Items in green will be created. You may drag new submissions into different folders to change their destination. Weasyl only supports sorting submissions into at most one folder.</p></body></html>"))
+        self.submissionFilter.setPlaceholderText(_translate("MainWindow", "Filter by title, tag, rating, type or folder, e.g. fox rating:adult"))
         self.groupBox_15.setTitle(_translate("MainWindow", "FurAffinity Submissions"))
         self.groupBox_16.setTitle(_translate("MainWindow", "Weasyl Submissions"))
-        self.wzlSubmissions.headerItem().setText(1, _translate("MainWindow", "FA Submission"))
         self.groupBox_17.setTitle(_translate("MainWindow", "Submission Info"))
         self.submissionPreview.setText(_translate("MainWindow", "Preview"))
         self.groupBox_18.setTitle(_translate("MainWindow", "Upload Settings"))
@@ -303,4 +303,4 @@ class Ui_MainWindow(object):
         self.btnCreateSubmissions.setText(_translate("MainWindow", "Upload"))
         self.label_26.setText(_translate("MainWindow", "<html><head/><body><p><span style=\" font-size:20pt;\">Copying Gallery</span></p></body></html>"))
 
-from fa2wzl.widget import FolderTree, SubmissionTree
+from fa2wzl.widget import FolderTree, LogView, ObjectTree, SubmissionTree
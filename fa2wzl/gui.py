@@ -1,75 +1,200 @@
+import logging
 import sys
-import threading
-
-import time
 
+import requests
 from PyQt5 import QtWidgets, QtCore, QtGui
 
-from fa2wzl import exceptions, compare
+from fa2wzl import events, exceptions, compare, constants
+from fa2wzl.fa import models as fa_models
 from fa2wzl.fa.session import FASession
 from fa2wzl.form import Ui_MainWindow
+from fa2wzl.logging import formatter, logger
+from fa2wzl.logins import restore_login, store_from_environment
+from fa2wzl.preview import PreviewService
+from fa2wzl.schedule import UploadScheduler
+from fa2wzl.search import SearchIndex
+from fa2wzl.state import StateStore
+from fa2wzl.tasks import TaskRunner, PRIORITY_HIGH
+from fa2wzl.thumbnails import ThumbnailCache, default_cache_dir
+from fa2wzl.treemodel import FAFolderModel, WZLFolderModel, \
+    FASubmissionModel, WZLSubmissionModel, FilterProxyModel
+from fa2wzl.wzl import models as wzl_models
 from fa2wzl.wzl.session import WZLSession
+from fa2wzl.worker import Worker
 
 
 class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     # Custom signals
-    captcha_loaded = QtCore.pyqtSignal(bytes, name="captchaLoaded")
-    login_complete = QtCore.pyqtSignal(bool, str, name="loginComplete")
-    folders_loaded = QtCore.pyqtSignal(name="foldersLoaded")
-    folders_created = QtCore.pyqtSignal(name="foldersCreated")
-    submissions_loaded = QtCore.pyqtSignal(name="submissionsLoaded")
-
-    set_preview = QtCore.pyqtSignal(bytes, name="setPreview")
-
-    progress = QtCore.pyqtSignal(int, int, int, int, name="progress")
-    log_event = QtCore.pyqtSignal(str, name="logEvent")
-
-    def __init__(self):
+    worker_event = QtCore.pyqtSignal(object, name="workerEvent")
+    submissions_scanned = QtCore.pyqtSignal(str, object, list,
+                                            name="submissionsScanned")
+    folder_scanned = QtCore.pyqtSignal(str, object, list,
+                                       name="folderScanned")
+    matches_changed = QtCore.pyqtSignal(list, name="matchesChanged")
+
+    def __init__(self, fa_sess=None, wzl_sess=None):
+        """Create the main window.
+
+        Args:
+            fa_sess (FASession, optional): A logged in FA session. Given
+                with wzl_sess, the login page is skipped.
+            wzl_sess (WZLSession, optional): A Weasyl session
+        """
         super(MainWindow, self).__init__()
         self.setupUi(self)
 
-        # Session stuff
-        self.lock = threading.Lock()
-        self.thread = None
-        self.run = True
-        self.fa_sess = FASession("")
-        self.wzl_sess = None
+        # Show the fa2wzl log in the progress page
+        self.log.buffer.setFormatter(formatter)
+        self.log.buffer.setLevel(logging.INFO)
+        logger.addHandler(self.log.buffer)
 
-        self.folder_mapping = {}
-        self.submission_mapping = {}
-        self.submission_folders = {}
-        self.excluded_submissions = []
+        # Session stuff
+        self.tasks = TaskRunner(parent=self)
+        self.fa_sess = fa_sess if fa_sess is not None else FASession("")
+        self.fa_sess.listeners.append(self._scan_listener("FurAffinity"))
+        self.wzl_sess = wzl_sess
+        if wzl_sess is not None:
+            wzl_sess.listeners.append(self._scan_listener("Weasyl"))
+
+        # Sessions that were passed in are logged out by their owner
+        self._owns_fa_sess = fa_sess is None
+
+        # Logins are kept if a passphrase for the store is set, and never
+        # logged out, which would make the site forget them
+        self.login_store = store_from_environment()
+        self._keep_login = False
+
+        # Shared with background tasks; only ever replaced, never mutated
+        self.state = StateStore()
+
+        # Submissions scanned by source and listing, the sources still
+        # loading, and the progressive matching and placement while loading
+        self._scan_counts = {}
+        self._loading = set()
+        self._matcher = compare.SubmissionMatcher()
+        self._placed = set()
+        self._user_moves = {}
+
+        self.preview_service = PreviewService(
+            ThumbnailCache(default_cache_dir()), self.tasks, parent=self)
+
+        # The worker uploading, cancelled when the window closes
+        self._worker = None
+        self._wait_timer = QtCore.QTimer(self)
+        self._wait_timer.setInterval(1000)
+        self._wait_timer.timeout.connect(self._tick_wait)
+
+        self.btnPause = QtWidgets.QPushButton("Pause", self.progressPage_2)
+        self.btnStop = QtWidgets.QPushButton("Stop", self.progressPage_2)
+        upload_controls = QtWidgets.QHBoxLayout()
+        upload_controls.addStretch()
+        upload_controls.addWidget(self.btnPause)
+        upload_controls.addWidget(self.btnStop)
+        self.verticalLayout_19.insertLayout(
+            self.verticalLayout_19.indexOf(self.log), upload_controls)
+
+        # Kept up to date as submissions are scanned and moved, so the
+        # trees can be filtered as the user types
+        self.fa_search = SearchIndex()
+        self.wzl_search = SearchIndex()
+
+        # Models
+        self.fa_folder_model = FAFolderModel(self)
+        self.wzl_folder_model = WZLFolderModel(self)
+        self.fa_submission_model = FASubmissionModel(self)
+        self.wzl_submission_model = WZLSubmissionModel(self)
+
+        self.faFolders.setModel(self.fa_folder_model)
+        self.wzlFolders.setModel(self.wzl_folder_model)
+        self.fa_submission_filter = FilterProxyModel(self)
+        self.fa_submission_filter.setSourceModel(self.fa_submission_model)
+        self.wzl_submission_filter = FilterProxyModel(self)
+        self.wzl_submission_filter.setSourceModel(self.wzl_submission_model)
+
+        self.faSubmissions.setModel(self.fa_submission_filter)
+        self.wzlSubmissions.setModel(self.wzl_submission_filter)
 
         # Signals/slots
-        self.captcha_loaded.connect(self._set_captcha_img)
         self.btnLogin.clicked.connect(self._login)
-        self.login_complete.connect(self._login_complete)
-        self.folders_loaded.connect(self._folders_loaded)
-        self.wzlFolders.folder_dropped.connect(self._folder_dropped)
+        self.wzl_folder_model.folder_dropped.connect(self._folder_dropped)
         self.btnResetFolders.clicked.connect(self._reload_folders)
         self.btnCreateFolders.clicked.connect(self._create_folders)
-        self.folders_created.connect(self._folders_created)
-        self.submissions_loaded.connect(self._submissions_loaded)
-        self.wzlSubmissions.submissions_dropped.connect(self._submission_move)
+        self.wzl_submission_model.submissions_dropped.connect(
+            self._submission_move)
         self.wzlSubmissions.customContextMenuRequested.connect(
             self._submission_context_menu)
         self.wzlSubmissions.selectionModel().selectionChanged.connect(
             self._get_preview)
-        self.set_preview.connect(self._set_preview)
+        self.preview_service.preview_ready.connect(self._set_preview)
+        self.submissionFilter.textChanged.connect(self._filter_submissions)
         self.btnResetSubmissions.clicked.connect(self._reset_submissions)
         self.btnCreateSubmissions.clicked.connect(self._upload)
-        self.progress.connect(self._progress)
-        self.log_event.connect(self._log)
+        self.btnPause.clicked.connect(self._toggle_pause)
+        self.btnStop.clicked.connect(self._stop_upload)
+        self.worker_event.connect(self._worker_event)
+        self.submissions_scanned.connect(self._submissions_scanned)
+        self.folder_scanned.connect(self._folder_scanned)
+        self.matches_changed.connect(self._matches_changed)
+
+        if fa_sess is not None and wzl_sess is not None:
+            self._login_complete(False, "")
+        elif self.login_store is not None:
+            self._restore_login()
+        else:
+            self._load_captcha()
 
-        self._load_captcha()
+    def _restore_login(self):
+        def work():
+            login = self.login_store.load()
+            if login is None or not login.get("wzl_api_key"):
+                return None
+
+            try:
+                restored = restore_login(self.fa_sess, login)
+            except (exceptions.ScraperError, exceptions.CircuitOpenError,
+                    requests.RequestException) as e:
+                # The login is kept for when FA answers again
+                logger.warning("Cannot check the stored login: %s" % e)
+                return None
+
+            if not restored:
+                logger.info("The stored login of %s has expired" %
+                            login["username"])
+                self.login_store.remove(login["username"])
+                return None
+
+            try:
+                wzl_sess = WZLSession(login["wzl_api_key"])
+                wzl_sess.username
+            except exceptions.AuthenticationError:
+                return None
+
+            return login, wzl_sess
+
+        def done(result):
+            if result is None:
+                self._load_captcha()
+                return
+
+            login, wzl_sess = result
+            self.faUsername.setText(login["username"])
+            self.wzlApiKey.setText(login["wzl_api_key"])
+            self.wzl_sess = wzl_sess
+            self.wzl_sess.listeners.append(self._scan_listener("Weasyl"))
+            self._keep_login = True
+            self._login_complete(False, "")
+
+        self.statusbar.showMessage("Logging in")
+        self._set_login_inputs_enabled(False)
+        self.tasks.submit(work, key="login", priority=PRIORITY_HIGH,
+                          on_done=done)
 
     def _load_captcha(self):
         def work():
-            with self.lock:
-                captcha = self.fa_sess.get_captcha()
-            self.captcha_loaded.emit(captcha)
+            return self.fa_sess.get_captcha()
 
-        threading.Thread(target=work).start()
+        self.tasks.submit(work, key="captcha", priority=PRIORITY_HIGH,
+                          on_done=self._set_captcha_img)
 
     def _set_captcha_img(self, data):
         bytes = QtCore.QByteArray(data)
@@ -80,28 +205,38 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def _login(self):
         self._set_login_inputs_enabled(False)
 
-        def work():
-
-            fa_user = self.faUsername.text()
-            fa_pwd = self.faPassword.text()
-            fa_captcha = self.faCaptcha.text()
-            wzl_key = self.wzlApiKey.text()
+        # Widgets may only be read on the UI thread
+        fa_user = self.faUsername.text()
+        fa_pwd = self.faPassword.text()
+        fa_captcha = self.faCaptcha.text()
+        wzl_key = self.wzlApiKey.text()
 
+        def work():
             fa_error = False
             wzl_error = False
 
-            with self.lock:
-                try:
-                    self.fa_sess.username = fa_user
-                    self.fa_sess.login(fa_pwd, fa_captcha)
-                except exceptions.AuthenticationError:
-                    fa_error = True
-
+            try:
+                self.fa_sess.username = fa_user
+                self.fa_sess.login(fa_pwd, fa_captcha)
+            except exceptions.AuthenticationError:
+                fa_error = True
+
+            try:
+                self.wzl_sess = WZLSession(wzl_key)
+                self.wzl_sess.listeners.append(
+                    self._scan_listener("Weasyl"))
+                wzl_user = self.wzl_sess.username
+            except exceptions.AuthenticationError:
+                wzl_error = True
+
+            if not fa_error and not wzl_error and \
+                    self.login_store is not None:
                 try:
-                    self.wzl_sess = WZLSession(wzl_key)
-                    wzl_user = self.wzl_sess.username
-                except exceptions.AuthenticationError:
-                    wzl_error = True
+                    self.login_store.save(fa_user, self.fa_sess.cookies,
+                                          wzl_key)
+                    self._keep_login = True
+                except exceptions.LoginStoreError as e:
+                    logger.warning("Not keeping the login: %s" % e)
 
             msg = ""
 
@@ -110,10 +245,11 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             if wzl_error:
                 msg += "Weasyl API key incorrect.\n"
 
-            self.login_complete.emit(fa_error or wzl_error, msg)
+            return fa_error or wzl_error, msg
 
         self.statusbar.showMessage("Logging in")
-        threading.Thread(target=work).start()
+        self.tasks.submit(work, key="login", priority=PRIORITY_HIGH,
+                          on_done=lambda r: self._login_complete(*r))
 
     def _login_complete(self, error, msg):
         self._set_login_inputs_enabled(True)
@@ -135,17 +271,14 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
     def _load_folders(self):
         def work():
-            with self.lock:
-                mapping_list = compare.map_folders(self.fa_sess.folders,
-                                                   self.wzl_sess.folders)
-
-                self.folder_mapping = {fa_folder: wzl_folder for
-                                       fa_folder, wzl_folder in mapping_list}
+            mapping_list = compare.map_folders(self.fa_sess.folders,
+                                               self.wzl_sess.folders)
 
-            self.folders_loaded.emit()
+            self.state.replace(folder_mapping=mapping_list)
 
         self.statusbar.showMessage("Loading folders")
-        threading.Thread(target=work).start()
+        self.tasks.submit(work, key="folders",
+                          on_done=lambda r: self._folders_loaded())
 
     def _folders_loaded(self):
         self.statusbar.clearMessage()
@@ -159,91 +292,12 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self._load_folders()
 
     def _render_folders(self):
+        fa_folders = self.fa_sess.folders
+        wzl_folders = self.wzl_sess.folders
 
-        fa_items = []
-        wzl_items = []
-        folder_item_mapping = {}
-
-        with self.lock:
-            # Populate each site's folders
-            for folder in self.fa_sess.folders:
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, folder)
-                item.setText(0, folder.title)
-                item.setFlags(
-                    item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-                fa_items.append(item)
-
-                for subfolder in folder.children:
-                    subitem = QtWidgets.QTreeWidgetItem()
-                    subitem.setData(0, QtCore.Qt.UserRole, subfolder)
-                    subitem.setText(0, subfolder.title)
-                    subitem.setFlags(
-                        item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-                    item.addChild(subitem)
-
-            for folder in self.wzl_sess.folders:
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, folder)
-                mappings = []
-
-                for fa_folder, wzl_folder in self.folder_mapping.items():
-                    if wzl_folder is folder:
-                        mappings.append(fa_folder.title)
-
-                item.setText(0, folder.title)
-                item.setText(1, ", ".join(mappings))
-                item.setFlags(
-                    item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-                folder_item_mapping[folder] = item
-                wzl_items.append(item)
-
-                for subfolder in folder.children:
-                    subitem = QtWidgets.QTreeWidgetItem()
-                    subitem.setData(0, QtCore.Qt.UserRole, subfolder)
-
-                    mappings = []
-
-                    for fa_folder, wzl_folder in self.folder_mapping.items():
-                        if wzl_folder is subfolder:
-                            mappings.append(fa_folder.title)
-
-                    subitem.setText(0, subfolder.title)
-                    subitem.setText(1, ", ".join(mappings))
-                    subitem.setFlags(
-                        item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-
-                    item.addChild(subitem)
-
-            # Populate unmapped folders
-            for folder in self.fa_sess.folders:
-                if folder in self.folder_mapping.keys():
-                    item = folder_item_mapping[self.folder_mapping[folder]]
-                else:
-                    item = QtWidgets.QTreeWidgetItem()
-                    item.setData(0, QtCore.Qt.UserRole, folder)
-                    item.setText(0, folder.title + "*")
-                    item.setForeground(0, QtGui.QColor(0, 150, 0))
-                    folder_item_mapping[folder] = item
-                    wzl_items.append(item)
-
-                for subfolder in folder.children:
-                    if subfolder in self.folder_mapping.keys():
-                        continue
-
-                    subitem = QtWidgets.QTreeWidgetItem()
-                    subitem.setData(0, QtCore.Qt.UserRole, subfolder)
-                    subitem.setText(0, subfolder.title + "*")
-                    subitem.setForeground(0, QtGui.QColor(0, 150, 0))
-                    item.addChild(subitem)
-
-        self.faFolders.clear()
-        for item in fa_items:
-            self.faFolders.invisibleRootItem().addChild(item)
-
-        self.wzlFolders.clear()
-        for item in wzl_items:
-            self.wzlFolders.invisibleRootItem().addChild(item)
+        self.fa_folder_model.populate(fa_folders)
+        self.wzl_folder_model.populate(fa_folders, wzl_folders,
+                                       self.state.snapshot.folder_mapping)
 
         self.faFolders.expandAll()
         self.wzlFolders.expandAll()
@@ -253,304 +307,359 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def _folder_dropped(self, src_id, wzl_folder):
         folders = {}
 
-        with self.lock:
-            for folder in self.fa_sess.folders:
-                folders[folder.id] = folder
-                for subfolder in folder.children:
-                    folders[subfolder.id] = subfolder
+        for folder in self.fa_sess.folders:
+            folders[folder.id] = folder
+            for subfolder in folder.children:
+                folders[subfolder.id] = subfolder
 
-            src_folder = folders[src_id]
+        src_folder = folders[src_id]
 
-            self.folder_mapping[src_folder] = wzl_folder
+        self.state.update(lambda state: state.replace(folder_mapping={
+            **state.folder_mapping, src_folder: wzl_folder}))
 
-        self._render_folders()
+        self.wzl_folder_model.map_folder(src_folder, wzl_folder)
+        self.wzlFolders.resizeColumnToContents(1)
 
     def _create_folders(self):
         def work():
-            with self.lock:
-                mapping = [(fa_folder, wzl_folder) for fa_folder, wzl_folder in
-                           self.folder_mapping.items()]
+            mapping = list(self.state.snapshot.folder_mapping.items())
 
-                compare.create_unmapped_folders(
-                    self.fa_sess,
-                    self.wzl_sess,
-                    mapping,
-                )
-
-            self.folders_created.emit()
+            compare.create_unmapped_folders(
+                self.fa_sess,
+                self.wzl_sess,
+                mapping,
+            )
 
         self.btnResetFolders.setEnabled(False)
         self.btnCreateFolders.setEnabled(False)
 
         self.statusbar.showMessage("Creating folders")
-        threading.Thread(target=work).start()
+        self.tasks.submit(work, key="create_folders",
+                          on_done=lambda r: self._folders_created())
 
     def _folders_created(self):
         self.statusbar.clearMessage()
         self.stackedWidget.setCurrentIndex(2)
         self._load_submissions()
 
-    def _load_submissions(self):
-        def work():
-            with self.lock:
-                fa_gallery = self.fa_sess.gallery
-                fa_scraps = self.fa_sess.scraps
-                wzl_gallery = self.wzl_sess.gallery
-
-                mapping = compare.map_submissions(fa_gallery + fa_scraps,
-                                                  wzl_gallery)
+    def _scan_listener(self, source):
+        # Called on the thread doing the scan, so matching happens there too
+        def listener(event, data):
+            listing = data.get("listing")
 
-                self.submission_mapping = {f: w for f, w in mapping}
+            if event == "submissions_page" and isinstance(listing, str):
+                matcher = self._matcher
+                if source == "FurAffinity":
+                    changed = matcher.add_fa(data["submissions"],
+                                             listing)
+                else:
+                    changed = matcher.add_wzl(data["submissions"])
+
+                # Sent first, so new rows are not shown before their match
+                if changed:
+                    self.matches_changed.emit(matcher.mapping())
+
+                self.submissions_scanned.emit(source, listing,
+                                              data["submissions"])
+            elif event == "submissions_done" and \
+                    not isinstance(listing, str):
+                self.folder_scanned.emit(source, listing,
+                                         data["submissions"])
+
+        return listener
+
+    def _show_scan_progress(self):
+        parts = []
+        for name in ("FurAffinity", "Weasyl"):
+            submissions = sum(c for (s, l), c in self._scan_counts.items()
+                              if s == name and l != "folders")
+            folders = self._scan_counts.get((name, "folders"), 0)
+            parts.append("%s: %d submissions, %d folders" % (
+                name, submissions, folders))
+
+        self.statusbar.showMessage(
+            "Loading submissions - " + "; ".join(parts))
+
+    def _submissions_scanned(self, source, listing, submissions):
+        if not self._loading:
+            return
 
-            self.submissions_loaded.emit()
+        key = (source, listing)
+        self._scan_counts[key] = self._scan_counts.get(key, 0) + \
+            len(submissions)
+        self._show_scan_progress()
 
-        self.statusbar.showMessage("Loading submissions")
-        threading.Thread(target=work).start()
+        if source == "FurAffinity":
+            self.fa_submission_model.add_submissions(listing, submissions)
+            self.wzl_submission_model.add_new(
+                submissions, self.state.snapshot.submission_folders)
+            self._index_submissions(fa_submissions=submissions)
+        elif listing == "gallery":
+            self.wzl_submission_model.add_existing(None, submissions)
+            self._index_submissions(wzl_submissions=submissions)
 
-    def _submissions_loaded(self):
-        with self.lock:
-            # Remap folders
-            folder_mapping = compare.map_folders(self.fa_sess.folders,
-                                                 self.wzl_sess.folders)
-            self.folder_mapping = {f: w for f, w in folder_mapping}
+        self._refilter()
 
-            unmapped_subs = compare.get_unmapped_submissions(
-                self.fa_sess.gallery + self.fa_sess.scraps,
-                [(f, w) for f, w in self.submission_mapping.items()])
-
-            assoc = compare.associate_submissions_with_folders(
-                self.fa_sess, unmapped_subs,
-                [(f, w) for f, w in self.folder_mapping.items()])
+    def _folder_scanned(self, source, folder, submissions):
+        if not self._loading:
+            return
 
-            self.submission_folders = {s: f for s, f in assoc}
+        key = (source, "folders")
+        self._scan_counts[key] = self._scan_counts.get(key, 0) + 1
+        self._show_scan_progress()
 
-        self.statusbar.clearMessage()
-        self._render_submissions()
-        self.btnResetSubmissions.setEnabled(True)
-        self.btnCreateSubmissions.setEnabled(True)
+        if source == "FurAffinity":
+            self.fa_submission_model.add_submissions(folder, submissions)
+            self._associate_folder(folder, submissions)
+            self._index_submissions(fa_submissions=submissions)
+        else:
+            self.wzl_submission_model.add_existing(folder, submissions)
+            self._index_submissions(wzl_submissions=submissions)
 
-    def _render_submissions(self):
-        wzl_items = []
+        self._refilter()
 
-        folder_items = {}
+    def _associate_folder(self, fa_folder, submissions):
+        # Like compare.associate_submissions_with_folders, a submission goes
+        # to the first folder it is found in. Folders are scanned in the
+        # same order, and submissions the user moved stay where they are.
+        placed = [s for s in submissions if s not in self._placed]
+        self._placed.update(placed)
 
-        with self.lock:
-            # Create folders
-            item = QtWidgets.QTreeWidgetItem()
-            item.setData(0, QtCore.Qt.UserRole, None)
-            item.setText(0, "Gallery")
-            fa_gallery_folder = item
+        wzl_folder = self.state.snapshot.folder_mapping.get(fa_folder)
+        if wzl_folder is None or not placed:
+            return
 
-            item = QtWidgets.QTreeWidgetItem()
-            item.setData(0, QtCore.Qt.UserRole, None)
-            item.setText(0, "Scraps")
-            fa_scraps_folder = item
+        self.state.update(lambda state: state.replace(submission_folders={
+            **{s: wzl_folder for s in placed}, **state.submission_folders}))
 
-            # FA Folders
-            for folder in self.fa_sess.folders:
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, folder)
-                item.setText(0, folder.title)
-                folder_items[folder] = item
-                fa_gallery_folder.addChild(item)
+        for sub in placed:
+            self.wzl_submission_model.move_submission(sub, wzl_folder)
 
-                parent_item = item
+    def _matches_changed(self, mapping):
+        if not self._loading:
+            return
 
-                for submission in folder.submissions:
-                    item = QtWidgets.QTreeWidgetItem()
-                    item.setData(0, QtCore.Qt.UserRole, submission)
-                    item.setText(0, submission.title)
-                    parent_item.addChild(item)
+        self.state.replace(submission_mapping=mapping)
+        self.wzl_submission_model.update_mapping(dict(mapping))
+
+    def _index_submissions(self, fa_submissions=(), wzl_submissions=()):
+        # Indexed with the folders they are shown in, which also lets
+        # folders be found by name
+        for sub in fa_submissions:
+            self.fa_search.add(sub, self.fa_submission_model.folders_of(sub))
+            self.wzl_search.add(sub,
+                                self.wzl_submission_model.folders_of(sub))
+
+        for sub in wzl_submissions:
+            self.wzl_search.add(sub,
+                                self.wzl_submission_model.folders_of(sub))
+
+    def _filter_submissions(self, query, expand=True):
+        for view, proxy, index in (
+                (self.faSubmissions, self.fa_submission_filter,
+                 self.fa_search),
+                (self.wzlSubmissions, self.wzl_submission_filter,
+                 self.wzl_search)):
+            matches = index.search(query)
+            if matches is None:
+                proxy.set_matches(None)
+                continue
+
+            folders = index.folders_of(matches)
+            proxy.set_matches(matches, folders)
+
+            # Open the folders with matches, so they can be seen at once
+            if expand:
+                view.expand_objects(folders)
+
+    def _refilter(self):
+        # Rows added since the filter was applied are hidden until then
+        query = self.submissionFilter.text()
+        if query.strip():
+            self._filter_submissions(query, expand=False)
 
+    def _load_submissions(self):
+        def load_fa():
+            # Folders may have been created, remap them before scanning so
+            # new submissions can be placed as their folders are scanned
+            folder_mapping = dict(compare.map_folders(self.fa_sess.folders,
+                                                      self.wzl_sess.folders))
+            self.state.update(lambda state: state.replace(folder_mapping={
+                **folder_mapping, **state.folder_mapping}))
+
+            self.fa_sess.gallery
+            self.fa_sess.scraps
+
+            # Folder contents are needed to place new submissions in folders
+            for folder in self.fa_sess.folders:
+                folder.submissions
                 for subfolder in folder.children:
-                    item = QtWidgets.QTreeWidgetItem()
-                    item.setData(0, QtCore.Qt.UserRole, subfolder)
-                    item.setText(0, subfolder.title)
-                    folder_items[subfolder] = item
-                    parent_item.addChild(item)
-
-                    subfolder_item = item
-
-                    for submission in subfolder.submissions:
-                        item = QtWidgets.QTreeWidgetItem()
-                        item.setData(0, QtCore.Qt.UserRole, submission)
-                        item.setText(0, submission.title)
-                        subfolder_item.addChild(item)
-
-            # FA gallery
-            for submission in self.fa_sess.gallery:
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, submission)
-                item.setText(0, submission.title)
-                fa_gallery_folder.addChild(item)
-
-            # FA Scraps
-            for submission in self.fa_sess.scraps:
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, submission)
-                item.setText(0, submission.title)
-                fa_scraps_folder.addChild(item)
-
-            wzl_subs_in_root = set(self.wzl_sess.gallery)
-
-            # WZL Folder
-            for folder in self.wzl_sess.folders:
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, folder)
-                item.setText(0, folder.title)
-                item.setFlags(
-                    item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-                folder_items[folder] = item
-                wzl_items.append(item)
-
-                parent_item = item
-
-                for submission in folder.submissions:
-                    item = QtWidgets.QTreeWidgetItem()
-                    item.setData(0, QtCore.Qt.UserRole, submission)
-
-                    item.setText(0, submission.title)
-
-                    for f_s, w_s in self.submission_mapping.items():
-                        if w_s is submission:
-                            item.setText(1, f_s.title)
-
-                    item.setFlags(
-                        item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-
-                    wzl_subs_in_root.remove(submission)
-
-                    parent_item.addChild(item)
+                    subfolder.submissions
 
+        def load_wzl():
+            # Folders first, so gallery submissions can be shown in the
+            # right place as soon as they are scanned
+            for folder in self.wzl_sess.folders:
+                folder.submissions
                 for subfolder in folder.children:
-                    item = QtWidgets.QTreeWidgetItem()
-                    item.setData(0, QtCore.Qt.UserRole, subfolder)
-                    item.setText(0, subfolder.title)
-                    item.setFlags(
-                        item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-                    folder_items[subfolder] = item
-                    parent_item.addChild(item)
-
-                    subfolder_item = item
-
-                    for submission in subfolder.submissions:
-                        item = QtWidgets.QTreeWidgetItem()
-                        item.setData(0, QtCore.Qt.UserRole, submission)
-
-                        item.setText(0, submission.title)
-
-                        for f_s, w_s in self.submision_mapping.items():
-                            if w_s is submission:
-                                item.setText(1, f_s.title)
-
-                        item.setFlags(
-                            item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-
-                        wzl_subs_in_root.remove(submission)
-
-                        subfolder_item.addChild(item)
-
-            # WZL root
-            for submission in wzl_subs_in_root:
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, submission)
-
-                item.setText(0, submission.title)
-
-                for f_s, w_s in self.submission_mapping.items():
-                    if w_s is submission:
-                        item.setText(1, f_s.title)
-
-                item.setFlags(
-                    item.flags() & ~ QtCore.Qt.ItemIsSelectable & ~ QtCore.Qt.ItemIsDragEnabled)
-
-                wzl_items.append(item)
-
-            # Now add unmapped submissions
-
-            unmapped_subs = compare.get_unmapped_submissions(
-                self.fa_sess.gallery + self.fa_sess.scraps,
-                [(f, w) for f, w in self.submission_mapping.items()])
-
-            wzl_subs_in_root = set(unmapped_subs)
-
-            for submission, folder in self.submission_folders.items():
-                if submission.id in self.excluded_submissions:
-                    continue
-
-                folder_item = folder_items[folder]
+                    subfolder.submissions
+
+            self.wzl_sess.gallery
+
+        def loaded(source):
+            self._loading.discard(source)
+            if not self._loading:
+                self.tasks.submit(self._match_submissions,
+                                  key="match_submissions",
+                                  on_done=self._submissions_loaded,
+                                  on_error=self._submissions_failed)
+
+        self._scan_counts = {}
+        self._loading = {"fa", "wzl"}
+        self._matcher = compare.SubmissionMatcher()
+        self._placed = set()
+        self._user_moves = {}
+        self.fa_search = SearchIndex()
+        self.wzl_search = SearchIndex()
+
+        # Show the folders now; scanned submissions are added as they arrive
+        state = self.state.snapshot
+        self.fa_submission_model.populate(self.fa_sess.folders, [], [])
+        self.wzl_submission_model.populate([], self.wzl_sess.folders, [], {},
+                                           {}, state.excluded_submissions)
+        self.faSubmissions.expandToDepth(0)
+        self.wzlSubmissions.expandToDepth(0)
+
+        # The sites are loaded side by side; Weasyl is not rate limited and
+        # should not wait behind FurAffinity
+        self.statusbar.showMessage("Loading submissions")
+        self.tasks.submit(load_fa, key="load_fa_submissions",
+                          on_done=lambda r: loaded("fa"),
+                          on_error=self._submissions_failed)
+        self.tasks.submit(load_wzl, key="load_wzl_submissions",
+                          on_done=lambda r: loaded("wzl"),
+                          on_error=self._submissions_failed)
+
+    def _match_submissions(self):
+        # Runs in the background once both sites are loaded. Also covers
+        # the case where everything was cached and nothing was scanned.
+        fa_submissions = self.fa_sess.gallery + self.fa_sess.scraps
+
+        submission_mapping = compare.map_submissions(fa_submissions,
+                                                     self.wzl_sess.gallery)
+
+        unmapped_subs = compare.get_unmapped_submissions(fa_submissions,
+                                                         submission_mapping)
+
+        assoc = compare.associate_submissions_with_folders(
+            self.fa_sess, unmapped_subs,
+            list(self.state.snapshot.folder_mapping.items()))
+
+        return submission_mapping, list(assoc)
+
+    def _submissions_failed(self, error):
+        logger.error("Loading submissions failed: %r" % error)
+        self._loading = set()
+        self.statusbar.showMessage("Loading submissions failed")
+        self.btnResetSubmissions.setEnabled(True)
 
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, submission)
-                item.setText(0, submission.title + "*")
-                item.setForeground(0, QtGui.QColor(0, 150, 0))
-                folder_item.addChild(item)
+    def _submissions_loaded(self, result):
+        submission_mapping, assoc = result
 
-                wzl_subs_in_root.remove(submission)
+        # Moves made while scanning win over the automatic placement
+        submission_folders = dict(assoc)
+        for sub, folder in self._user_moves.items():
+            if folder is None:
+                submission_folders.pop(sub, None)
+            else:
+                submission_folders[sub] = folder
 
-            for submission in wzl_subs_in_root:
-                if submission.id in self.excluded_submissions:
-                    continue
+        self.state.replace(submission_mapping=submission_mapping,
+                           submission_folders=submission_folders)
 
-                item = QtWidgets.QTreeWidgetItem()
-                item.setData(0, QtCore.Qt.UserRole, submission)
-                item.setText(0, submission.title + "*")
-                item.setForeground(0, QtGui.QColor(0, 150, 0))
+        self.statusbar.clearMessage()
+        self._render_submissions()
+        self.btnResetSubmissions.setEnabled(True)
+        self.btnCreateSubmissions.setEnabled(True)
 
-                wzl_items.append(item)
+    def _render_submissions(self):
+        state = self.state.snapshot
+        fa_gallery = self.fa_sess.gallery
+        fa_scraps = self.fa_sess.scraps
+
+        fa_expanded = self.faSubmissions.expanded_objects()
+        wzl_expanded = self.wzlSubmissions.expanded_objects()
+
+        self.fa_submission_model.populate(self.fa_sess.folders,
+                                          fa_gallery, fa_scraps)
+        self.wzl_submission_model.populate(
+            fa_gallery + fa_scraps,
+            self.wzl_sess.folders,
+            self.wzl_sess.gallery,
+            state.submission_mapping,
+            state.submission_folders,
+            state.excluded_submissions,
+        )
 
-        self.faSubmissions.clear()
-        self.faSubmissions.invisibleRootItem().addChild(fa_gallery_folder)
-        self.faSubmissions.invisibleRootItem().addChild(fa_scraps_folder)
+        # Only the top level is expanded, deeper folders are populated when
+        # they are opened
+        self.faSubmissions.expandToDepth(0)
+        self.wzlSubmissions.expandToDepth(0)
 
-        self.wzlSubmissions.clear()
-        for item in wzl_items:
-            self.wzlSubmissions.invisibleRootItem().addChild(item)
+        # Mostly indexed while scanning already, this adds what was cached
+        self._index_submissions(fa_submissions=fa_gallery + fa_scraps,
+                                wzl_submissions=self.wzl_sess.gallery)
+        self._refilter()
 
-        self.faSubmissions.expandAll()
-        self.wzlSubmissions.expandAll()
-        self.wzlSubmissions.resizeColumnToContents(0)
-        self.wzlSubmissions.resizeColumnToContents(1)
+        # Keep folders opened while scanning open
+        self.faSubmissions.expand_objects(fa_expanded)
+        self.wzlSubmissions.expand_objects(wzl_expanded)
 
     def _submission_move(self, id_list, target_folder):
 
         target_folder = target_folder[0]  # hacky
 
-        with self.lock:
-            subs = {}
+        # The sessions may still be scanning, so look in the model instead
+        subs = {sub.id: sub for sub in
+                self.wzl_submission_model.new_submissions()}
 
-            for sub in self.fa_sess.gallery + self.fa_sess.scraps:
-                subs[sub.id] = sub
+        moved = [subs[id_] for id_ in id_list if id_ in subs]
 
-            for id_ in id_list:
-                sub = subs[id_]
+        def move(state):
+            submission_folders = dict(state.submission_folders)
 
+            for sub in moved:
                 if target_folder is None:
-                    if sub in self.submission_folders:
-                        del self.submission_folders[sub]
+                    submission_folders.pop(sub, None)
                 else:
-                    self.submission_folders[sub] = target_folder
+                    submission_folders[sub] = target_folder
 
-        self._render_submissions()
+            return state.replace(submission_folders=submission_folders)
+
+        self.state.update(move)
+
+        # Submissions not uploaded yet go where they were moved to
+        if self._worker is not None:
+            self._worker.move(moved, target_folder)
+
+        for sub in moved:
+            self._placed.add(sub)
+            self._user_moves[sub] = target_folder
+            self.wzl_submission_model.move_submission(sub, target_folder)
+
+        self._index_submissions(fa_submissions=moved)
+        self._refilter()
 
     def _submission_context_menu(self, point):
 
-        if len(self.wzlSubmissions.selectedItems()) == 0:
+        if len(self.wzlSubmissions.selected_objects()) == 0:
             return
 
         ctx = QtWidgets.QMenu()
         act = QtWidgets.QAction("Delete", self)
 
         def handler(b):
-            exclude = []
-            for item in self.wzlSubmissions.selectedItems():
-                sub = item.data(0, QtCore.Qt.UserRole)
-                exclude.append(sub.id)
-
-            with self.lock:
-                self.excluded_submissions.extend(exclude)
-
-            self._render_submissions()
+            self._exclude_submissions(self.wzlSubmissions.selected_objects())
 
         act.triggered.connect(handler)
 
@@ -558,149 +667,182 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
         ctx.exec(self.wzlSubmissions.mapToGlobal(point))
 
+    def _exclude_submissions(self, submissions):
+        self.state.update(lambda state: state.replace(
+            excluded_submissions=state.excluded_submissions |
+            {sub.id for sub in submissions}))
+
+        for sub in submissions:
+            self.wzl_submission_model.exclude_submission(sub)
+            self.wzl_search.remove(sub)
+
+        if self._worker is not None:
+            self._worker.exclude(submissions)
+
     def _reset_submissions(self):
         self.btnResetSubmissions.setEnabled(False)
         self.btnCreateSubmissions.setEnabled(False)
-        self.excluded_submissions = []
+        self.state.replace(excluded_submissions=())
         self._load_submissions()
 
+    def _preview_source(self, obj):
+        # FA thumbnails come from FA's servers, so fetch them with the FA
+        # session rather than sending the Weasyl API key along
+        if isinstance(obj, fa_models.Submission):
+            return obj.thumbnail_url, self.fa_sess.fetch_thumbnail
+        elif isinstance(obj, wzl_models.Submission):
+            return obj.thumbnail_url, self.wzl_sess.fetch_media
+        return None
+
     def _get_preview(self, old, new):
-        if len(self.wzlSubmissions.selectedItems()) != 1:
+        rows = self.wzlSubmissions.selectionModel().selectedRows()
+
+        source = self._preview_source(
+            rows[0].data(QtCore.Qt.UserRole)) if len(rows) == 1 else None
+
+        if source is None:
+            self.preview_service.clear()
             self.submissionPreview.setPixmap(QtGui.QPixmap())
             return
 
-        sub = self.wzlSubmissions.selectedItems()[0].data(0, QtCore.Qt.UserRole)
-
-        def work():
-            with self.lock:
-                # TODO: do not use protected attribute
-                # TODO: cache the thumbnail instead of repeatedly requesting it
-                res = self.wzl_sess._requests.get(sub.thumbnail_url)
-                data = res.content
+        # Prefetch the rows around the selection, likely to be shown next
+        index = rows[0]
+        model = index.model()
+        neighbors = []
+        for offset in range(1, constants.PREVIEW_PREFETCH_ROWS + 1):
+            for row in (index.row() + offset, index.row() - offset):
+                sibling = model.index(row, 0, index.parent())
+                if not sibling.isValid():
+                    continue
 
-            self.set_preview.emit(data)
+                neighbor = self._preview_source(
+                    sibling.data(QtCore.Qt.UserRole))
+                if neighbor is not None:
+                    neighbors.append(neighbor)
 
-        threading.Thread(target=work).start()
+        url, fetch = source
+        self.preview_service.show(url, fetch, neighbors)
 
-    def _set_preview(self, data):
-        pixmap = QtGui.QPixmap()
-        pixmap.loadFromData(QtCore.QByteArray(data))
+    def _set_preview(self, pixmap):
         self.submissionPreview.setPixmap(pixmap)
 
     def _upload(self):
         self.overallProgress.setValue(0)
         self.waitProgress.setValue(0)
+        self.btnPause.setText("Pause")
+        self.btnPause.setEnabled(True)
+        self.btnStop.setEnabled(True)
         self.stackedWidget.setCurrentIndex(3)
 
-        interval_minutes = self.btnDelay.value()
+        # The same engine as headless runs; the window only follows its
+        # events
+        worker = Worker(self.fa_sess, self.wzl_sess,
+                        thumbnail_cache=self.preview_service.cache)
+        worker.subscribers.append(self.worker_event.emit)
+        self._worker = worker
 
-        def work():
-
-            with self.lock:
-                unmapped = compare.get_unmapped_submissions(
-                    self.fa_sess.gallery + self.fa_sess.scraps,
-                    [(f, w) for f, w in self.submission_mapping.items()])
-
-                to_create = [sub for sub in unmapped if
-                             sub not in self.excluded_submissions]
-
-                to_create.sort(key=lambda x: x.id)
-
-                uploaded = 0
-
-                for sub in to_create:
-                    if sub is not to_create[0]:
-                        self.log_event.emit(
-                            "Waiting %d minutes" % interval_minutes)
-                        for i in range(60 * interval_minutes):
-                            if not self.run:
-                                return
-                            time.sleep(1)
-                            self.progress.emit(uploaded, len(to_create), i + 1,
-                                               60 * interval_minutes)
-
-                    if not self.run:
-                        return
-
-                    self.log_event.emit("Uploading \"%s\"" % sub.title)
-                    self._upload_one_submission(sub)
-                    uploaded += 1
-                    self.progress.emit(uploaded, len(to_create), 0, 1)
+        scheduler = UploadScheduler.from_interval(self.btnDelay.value())
 
-                self.log_event.emit("Finished")
-
-        self.thread = threading.Thread(target=work)
-        self.thread.start()
+        def work():
+            state = self.state.snapshot
 
-    def _upload_one_submission(self, sub):
-        # Download the file
-        # TODO: use a non protected attribute
-        res = self.fa_sess._requests.get(sub.media_url)
-        file = res.content
+            unmapped = compare.get_unmapped_submissions(
+                self.fa_sess.gallery + self.fa_sess.scraps,
+                list(state.submission_mapping.items()))
 
-        # TODO: not exactly the right way
-        file_name_info = sub.media_url.split("/")
+            to_create = [sub for sub in unmapped if
+                         sub.id not in state.excluded_submissions]
 
-        file_name = file_name_info[-1]
+            to_create.sort(key=lambda x: x.id)
 
-        title = sub.title
-        type = compare.convert_submission_type(sub.type)
+            worker.submissions_to_create = to_create
+            worker.submission_folder_mapping = dict(
+                state.submission_folders)
+            worker.create_all(scheduler=scheduler)
 
-        try:
-            category = compare.convert_submission_category(sub.category)
-        except KeyError:
-            category = ""
+        def failed(e):
+            logger.error("Uploading failed: %r" % e)
+            self._upload_ended()
 
-        rating = compare.convert_rating(sub.rating)
-        description = sub.description
-        tags = sub.tags
+        self.tasks.submit(work, key="upload", on_error=failed)
 
-        if sub in self.submission_folders:
-            folder_id = self.submission_folders[sub].id
-        else:
-            folder_id = 0
+    def _toggle_pause(self):
+        if self._worker is None:
+            return
 
-        if type != "visual":
-            # Use custom thumbnail
-            res = self.fa_sess._requests.get(sub.thumbnail_url)
-            thumb_file = res.content
+        if self._worker.paused:
+            self._worker.resume()
         else:
-            thumb_file = None
-
-        # Upload the submission
-
-        self.wzl_sess.create_submission(
-            file_name,
-            file,
-            title,
-            type,
-            category,
-            rating,
-            description,
-            tags,
-            folder_id,
-            thumb_file,
-        )
-
-    def _progress(self, overall_num, overall_max, time_num, time_max):
-        self.overallProgress.setMaximum(overall_max)
-        self.overallProgress.setValue(overall_num)
-        self.waitProgress.setValue(time_max)
-        self.waitProgress.setValue(time_num)
-
-    def _log(self, msg):
-        self.log.setText(self.log.toPlainText() + msg + "\r\n")
+            self._worker.pause()
+
+    def _stop_upload(self):
+        if self._worker is not None:
+            self._worker.cancel()
+        self.btnPause.setEnabled(False)
+        self.btnStop.setEnabled(False)
+
+    def _upload_ended(self):
+        self._wait_timer.stop()
+        self.btnPause.setEnabled(False)
+        self.btnStop.setEnabled(False)
+
+    def _worker_event(self, event):
+        if isinstance(event, events.Waiting):
+            logger.info("Waiting %d seconds, all done in about %d minutes" %
+                        (event.seconds, event.eta // 60))
+            self.waitProgress.setMaximum(max(1, int(event.seconds)))
+            self.waitProgress.setValue(0)
+
+            # The wait is shown counting up here, rather than reported by
+            # the waiting thread every second
+            self._wait_timer.start()
+        elif isinstance(event, events.ItemStarted):
+            logger.info("Uploading \"%s\"" % event.submission.title)
+            self._wait_timer.stop()
+            self.waitProgress.setValue(self.waitProgress.maximum())
+        elif isinstance(event, (events.ItemUploaded, events.ItemSkipped)):
+            if isinstance(event, events.ItemSkipped) and event.error is None:
+                logger.info("Skipping \"%s\"" % event.submission.title)
+
+            # Uploads running side by side finish in any order
+            self.overallProgress.setMaximum(event.total)
+            self.overallProgress.setValue(self.overallProgress.value() + 1)
+        elif isinstance(event, events.Paused):
+            logger.info("Paused")
+            self.btnPause.setText("Resume")
+        elif isinstance(event, events.Resumed):
+            logger.info("Resumed")
+            self.btnPause.setText("Pause")
+        elif isinstance(event, events.Cancelled):
+            logger.info("Stopped with %d submissions left" %
+                        (event.total - event.index))
+        elif isinstance(event, events.Error):
+            self._upload_ended()
+        elif isinstance(event, events.StageFinished) and \
+                event.stage == "create_all":
+            logger.info("Finished")
+            self._upload_ended()
+
+    def _tick_wait(self):
+        self.waitProgress.setValue(self.waitProgress.value() + 1)
+        if self.waitProgress.value() >= self.waitProgress.maximum():
+            self._wait_timer.stop()
 
     def closeEvent(self, QCloseEvent):
         super().closeEvent(QCloseEvent)
 
-        self.run = False
+        self.preview_service.clear()
+        if self._worker is not None:
+            self._worker.cancel()
+        # Scans do not stop between pages, and the task threads are daemon
+        # threads, so the window closes without waiting for them
+        self.tasks.shutdown(wait=False)
 
-        if self.thread is not None:
-            self.thread.join()
+        logger.removeHandler(self.log.buffer)
 
     def __del__(self):
-        self.fa_sess.logout()
+        if self._owns_fa_sess and not self._keep_login:
+            self.fa_sess.logout()
 
 
 def main():
@@ -0,0 +1,642 @@
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+
+import time
+
+from fa2wzl import constants, exceptions
+from fa2wzl.logging import logger
+from fa2wzl.plan import entry_submission, make_plan
+
+CRAWL = "crawl"
+PREFETCH = "prefetch"
+TRANSFER = "transfer"
+UPLOAD = "upload"
+
+KINDS = (CRAWL, PREFETCH, TRANSFER, UPLOAD)
+"""tuple: Job kinds, in the order a submission goes through them"""
+
+DETAIL_FIELDS = ("title", "rating", "category", "description", "tags",
+                 "media_url")
+"""tuple: Submission fields loaded from its page by a prefetch job"""
+
+# Later stages go first, so submissions finish instead of piling up as
+# downloaded media
+_PRIORITIES = {UPLOAD: 0, TRANSFER: 1, PREFETCH: 2, CRAWL: 3}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    account TEXT NOT NULL,
+    fa_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    UNIQUE (kind, account, fa_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_ready
+    ON jobs (state, priority, available_at);
+CREATE TABLE IF NOT EXISTS completions (
+    kind TEXT NOT NULL,
+    account TEXT NOT NULL,
+    fa_id INTEGER NOT NULL,
+    owner TEXT,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (kind, account, fa_id)
+);
+"""
+
+_COLUMNS = "id, kind, account, fa_id, payload, attempts, owner, lease_until"
+
+
+class Job(object):
+    """A unit of migration work leased from a JobQueue.
+
+    Attributes:
+        id (int): The job ID in the queue
+        kind (str): One of KINDS
+        account (str): The FA username the job is for
+        fa_id (int): The FA submission ID, 0 for crawl jobs
+        payload (dict): What the job needs to know
+        attempts (int): Times the job was leased, this time included
+        owner (str): The queue worker holding the lease
+        lease_until (float): When the lease runs out, as a Unix time
+    """
+
+    def __init__(self, id, kind, account, fa_id, payload, attempts, owner,
+                 lease_until):
+        self.id = id
+        self.kind = kind
+        self.account = account
+        self.fa_id = fa_id
+        self.payload = json.loads(payload)
+        self.attempts = attempts
+        self.owner = owner
+        self.lease_until = lease_until
+
+    def __repr__(self):
+        return "<Job #%d: %s %s %d>" % (self.id, self.kind, self.account,
+                                        self.fa_id)
+
+
+class JobQueue(object):
+    """A queue of migration jobs in an SQLite database.
+
+    Several processes, also on other hosts sharing the file, can take jobs
+    from the same queue; a shared file system must support file locks. A
+    job is leased to one worker at a time. Running jobs have their lease
+    extended by heartbeats; when a worker dies, its lease runs out and the
+    job is leased to another worker.
+
+    Completion is recorded per kind, account and FA submission ID, so a job
+    finished twice, e.g. by a worker whose lease had run out, only counts
+    once, and nothing is uploaded again once its upload completed.
+    """
+
+    def __init__(self, path, max_attempts=constants.JOB_MAX_ATTEMPTS,
+                 retry_seconds=constants.JOB_RETRY_SECONDS):
+        """Open a queue, creating it if needed.
+
+        Args:
+            path (str): The database file
+            max_attempts (int, optional): Times a job is tried before it
+                is marked as failed
+            retry_seconds (float, optional): Base delay before a failed job
+                is tried again
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+
+        # Connections cannot be shared between threads
+        self._local = threading.local()
+
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # The default rollback journal, as WAL needs memory shared
+            # between processes and breaks on network file systems
+            db = sqlite3.connect(self.path, timeout=60,
+                                 isolation_level=None)
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        # Take the write lock up front, so two workers never read the same
+        # job as free
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _put(self, db, kind, account, fa_id, payload, spacing, replace):
+        now = time.time()
+        available_at = now
+
+        if spacing > 0:
+            # Spread the account's jobs of this kind out in time
+            last, = db.execute(
+                "SELECT MAX(available_at) FROM jobs WHERE kind = ? AND "
+                "account = ?", (kind, account)).fetchone()
+            if last is not None:
+                available_at = max(now, last + spacing)
+
+        row = db.execute(
+            "SELECT state FROM jobs WHERE kind = ? AND account = ? AND "
+            "fa_id = ?", (kind, account, fa_id)).fetchone()
+
+        if row is None:
+            db.execute(
+                "INSERT INTO jobs (kind, account, fa_id, payload, state, "
+                "priority, available_at) VALUES (?, ?, ?, ?, 'pending', ?, "
+                "?)", (kind, account, fa_id, json.dumps(payload),
+                       _PRIORITIES[kind], available_at))
+            return True
+
+        if replace and row[0] in ("done", "failed"):
+            db.execute(
+                "UPDATE jobs SET payload = ?, state = 'pending', "
+                "available_at = ?, owner = NULL, lease_until = NULL, "
+                "attempts = 0, error = NULL WHERE kind = ? AND account = ? "
+                "AND fa_id = ?", (json.dumps(payload), available_at, kind,
+                                  account, fa_id))
+            db.execute(
+                "DELETE FROM completions WHERE kind = ? AND account = ? AND "
+                "fa_id = ?", (kind, account, fa_id))
+            return True
+
+        return False
+
+    def put(self, kind, account, fa_id=0, payload=None, spacing=0,
+            replace=False):
+        """Add a job, unless the same job is already queued.
+
+        Args:
+            kind (str): One of KINDS
+            account (str): The FA username
+            fa_id (int, optional): The FA submission ID
+            payload (dict, optional): What the job needs to know
+            spacing (float, optional): Seconds to keep between this and the
+                account's previous job of the kind
+            replace (bool, optional): Queue a finished or failed job again
+
+        Returns:
+            bool: Whether the job was added
+        """
+        with self._transaction() as db:
+            return self._put(db, kind, account, fa_id, payload or {},
+                             spacing, replace)
+
+    def lease(self, owner, kinds=None,
+              seconds=constants.JOB_LEASE_SECONDS):
+        """Take the next ready job.
+
+        Args:
+            owner (str): The name of the worker taking it
+            kinds (optional): Kinds of jobs to take, defaults to all
+            seconds (float, optional): Length of the lease
+
+        Returns:
+            Job: The job, or None if no job is ready
+        """
+        now = time.time()
+        kinds = tuple(kinds or KINDS)
+        kind_filter = "kind IN (%s)" % ", ".join("?" * len(kinds))
+
+        with self._transaction() as db:
+            # Workers of abandoned jobs may have died because of the job
+            db.execute(
+                "UPDATE jobs SET state = 'failed', owner = NULL, error = "
+                "'The lease ran out too often' WHERE state = 'leased' AND "
+                "lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts))
+
+            row = db.execute(
+                "SELECT id FROM jobs WHERE " + kind_filter + " AND ("
+                "(state = 'pending' AND available_at <= ?) OR "
+                "(state = 'leased' AND lease_until < ?)) "
+                "ORDER BY priority, available_at, id LIMIT 1",
+                kinds + (now, now)).fetchone()
+
+            if row is None:
+                return None
+
+            db.execute(
+                "UPDATE jobs SET state = 'leased', owner = ?, "
+                "lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (owner, now + seconds, row[0]))
+
+            return Job(*db.execute(
+                "SELECT " + _COLUMNS + " FROM jobs WHERE id = ?",
+                row).fetchone())
+
+    def heartbeat(self, job, seconds=constants.JOB_LEASE_SECONDS):
+        """Extend the lease of a running job.
+
+        Args:
+            job (Job): The job
+            seconds (float, optional): New length of the lease from now
+
+        Returns:
+            bool: False if the lease was lost to another worker
+        """
+        lease_until = time.time() + seconds
+
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND "
+                "owner = ? AND state = 'leased'",
+                (lease_until, job.id, job.owner))
+
+        if cursor.rowcount != 1:
+            return False
+
+        job.lease_until = lease_until
+        return True
+
+    def complete(self, job, follow_ups=()):
+        """Mark a job as done and queue the jobs continuing its work.
+
+        Completing the same work again has no effect. Work finished after
+        the lease was lost still counts, so the worker that took the job
+        over finds it done, but the job itself is left to that worker.
+
+        Args:
+            job (Job): The job
+            follow_ups: Dicts of put arguments, queued only if this is the
+                first completion
+
+        Returns:
+            bool: Whether this was the first completion
+
+        Raises:
+            LeaseLostError: If another worker took the job over
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO completions (kind, account, fa_id, "
+                "owner, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (job.kind, job.account, job.fa_id, job.owner, time.time()))
+            first = cursor.rowcount == 1
+
+            cursor = db.execute(
+                "UPDATE jobs SET state = 'done', owner = NULL, "
+                "lease_until = NULL, error = NULL WHERE id = ? AND "
+                "owner = ? AND state = 'leased'", (job.id, job.owner))
+            leased = cursor.rowcount == 1
+
+            if first:
+                for follow_up in follow_ups:
+                    self._put(db, follow_up["kind"], job.account,
+                              follow_up.get("fa_id", job.fa_id),
+                              follow_up.get("payload") or {},
+                              follow_up.get("spacing", 0), False)
+
+        if not leased:
+            raise exceptions.LeaseLostError("Lost the lease of %r" % job)
+
+        return first
+
+    def fail(self, job, error):
+        """Give a job back after it failed, to be tried again later.
+
+        Args:
+            job (Job): The job
+            error (str): What went wrong
+
+        Returns:
+            bool: Whether it will be tried again
+        """
+        retry = job.attempts < self.max_attempts
+        delay = self.retry_seconds * 2 ** (job.attempts - 1)
+
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, owner = NULL, lease_until = "
+                "NULL, available_at = ?, error = ? WHERE id = ? AND "
+                "owner = ? AND state = 'leased'",
+                ("pending" if retry else "failed", time.time() + delay,
+                 error, job.id, job.owner))
+
+        return retry
+
+    def is_complete(self, kind, account, fa_id=0):
+        """Check whether some work was completed.
+
+        Args:
+            kind (str): One of KINDS
+            account (str): The FA username
+            fa_id (int, optional): The FA submission ID
+
+        Returns:
+            bool: Whether a job of the kind completed for the submission
+        """
+        row = self._connection().execute(
+            "SELECT 1 FROM completions WHERE kind = ? AND account = ? AND "
+            "fa_id = ?", (kind, account, fa_id)).fetchone()
+        return row is not None
+
+    def counts(self):
+        """Count the jobs of each kind in each state.
+
+        Returns:
+            dict: Kinds to dicts of states to numbers of jobs
+        """
+        counts = {kind: {} for kind in KINDS}
+
+        for kind, state, count in self._connection().execute(
+                "SELECT kind, state, COUNT(*) FROM jobs "
+                "GROUP BY kind, state"):
+            counts.setdefault(kind, {})[state] = count
+
+        return counts
+
+    def unfinished(self):
+        """Count the jobs that are waiting or running.
+
+        Returns:
+            int: The number of jobs
+        """
+        row = self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state IN ('pending', "
+            "'leased')").fetchone()
+        return row[0]
+
+    def failures(self):
+        """Get the jobs that failed for good.
+
+        Returns:
+            list: Tuples of kind, account, FA submission ID and error
+        """
+        return self._connection().execute(
+            "SELECT kind, account, fa_id, error FROM jobs WHERE state = "
+            "'failed' ORDER BY id").fetchall()
+
+
+class QueueWorker(object):
+    """Takes jobs from a JobQueue and runs them with Worker stages.
+
+    A crawl job maps and creates folders and plans the account's new
+    submissions. A prefetch job loads a submission's details from its page,
+    a transfer job downloads its files to the spool directory and an upload
+    job creates it on Weasyl. Each queues the next, so different workers can
+    run the stages of one submission. Transfer and upload workers on other
+    hosts need to share the spool directory.
+
+    Rate limits apply per process, so the number of workers taking each
+    kind of job should keep the sum within the sites' limits.
+
+    Attributes:
+        queue (JobQueue): The queue
+        make_worker: Callable taking an FA username, returning a Worker for
+            the account
+        spool_dir (str): Where downloaded files wait for their upload
+        kinds: Kinds of jobs taken
+        owner (str): Name of this worker in the queue
+        listeners: Callables called with an event name and a dict of details.
+            "job_started", "job_finished" and "job_failed" have the kind,
+            account and fa_id of the job; "job_failed" also has the error.
+    """
+
+    def __init__(self, queue, make_worker, spool_dir, kinds=None, owner=None,
+                 lease_seconds=constants.JOB_LEASE_SECONDS,
+                 heartbeat_seconds=constants.JOB_HEARTBEAT_SECONDS):
+        """Create a queue worker.
+
+        Args:
+            queue (JobQueue): The queue
+            make_worker: Callable taking an FA username, returning a Worker
+            spool_dir (str): Where downloaded files wait for their upload
+            kinds (optional): Kinds of jobs to take, defaults to all
+            owner (str, optional): Name in the queue, defaults to one made
+                of the host name and process ID
+            lease_seconds (float, optional): Length of leases
+            heartbeat_seconds (float, optional): Interval between heartbeats
+        """
+        self.queue = queue
+        self.make_worker = make_worker
+        self.spool_dir = spool_dir
+        self.kinds = tuple(kinds or KINDS)
+        self.owner = owner or "%s:%d:%s" % (socket.gethostname(), os.getpid(),
+                                            uuid.uuid4().hex[:8])
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+
+        self.listeners = []
+
+        self._workers = {}
+        self._handlers = {
+            CRAWL: self._crawl,
+            PREFETCH: self._prefetch,
+            TRANSFER: self._transfer,
+            UPLOAD: self._upload,
+        }
+
+    def _notify(self, event, **data):
+        """Tell the listeners about progress.
+
+        Args:
+            event (str): The event name
+            **data: Event details
+        """
+        for listener in list(self.listeners):
+            listener(event, data)
+
+    def _worker(self, account):
+        worker = self._workers.get(account)
+        if worker is None:
+            worker = self._workers[account] = self.make_worker(account)
+        return worker
+
+    def _spool_path(self, job, name):
+        return os.path.join(self.spool_dir, job.account, str(job.fa_id), name)
+
+    def _submission(self, worker, payload):
+        sub = entry_submission(worker.fa_sess, payload)
+        for field in DETAIL_FIELDS:
+            if field in payload:
+                setattr(sub, field, payload[field])
+        return sub
+
+    def _crawl(self, job, worker):
+        options = job.payload
+
+        worker.map_folders()
+        if options.get("create_folders", True):
+            worker.create_folders()
+
+        plan = make_plan(worker, set(options.get("exclude", ())))
+        interval = options.get("interval_minutes", 0)
+
+        return [{
+            "kind": PREFETCH,
+            "fa_id": entry["id"],
+            "payload": dict(entry, interval_minutes=interval),
+        } for entry in plan["submissions"]]
+
+    def _prefetch(self, job, worker):
+        sub = entry_submission(worker.fa_sess, job.payload)
+        details = {field: getattr(sub, field) for field in DETAIL_FIELDS}
+
+        return [{"kind": TRANSFER, "payload": dict(job.payload, **details)}]
+
+    def _transfer(self, job, worker):
+        sub = self._submission(worker, job.payload)
+
+        # Downloads continue from partial files left by failed attempts
+        media_path = self._spool_path(job, "media")
+        os.makedirs(os.path.dirname(media_path), exist_ok=True)
+        file_name, media, thumbnail = worker.download_submission_media(
+            sub, media_path, self._spool_path(job, "thumbnail"))
+
+        payload = dict(job.payload, file_name=file_name, media=media,
+                       thumbnail=thumbnail)
+        spacing = 60 * job.payload.get("interval_minutes", 0)
+
+        return [{"kind": UPLOAD, "payload": payload, "spacing": spacing}]
+
+    def _read_spool(self, job, name, check):
+        path = self._spool_path(job, name)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        # The spool may be on a shared disk other processes write to
+        length, sha256 = check
+        if len(data) != length or \
+                hashlib.sha256(data).hexdigest() != sha256:
+            os.remove(path)
+            raise exceptions.MediaError("The spooled %s of %r is corrupt" %
+                                        (name, job))
+
+        return data
+
+    def _upload(self, job, worker):
+        # Another worker may have leased the job since the last heartbeat,
+        # e.g. after this process stalled; it uploads instead
+        if not self.queue.heartbeat(job, self.lease_seconds):
+            raise exceptions.LeaseLostError("Lost the lease of %r" % job)
+
+        if self.queue.is_complete(UPLOAD, job.account, job.fa_id):
+            logger.info("%r was already uploaded" % job)
+            return []
+
+        file = self._read_spool(job, "media", job.payload["media"])
+
+        thumb_file = None
+        if job.payload.get("thumbnail"):
+            thumb_file = self._read_spool(job, "thumbnail",
+                                          job.payload["thumbnail"])
+
+        sub = self._submission(worker, job.payload)
+        worker.upload_submission(sub, job.payload["file_name"], file,
+                                 thumb_file, job.payload.get("folder") or 0)
+        return []
+
+    def _clean_spool(self, job):
+        directory = os.path.dirname(self._spool_path(job, "media"))
+        for name in ("media", "media.part", "thumbnail", "thumbnail.part"):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    def _heartbeat(self, job, done):
+        while not done.wait(self.heartbeat_seconds):
+            if not self.queue.heartbeat(job, self.lease_seconds):
+                logger.warning("Lost the lease of %r" % job)
+                return
+
+    def run_one(self):
+        """Lease and run one job.
+
+        Returns:
+            bool: False if no job was ready
+        """
+        job = self.queue.lease(self.owner, self.kinds, self.lease_seconds)
+        if job is None:
+            return False
+
+        details = {"kind": job.kind, "account": job.account,
+                   "fa_id": job.fa_id}
+        self._notify("job_started", **details)
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat,
+                                     args=(job, done), daemon=True)
+        heartbeat.start()
+
+        try:
+            follow_ups = self._handlers[job.kind](job,
+                                                  self._worker(job.account))
+        except exceptions.LeaseLostError as e:
+            # The job is no longer this worker's to fail
+            logger.warning(str(e))
+            self._notify("job_failed", error=e, **details)
+            return True
+        except Exception as e:
+            logger.exception("%r failed" % job)
+            self.queue.fail(job, repr(e))
+            self._notify("job_failed", error=e, **details)
+            return True
+        finally:
+            done.set()
+            heartbeat.join()
+
+        try:
+            self.queue.complete(job, follow_ups)
+        except exceptions.LeaseLostError as e:
+            # The worker now holding the job cleans up after it
+            logger.warning(str(e))
+        else:
+            if job.kind == UPLOAD:
+                self._clean_spool(job)
+
+        self._notify("job_finished", **details)
+        return True
+
+    def run(self, stop=None, exit_when_idle=True,
+            poll_seconds=constants.JOB_POLL_SECONDS):
+        """Run jobs until stopped or, optionally, until the queue is done.
+
+        Args:
+            stop (threading.Event, optional): Set to stop after the current
+                job
+            exit_when_idle (bool, optional): Return once no job is waiting
+                or running, instead of waiting for more
+            poll_seconds (float, optional): How long to wait before looking
+                for jobs again
+        """
+        stop = stop if stop is not None else threading.Event()
+
+        while not stop.is_set():
+            if self.run_one():
+                continue
+
+            # Jobs running elsewhere may still queue more
+            if exit_when_idle and not self.queue.unfinished():
+                return
+
+            stop.wait(poll_seconds)
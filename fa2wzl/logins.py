@@ -0,0 +1,238 @@
+import base64
+import json
+import os
+
+from fa2wzl import constants, exceptions
+from fa2wzl.logging import logger
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+except ImportError:
+    Fernet = None
+
+
+def default_store_path():
+    """Get the default file for stored logins.
+
+    Returns:
+        str: The file path
+    """
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+        os.path.expanduser("~"), ".config")
+    return os.path.join(base, "fa2wzl", "logins")
+
+
+def store_from_environment(path=None):
+    """Open the login store if a passphrase is set in the environment.
+
+    Args:
+        path (str, optional): The store file, defaults to
+            default_store_path()
+
+    Returns:
+        LoginStore: The store, or None if no passphrase is set or the
+        cryptography package is missing
+    """
+    passphrase = os.environ.get(constants.LOGIN_STORE_PASSPHRASE_ENV)
+    if not passphrase:
+        return None
+
+    if Fernet is None:
+        logger.warning("%s is set, but logins cannot be stored without the "
+                       "cryptography package" %
+                       constants.LOGIN_STORE_PASSPHRASE_ENV)
+        return None
+
+    return LoginStore(path or default_store_path(), passphrase)
+
+
+class LoginStore(object):
+    """Keeps FA login cookies and Weasyl API keys between runs.
+
+    Logins are encrypted with a key derived from a passphrase, so the file
+    alone does not give access to the accounts. Needs the optional
+    cryptography package.
+
+    Attributes:
+        path (str): The store file
+    """
+
+    def __init__(self, path, passphrase):
+        """Open a login store; the file is created when a login is saved.
+
+        Args:
+            path (str): The store file
+            passphrase (str): The passphrase the logins are encrypted with
+
+        Raises:
+            ImportError: If the cryptography package is missing
+        """
+        if Fernet is None:
+            raise ImportError("Storing logins needs the cryptography "
+                              "package")
+
+        self.path = path
+        self._passphrase = passphrase.encode("utf-8")
+
+        # Deriving a key is slow on purpose, so do it once per salt
+        self._salt = None
+        self._fernets = {}
+
+    def _fernet(self, salt):
+        fernet = self._fernets.get(salt)
+        if fernet is None:
+            kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt,
+                             iterations=constants.LOGIN_STORE_KDF_ITERATIONS)
+            fernet = Fernet(base64.urlsafe_b64encode(
+                kdf.derive(self._passphrase)))
+            self._fernets[salt] = fernet
+        return fernet
+
+    def _read(self, strict=False):
+        """Read and decrypt the stored logins.
+
+        Args:
+            strict (bool, optional): Whether to raise rather than ignore a
+                store that cannot be read, as before writing it
+
+        Returns:
+            dict: The logins, empty if there are none
+
+        Raises:
+            LoginStoreError: If strict and the store is unreadable
+        """
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+            salt = base64.b64decode(stored["salt"])
+            token = stored["logins"].encode("ascii")
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError) as e:
+            message = "Unreadable login store %s: %r" % (self.path, e)
+        else:
+            try:
+                logins = json.loads(self._fernet(salt).decrypt(token))
+            except InvalidToken:
+                message = "Cannot decrypt the login store %s, wrong " \
+                          "passphrase?" % self.path
+            else:
+                self._salt = salt
+                return logins
+
+        # Writing over it would lose every login in it
+        if strict:
+            raise exceptions.LoginStoreError(message)
+        logger.warning(message)
+        return {}
+
+    def _write(self, logins):
+        # Fernet adds a random IV to every token, so the salt can stay
+        if self._salt is None:
+            self._salt = os.urandom(16)
+        salt = self._salt
+        token = self._fernet(salt).encrypt(
+            json.dumps(logins).encode("utf-8"))
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+
+        # Readable by the owner only, and never left half written
+        part = self.path + ".part"
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({
+                "salt": base64.b64encode(salt).decode("ascii"),
+                "logins": token.decode("ascii"),
+            }, f)
+        os.replace(part, self.path)
+
+    def load(self, username=None):
+        """Get a stored login.
+
+        Args:
+            username (str, optional): The FA username, defaults to the last
+                saved login
+
+        Returns:
+            dict: The login, with the FA username as username, the FA
+            cookies as cookies and optionally the Weasyl API key as
+            wzl_api_key. None if there is none.
+        """
+        logins = self._read()
+
+        if username is None:
+            username = logins.get("last")
+
+        login = logins.get("accounts", {}).get(username)
+        if login is None:
+            return None
+
+        return dict(login, username=username)
+
+    def save(self, username, cookies, wzl_api_key=None):
+        """Store a login, replacing an earlier one of the user.
+
+        Args:
+            username (str): The FA username
+            cookies: Dict of the FA session's cookies
+            wzl_api_key (str, optional): The Weasyl API key
+
+        Raises:
+            LoginStoreError: If the store exists but cannot be read, e.g.
+                with this passphrase
+        """
+        logins = self._read(strict=True)
+
+        login = {"cookies": dict(cookies)}
+        if wzl_api_key:
+            login["wzl_api_key"] = wzl_api_key
+
+        logins.setdefault("accounts", {})[username] = login
+        logins["last"] = username
+        self._write(logins)
+
+    def remove(self, username):
+        """Forget a stored login, e.g. once it is no longer accepted.
+
+        Args:
+            username (str): The FA username
+
+        Raises:
+            LoginStoreError: If the store exists but cannot be read
+        """
+        logins = self._read(strict=True)
+
+        if logins.get("accounts", {}).pop(username, None) is None:
+            return
+        if logins.get("last") == username:
+            logins.pop("last")
+
+        self._write(logins)
+
+
+def restore_login(fa_sess, login):
+    """Use a stored login if the site still accepts it.
+
+    Costs one page request instead of a CAPTCHA and a login.
+
+    Args:
+        fa_sess (FASession): The session to log in
+        login (dict): A login from LoginStore.load
+
+    Returns:
+        bool: Whether the session is logged in
+
+    Raises:
+        ScraperError: If FA could not tell, e.g. while it is down
+    """
+    fa_sess.username = login["username"]
+
+    try:
+        fa_sess.set_cookies(login["cookies"])
+    except exceptions.AuthenticationError:
+        return False
+
+    return fa_sess.check_login()
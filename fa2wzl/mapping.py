@@ -1,3 +1,5 @@
+from contextlib import nullcontext
+
 from fa2wzl import exceptions
 
 
@@ -9,6 +11,9 @@ class MappedAttributeState(object):
 
 class MappedAttribute(object):
     """Class that manages attributes that are lazily loaded from somewhere.
+
+    If the instance has a _load_lock, loading happens while holding it, so
+    threads reading the attribute at the same time load it only once.
     """
 
     def __init__(self, load_func):
@@ -20,19 +25,20 @@ class MappedAttribute(object):
         self._load_func = load_func
 
     def _get_attribute_state(self, instance):
-        if not hasattr(instance, "_attr_state"):
-            setattr(instance, "_attr_state", {})
-
-        if self not in instance._attr_state:
-            instance._attr_state[self] = MappedAttributeState()
-
-        return instance._attr_state[self]
+        # setdefault is atomic, so racing threads end up with the same state
+        attr_state = instance.__dict__.setdefault("_attr_state", {})
+        return attr_state.setdefault(self, MappedAttributeState())
 
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
         state = self._get_attribute_state(instance)
 
-        if not state.loaded:
-            self._load_func(instance)
+        if not state.loaded and self._load_func is not None:
+            with getattr(instance, "_load_lock", nullcontext()):
+                if not state.loaded:
+                    self._load_func(instance)
 
         if not state.loaded:
             raise exceptions.ScraperError()
@@ -43,3 +49,26 @@ class MappedAttribute(object):
         state = self._get_attribute_state(instance)
         state.loaded = True
         state.value = value
+
+
+def loaded_value(instance, name, default=None):
+    """Get a mapped attribute only if it is already loaded.
+
+    Unlike reading the attribute, this never loads it, so it is safe to call
+    from the UI thread while a scan is running.
+
+    Args:
+        instance: The object
+        name (str): The attribute name
+        default: Returned if the attribute is not loaded
+
+    Returns:
+        The attribute value, or default
+    """
+    attribute = getattr(type(instance), name)
+    state = attribute._get_attribute_state(instance)
+
+    if not state.loaded:
+        return default
+
+    return state.value
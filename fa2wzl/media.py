@@ -0,0 +1,273 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError
+
+from fa2wzl import constants, exceptions, transport
+from fa2wzl.logging import logger
+
+# Errors of a response body cut off after the response started
+_STREAM_ERRORS = (requests.ConnectionError, requests.Timeout,
+                  requests.exceptions.ChunkedEncodingError, ProtocolError)
+
+_CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+def _file_digest(path, chunk_size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaFetcher(object):
+    """Downloads media files from the sites' static servers.
+
+    Downloads are streamed to a partial file next to their destination. If
+    the connection drops, the download continues from where it stopped with
+    an HTTP Range request, also in a later run, as long as the partial file
+    is kept. The fetcher has its own connection pool, apart from the page
+    requests, and limits how many downloads run at once, so large files
+    never hold up page requests.
+
+    Attributes:
+        concurrency (int): Downloads running at the same time
+        chunk_size (int): Bytes read and written at a time
+        max_resumes (int): Times a download is resumed before giving up
+        limiter (BandwidthLimiter): Bandwidth limit shared by all downloads,
+            None for no limit
+    """
+
+    def __init__(self, concurrency=constants.MEDIA_CONCURRENCY,
+                 chunk_size=constants.MEDIA_CHUNK_SIZE,
+                 max_resumes=constants.MEDIA_MAX_RESUMES, cookies=None,
+                 metrics=None, limiter=None, adapter=None):
+        """Create a media fetcher.
+
+        Args:
+            concurrency (int, optional): Downloads running at the same time
+            chunk_size (int, optional): Bytes read and written at a time
+            max_resumes (int, optional): Times a download is resumed before
+                giving up
+            cookies (optional): Cookie jar to send, e.g. that of a logged in
+                session
+            metrics (Metrics, optional): Where to record request metrics
+            limiter (BandwidthLimiter, optional): Bandwidth limit shared by
+                all downloads
+            adapter (HTTPAdapter, optional): Connection pools for media
+                shared with other fetchers
+        """
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.max_resumes = max_resumes
+        self.limiter = limiter
+
+        if adapter is None:
+            adapter = HTTPAdapter(
+                pool_connections=constants.HTTP_POOL_CONNECTIONS,
+                pool_maxsize=concurrency)
+
+        self._requests = transport.Transport(metrics=metrics,
+                                             adapter=adapter)
+        self._requests.headers["User-Agent"] = constants.USER_AGENT
+        if cookies is not None:
+            self._requests.cookies = cookies
+
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    @property
+    def headers(self):
+        """dict: Headers sent with every download"""
+        return self._requests.headers
+
+    def _throttle(self, size):
+        if self.limiter is not None:
+            self.limiter.acquire(size)
+
+    def _stream(self, url, part, endpoint):
+        """Download into the partial file, continuing what it holds.
+
+        Returns:
+            int: The full length of the file, None if the server did not say
+        """
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {"Range": "bytes=%d-" % offset} if offset else {}
+
+        res = self._requests.get(url, headers=headers, stream=True,
+                                 endpoint=endpoint)
+        try:
+            if res.status_code == 416 and offset:
+                # The partial file already holds everything
+                total = res.headers.get("Content-Range",
+                                        "").rpartition("/")[2]
+                return int(total) if total.isdigit() else offset
+
+            res.raise_for_status()
+
+            if res.status_code == 206:
+                match = _CONTENT_RANGE_RE.match(
+                    res.headers.get("Content-Range", ""))
+                if match is None or int(match.group(1)) != offset:
+                    raise exceptions.MediaError(
+                        "Unexpected range %r for %s" % (
+                            res.headers.get("Content-Range"), url))
+                total = None if match.group(3) == "*" \
+                    else int(match.group(3))
+                mode = "ab"
+            else:
+                # The server sent the whole file, ignoring the range
+                length = res.headers.get("Content-Length")
+                total = int(length) if length is not None else None
+                mode = "wb"
+
+            # Keep whatever arrived before a drop; iter_content would lose
+            # the chunk it was still filling
+            read1 = getattr(res.raw, "read1", None)
+            if read1 is not None:
+                chunks = iter(lambda: read1(self.chunk_size,
+                                            decode_content=True), b"")
+            else:
+                chunks = res.iter_content(self.chunk_size)
+
+            with open(part, mode) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    self._throttle(len(chunk))
+
+            return total
+        finally:
+            res.close()
+
+    def download(self, url, path, length=None, sha256=None,
+                 endpoint="media"):
+        """Download a file, resuming an earlier partial download.
+
+        Args:
+            url (str): The URL of the file
+            path (str): Where to save the file
+            length (int, optional): The expected length in bytes
+            sha256 (str, optional): The expected SHA-256 hex digest
+            endpoint (str, optional): Logical endpoint name for metrics
+
+        Returns:
+            tuple: The length and the SHA-256 hex digest of the file
+
+        Raises:
+            MediaError: If the download stays incomplete or does not match
+                the expected length or digest
+        """
+        part = path + ".part"
+
+        with self._slots:
+            resumes = 0
+            while True:
+                try:
+                    total = self._stream(url, part, endpoint)
+                except _STREAM_ERRORS as e:
+                    total = None
+                    error = e
+                else:
+                    error = None
+
+                size = os.path.getsize(part) if os.path.exists(part) else 0
+                if error is None and (total is None or size >= total):
+                    break
+
+                if resumes >= self.max_resumes:
+                    raise exceptions.MediaError(
+                        "Download of %s stopped at %d bytes" % (url, size))
+
+                resumes += 1
+                logger.debug("Resuming %s at %d bytes (%s)" % (
+                    url, size, error or "connection closed early"))
+
+        if total is not None and size != total:
+            os.remove(part)
+            raise exceptions.MediaError("%s has %d bytes instead of %d" % (
+                url, size, total))
+        if length is not None and size != length:
+            os.remove(part)
+            raise exceptions.MediaError("%s has %d bytes, expected %d" % (
+                url, size, length))
+
+        digest = _file_digest(part, self.chunk_size)
+        if sha256 is not None and digest != sha256.lower():
+            os.remove(part)
+            raise exceptions.MediaError("%s does not match its SHA-256 "
+                                        "digest" % url)
+
+        os.replace(part, path)
+        return size, digest
+
+    def size(self, url, endpoint="media"):
+        """Find the length of a file without downloading it.
+
+        Args:
+            url (str): The URL of the file
+            endpoint (str, optional): Logical endpoint name for metrics
+
+        Returns:
+            int: The length in bytes, None if the server does not say
+        """
+        try:
+            res = self._requests.head(url, allow_redirects=True,
+                                      endpoint=endpoint)
+        except requests.RequestException as e:
+            logger.debug("Could not get the size of %s: %s" % (url, e))
+            return None
+
+        length = res.headers.get("Content-Length")
+        if not res.ok or length is None or not length.isdigit():
+            return None
+        return int(length)
+
+    def get(self, url, endpoint="media"):
+        """Download a small file, such as a thumbnail, at once.
+
+        Small files do not wait for a free download slot, so previews are
+        never held up by large downloads.
+
+        Args:
+            url (str): The URL of the file
+            endpoint (str, optional): Logical endpoint name for metrics
+
+        Returns:
+            bytes: The file contents
+        """
+        res = self._requests.get(url, endpoint=endpoint)
+        res.raise_for_status()
+        self._throttle(len(res.content))
+        return res.content
+
+    def fetch(self, url, endpoint="media", **checks):
+        """Download a file into memory.
+
+        Large files are still resumed if the connection drops.
+
+        Args:
+            url (str): The URL of the file
+            endpoint (str, optional): Logical endpoint name for metrics
+            **checks: length and sha256 as for download
+
+        Returns:
+            bytes: The file contents
+        """
+        directory = tempfile.mkdtemp(prefix="fa2wzl-media-")
+        try:
+            path = os.path.join(directory, "media")
+            self.download(url, path, endpoint=endpoint, **checks)
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def close(self):
+        """Close the pooled connections."""
+        self._requests.close()
@@ -0,0 +1,242 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fa2wzl.logging import logger
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""tuple: Upper bounds in seconds of the request latency histogram"""
+
+
+class EndpointMetrics(object):
+    """Counters for a single logical endpoint.
+
+    Attributes:
+        statuses: Dict of response status code to count
+        errors (int): Requests that failed without a response
+        buckets: List of counts per entry of LATENCY_BUCKETS
+        latency_count (int): Number of latency observations
+        latency_sum (float): Sum of all latencies in seconds
+        bytes_in (int): Response body bytes received
+        bytes_out (int): Request body bytes sent
+        waits (int): Number of times a request had to wait for a limiter
+        wait_seconds (float): Total time spent blocked in rate limiters
+    """
+
+    def __init__(self):
+        self.statuses = {}
+        self.errors = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    @property
+    def requests(self):
+        return sum(self.statuses.values()) + self.errors
+
+    def observe_latency(self, seconds):
+        self.latency_count += 1
+        self.latency_sum += seconds
+
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "statuses": dict(self.statuses),
+            "errors": self.errors,
+            "latency_buckets": dict(zip(LATENCY_BUCKETS, self.buckets)),
+            "latency_count": self.latency_count,
+            "latency_sum": self.latency_sum,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "waits": self.waits,
+            "wait_seconds": self.wait_seconds,
+        }
+
+
+class Metrics(object):
+    """A thread-safe collection of per-endpoint HTTP metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _get(self, endpoint):
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = EndpointMetrics()
+            self._endpoints[endpoint] = metrics
+        return metrics
+
+    def record_request(self, endpoint, status, seconds, bytes_in=0,
+                       bytes_out=0):
+        """Record a completed request.
+
+        Args:
+            endpoint (str): The logical endpoint name
+            status (int): The response status code
+            seconds (float): Time until the response was received
+            bytes_in (int): Size of the response body
+            bytes_out (int): Size of the request body
+        """
+        with self._lock:
+            metrics = self._get(endpoint)
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.observe_latency(seconds)
+            metrics.bytes_in += bytes_in
+            metrics.bytes_out += bytes_out
+
+    def record_error(self, endpoint, seconds):
+        """Record a request that failed without a response.
+
+        Args:
+            endpoint (str): The logical endpoint name
+            seconds (float): Time until the request failed
+        """
+        with self._lock:
+            metrics = self._get(endpoint)
+            metrics.errors += 1
+            metrics.observe_latency(seconds)
+
+    def record_wait(self, endpoint, seconds):
+        """Record time spent blocked in a rate limiter.
+
+        Args:
+            endpoint (str): The logical endpoint name
+            seconds (float): Time spent waiting
+        """
+        with self._lock:
+            metrics = self._get(endpoint)
+            if seconds > 0:
+                metrics.waits += 1
+                metrics.wait_seconds += seconds
+
+    def reset(self):
+        """Forget everything recorded so far.
+        """
+        with self._lock:
+            self._endpoints = {}
+
+    def snapshot(self):
+        """Get a copy of the current metrics.
+
+        Returns:
+            dict: Endpoint names mapped to dicts of their counters
+        """
+        with self._lock:
+            return {name: metrics.as_dict() for name, metrics in
+                    self._endpoints.items()}
+
+    def render_prometheus(self):
+        """Render the metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The rendered metrics
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name, type, help):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+
+        header("fa2wzl_http_requests_total", "counter",
+               "HTTP responses received, by status code")
+        for endpoint, data in sorted(snapshot.items()):
+            for status, count in sorted(data["statuses"].items()):
+                lines.append(
+                    'fa2wzl_http_requests_total{endpoint="%s",status="%d"} %d'
+                    % (endpoint, status, count))
+
+        header("fa2wzl_http_errors_total", "counter",
+               "HTTP requests that failed without a response")
+        for endpoint, data in sorted(snapshot.items()):
+            lines.append('fa2wzl_http_errors_total{endpoint="%s"} %d' % (
+                endpoint, data["errors"]))
+
+        header("fa2wzl_http_request_duration_seconds", "histogram",
+               "HTTP request latency")
+        for endpoint, data in sorted(snapshot.items()):
+            for bound in LATENCY_BUCKETS:
+                lines.append(
+                    'fa2wzl_http_request_duration_seconds_bucket'
+                    '{endpoint="%s",le="%s"} %d' % (
+                        endpoint, bound, data["latency_buckets"][bound]))
+            lines.append(
+                'fa2wzl_http_request_duration_seconds_bucket'
+                '{endpoint="%s",le="+Inf"} %d' % (
+                    endpoint, data["latency_count"]))
+            lines.append(
+                'fa2wzl_http_request_duration_seconds_sum{endpoint="%s"} %f'
+                % (endpoint, data["latency_sum"]))
+            lines.append(
+                'fa2wzl_http_request_duration_seconds_count{endpoint="%s"} %d'
+                % (endpoint, data["latency_count"]))
+
+        header("fa2wzl_http_received_bytes_total", "counter",
+               "Response body bytes received")
+        for endpoint, data in sorted(snapshot.items()):
+            lines.append('fa2wzl_http_received_bytes_total{endpoint="%s"} %d'
+                         % (endpoint, data["bytes_in"]))
+
+        header("fa2wzl_http_sent_bytes_total", "counter",
+               "Request body bytes sent")
+        for endpoint, data in sorted(snapshot.items()):
+            lines.append('fa2wzl_http_sent_bytes_total{endpoint="%s"} %d'
+                         % (endpoint, data["bytes_out"]))
+
+        header("fa2wzl_rate_limit_wait_seconds_total", "counter",
+               "Time spent blocked in rate limiters")
+        for endpoint, data in sorted(snapshot.items()):
+            lines.append(
+                'fa2wzl_rate_limit_wait_seconds_total{endpoint="%s"} %f'
+                % (endpoint, data["wait_seconds"]))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics over HTTP in a background thread.
+
+        Args:
+            port (int): The port to listen on
+            host (str, optional): The address to bind to
+
+        Returns:
+            The running server; call its shutdown method to stop it
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        logger.info("Serving metrics on http://%s:%d/" % (
+            host, server.server_address[1]))
+
+        return server
+
+
+registry = Metrics()
+"""Metrics: The default registry used by the sessions"""
@@ -0,0 +1,389 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from fa2wzl import compare, constants
+from fa2wzl.exceptions import ConfigError, ValidationError
+from fa2wzl.mapping import loaded_value
+
+PLAN_VERSION = 1
+"""int: Version of the plan file format"""
+
+LISTING_FIELDS = ("type", "thumbnail_url")
+"""tuple: Submission fields only found in gallery listings, kept in plans so
+running one needs no gallery scan"""
+
+
+def load_plan(path):
+    """Read a plan file written by the plan command.
+
+    Args:
+        path (str): The JSON file
+
+    Returns:
+        dict: The plan
+
+    Raises:
+        ConfigError: If the file is missing, unreadable or of another version
+    """
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError("Cannot read %s: %s" % (path, e))
+
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise ConfigError("%s is not a version %d plan" % (path,
+                                                            PLAN_VERSION))
+
+    return plan
+
+
+def walk_folders(folders):
+    """Iterate over folders and all their subfolders.
+
+    Args:
+        folders: The root folders
+
+    Yields:
+        Each folder, before its children
+    """
+    for folder in folders:
+        yield folder
+        yield from walk_folders(folder.children)
+
+
+def make_plan(worker, exclude=()):
+    """Map folders and submissions, without changing anything on Weasyl.
+
+    Args:
+        worker (Worker): The worker, with its sessions
+        exclude: IDs of FA submissions to leave out
+
+    Returns:
+        dict: The plan, ready to be written as JSON
+    """
+    worker.map_folders()
+    worker.map_submissions()
+
+    missing = [folder for folder in walk_folders(worker.fa_sess.folders)
+               if folder not in worker.folder_mapping]
+    parents = {child: folder for folder in worker.fa_sess.folders
+               for child in folder.children}
+
+    submissions = []
+    for sub in worker.submissions_to_create:
+        if sub.id in exclude:
+            continue
+
+        fa_folder = worker.submission_fa_folders.get(sub)
+        wzl_folder = worker.submission_folder_mapping.get(sub)
+        entry = {
+            "id": sub.id,
+            "title": sub.title,
+            "fa_folder": fa_folder.id if fa_folder is not None else None,
+            "folder": wzl_folder.id if wzl_folder is not None else None,
+        }
+        for field in LISTING_FIELDS:
+            entry[field] = getattr(sub, field)
+        submissions.append(entry)
+
+    return {
+        "version": PLAN_VERSION,
+        "fa_username": worker.fa_sess.username,
+        "folders_to_create": [{
+            "id": folder.id,
+            "title": folder.title,
+            "parent": parents[folder].id if folder in parents else None,
+        } for folder in missing],
+        "submissions": submissions,
+    }
+
+
+def entry_submission(fa_sess, entry):
+    """Get the FA submission of a plan entry, without scanning galleries.
+
+    Args:
+        fa_sess (FASession): The FA session
+        entry (dict): The plan entry
+
+    Returns:
+        Submission: The submission, with the fields known from listings set
+    """
+    sub = fa_sess.submission(entry["id"])
+    for field in LISTING_FIELDS:
+        if entry.get(field):
+            setattr(sub, field, entry[field])
+
+    return sub
+
+
+def apply_plan(worker, plan):
+    """Set the submissions to create from a plan, without scanning galleries.
+
+    Folders have to be mapped first. Submissions planned into an FA folder
+    are put in the Weasyl folder it is mapped to now, so folders created
+    since planning are used.
+
+    Args:
+        worker (Worker): The worker, with its folders mapped
+        plan (dict): The plan
+
+    Raises:
+        ConfigError: If the plan is for another FA user
+    """
+    if plan.get("fa_username") != worker.fa_sess.username:
+        raise ConfigError("The plan is for FA user %r" %
+                          plan.get("fa_username"))
+
+    fa_folders = {f.id: f for f in walk_folders(worker.fa_sess.folders)}
+    wzl_folders = {f.id: f for f in walk_folders(worker.wzl_sess.folders)}
+
+    submissions = []
+    fa_folder_of = {}
+    wzl_folder_of = {}
+
+    for entry in plan["submissions"]:
+        sub = entry_submission(worker.fa_sess, entry)
+        submissions.append(sub)
+
+        fa_folder = fa_folders.get(entry.get("fa_folder"))
+        if fa_folder is not None:
+            fa_folder_of[sub] = fa_folder
+
+        wzl_folder = wzl_folders.get(entry.get("folder"))
+        if wzl_folder is None and fa_folder is not None:
+            wzl_folder = worker.folder_mapping.get(fa_folder)
+        if wzl_folder is not None:
+            wzl_folder_of[sub] = wzl_folder
+
+    worker.submissions_to_create = submissions
+    worker.submission_fa_folders = fa_folder_of
+    worker.submission_folder_mapping = wzl_folder_of
+
+
+def select_submissions(worker, config, plan=None):
+    """Set the submissions a run would create.
+
+    Folders have to be mapped first.
+
+    Args:
+        worker (Worker): The worker, with its folders mapped
+        config (dict): The account configuration, with the IDs to leave out
+            as exclude
+        plan (dict, optional): A plan to take the submissions from, instead
+            of scanning the galleries
+    """
+    if plan is not None:
+        apply_plan(worker, plan)
+    else:
+        worker.map_submissions()
+
+    worker.submissions_to_create = [
+        sub for sub in worker.submissions_to_create
+        if sub.id not in config["exclude"]]
+
+
+def submission_problems(worker, sub, size=None, preprocessing=False):
+    """Find what would stop a submission from being uploaded as it is.
+
+    Only details already loaded are looked at, so nothing is fetched.
+
+    Args:
+        worker (Worker): The worker
+        sub: The FA submission
+        size (int, optional): The length of its file, if known
+        preprocessing (bool, optional): Whether the run converts files
+            Weasyl would refuse
+
+    Returns:
+        tuple: Lists of errors, which make the upload fail, and warnings
+    """
+    # Imaging libraries are only loaded when checking, so the command line
+    # starts quickly
+    from fa2wzl import preprocess
+
+    errors = []
+    warnings = []
+
+    fa_type = loaded_value(sub, "type")
+    try:
+        type = compare.convert_submission_type(fa_type)
+    except KeyError:
+        errors.append("No Weasyl type for FA type %r" % fa_type)
+        type = None
+
+    rating = loaded_value(sub, "rating")
+    try:
+        compare.convert_rating(rating)
+    except KeyError:
+        errors.append("No Weasyl rating for %r" % rating)
+
+    category = loaded_value(sub, "category")
+    try:
+        compare.convert_submission_category(category)
+    except KeyError:
+        warnings.append("No Weasyl category for %r, uploaded without one" %
+                        category)
+
+    if type not in (None, "visual") and \
+            loaded_value(sub, "thumbnail_url") is None:
+        errors.append("No thumbnail to use as the custom thumbnail")
+
+    if loaded_value(sub, "media_url") is None:
+        errors.append("No download link")
+    elif type is not None:
+        try:
+            convert = preprocess.check_media(worker.media_file_name(sub),
+                                             size, type)
+        except ValidationError as e:
+            errors.append(str(e))
+        else:
+            if convert and preprocessing:
+                warnings.append("Converted before uploading")
+            elif convert:
+                errors.append("Weasyl would refuse the file as it is; run "
+                              "with preprocessing to convert it")
+
+    return errors, warnings
+
+
+def _weasyl_type(sub):
+    try:
+        return compare.convert_submission_type(loaded_value(sub, "type"))
+    except KeyError:
+        return None
+
+
+def _media_sizes(worker, submissions, workers):
+    urls = [loaded_value(sub, "media_url") for sub in submissions]
+
+    def size(url):
+        return worker.fa_sess.media_size(url) if url is not None else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(size, urls))
+
+
+def check_submissions(worker, scheduler, create_folders=True,
+                      preprocessing=False, listing_pages=0,
+                      workers=constants.DETAIL_PREFETCH_WORKERS):
+    """Check the submissions a run would create, without changing anything.
+
+    The details and file sizes of all submissions are fetched up front,
+    several at a time, so problems that would otherwise stop the run hours
+    in are found at once.
+
+    Args:
+        worker (Worker): The worker, with the submissions to create set
+        scheduler (UploadScheduler): Decides when the run's uploads start
+        create_folders (bool, optional): Whether the run creates missing
+            folders
+        preprocessing (bool, optional): Whether the run converts files
+            Weasyl would refuse
+        listing_pages (int, optional): Gallery pages the run scans
+        workers (int, optional): Requests made at the same time
+
+    Returns:
+        dict: The report, with the problems found and the costs of the run
+        as used by estimate
+    """
+    submissions = worker.submissions_to_create
+    failed = worker.fa_sess.prefetch(submissions, workers)
+    sizes = _media_sizes(worker, submissions, workers)
+
+    problems = []
+    for sub, size in zip(submissions, sizes):
+        if sub in failed:
+            errors = ["Details could not be loaded: %r" % failed[sub]]
+            warnings = []
+        else:
+            errors, warnings = submission_problems(worker, sub, size,
+                                                   preprocessing)
+
+        title = loaded_value(sub, "title")
+        problems.extend({"id": sub.id, "title": title, "level": "error",
+                         "message": message} for message in errors)
+        problems.extend({"id": sub.id, "title": title, "level": "warning",
+                         "message": message} for message in warnings)
+
+    folders = 0
+    if create_folders:
+        folders = sum(1 for folder in walk_folders(worker.fa_sess.folders)
+                      if folder not in worker.folder_mapping)
+
+    # Files of unknown size are taken to be of the average size
+    known = [size for size in sizes if size is not None]
+    media_bytes = sum(known)
+    if known:
+        media_bytes += (len(sizes) - len(known)) * media_bytes // len(known)
+
+    literary = sum(1 for sub in submissions
+                   if loaded_value(sub, "type") == "text")
+
+    return {
+        "fa_username": worker.fa_sess.username,
+        "submissions": len(submissions),
+        "folders_to_create": folders,
+        "problems": problems,
+        "costs": {
+            # Each upload loads its submission's page again
+            "fa_pages": listing_pages + len(submissions),
+            # Literary submissions need a second request for the thumbnail
+            "wzl_writes": folders + len(submissions) + literary,
+            "media_bytes": media_bytes,
+            "unknown_sizes": len(sizes) - len(known),
+            # Uploads take no time of their own, as that is transfer time
+            "wait_seconds": scheduler.eta(
+                [_weasyl_type(sub) for sub in submissions], 0),
+        },
+    }
+
+
+def _limited_seconds(limiter, count):
+    # Time a token bucket needs for count tokens, after using its burst
+    return max(0.0, count - limiter.burst) * limiter.per / limiter.rate
+
+
+def estimate(worker, costs, concurrency=1):
+    """Estimate how long runs take, from their costs and the limits.
+
+    Runs sharing the worker's limiters, like accounts of a batch, share
+    their budgets, while their upload schedules pass side by side. Requests
+    are assumed to take no time beyond what the limits impose.
+
+    Args:
+        worker (Worker): A worker with the limiters the runs use
+        costs: The costs of each run, from check_submissions
+        concurrency (int, optional): Runs going on at the same time
+
+    Returns:
+        dict: The estimated seconds, in total and for each part
+    """
+    download_rate = worker.fa_sess.download_limiter.rate or \
+        constants.ESTIMATE_BYTES_PER_SECOND
+    upload_rate = worker.wzl_sess.upload_limiter.rate or \
+        constants.ESTIMATE_BYTES_PER_SECOND
+
+    media_bytes = sum(cost["media_bytes"] for cost in costs)
+    waits = [cost["wait_seconds"] for cost in costs]
+
+    parts = {
+        "fa_pages_seconds": _limited_seconds(
+            worker.fa_sess.page_limiter,
+            sum(cost["fa_pages"] for cost in costs)),
+        "wzl_writes_seconds": _limited_seconds(
+            worker.wzl_sess.write_limiter,
+            sum(cost["wzl_writes"] for cost in costs)),
+        "wait_seconds": max([sum(waits) / concurrency] + waits),
+        "transfer_seconds": media_bytes / download_rate +
+        media_bytes / upload_rate,
+    }
+
+    # The limiters refill while the worker waits between uploads, but
+    # files are only moved in between
+    parts["total_seconds"] = max(parts["fa_pages_seconds"],
+                                 parts["wzl_writes_seconds"],
+                                 parts["wait_seconds"]) + \
+        parts["transfer_seconds"]
+
+    return parts
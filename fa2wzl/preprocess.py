@@ -0,0 +1,240 @@
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from fa2wzl import constants, exceptions
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def _extension(file_name):
+    return os.path.splitext(file_name)[1][1:].lower()
+
+
+def _open_image(data):
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise exceptions.ValidationError("Not a readable image: %s" % e)
+    return image
+
+
+def _has_alpha(image):
+    return image.mode in ("RGBA", "LA", "PA") or \
+        (image.mode == "P" and "transparency" in image.info)
+
+
+def _encode(image, format, quality=None):
+    out = io.BytesIO()
+    if format == "JPEG":
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(out, "JPEG", quality=quality, optimize=True)
+    else:
+        image.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def _fit_image(image, limit):
+    """Encode an image in at most limit bytes, shrinking it if needed.
+
+    Images with transparency stay PNG, others become JPEG.
+
+    Returns:
+        tuple: The new extension and the encoded image
+    """
+    alpha = _has_alpha(image)
+
+    while True:
+        if alpha:
+            data = _encode(image, "PNG")
+            if len(data) <= limit:
+                return "png", data
+        else:
+            for quality in constants.JPEG_QUALITIES:
+                data = _encode(image, "JPEG", quality)
+                if len(data) <= limit:
+                    return "jpg", data
+
+        width, height = image.size
+        if width <= 1 and height <= 1:
+            raise exceptions.ValidationError("The image does not fit in %d "
+                                             "bytes" % limit)
+
+        image = image.resize((max(1, int(width * constants.IMAGE_SCALE_STEP)),
+                              max(1, int(height *
+                                         constants.IMAGE_SCALE_STEP))),
+                             Image.LANCZOS)
+
+
+def check_media(file_name, size, type):
+    """Check a submission file against Weasyl's limits without reading it.
+
+    Args:
+        file_name (str): The file name
+        size (int): The file length, None if unknown
+        type (str): The Weasyl submission type
+
+    Returns:
+        bool: Whether the file has to be converted before Weasyl takes it
+
+    Raises:
+        ValidationError: If Weasyl would refuse the file, even converted
+    """
+    limits = constants.WZL_FILE_LIMITS[type]
+    ext = _extension(file_name)
+
+    if ext in limits and (size is None or size <= limits[ext]):
+        return False
+
+    if type != "visual":
+        if ext not in limits:
+            raise exceptions.ValidationError(
+                "Weasyl does not take .%s files as %s submissions" % (
+                    ext, type))
+        raise exceptions.ValidationError(
+            "%s has %d bytes, over Weasyl's limit of %d" % (
+                file_name, size, limits[ext]))
+
+    if Image is None:
+        raise exceptions.ValidationError("Converting %s needs the Pillow "
+                                         "package" % file_name)
+    return True
+
+
+def prepare_media(file_name, data, type):
+    """Check a submission file against Weasyl's limits, converting images.
+
+    Images in formats Weasyl does not take, or over its size limit, are
+    recompressed and if need be shrunk. Other files can only be checked.
+
+    Args:
+        file_name (str): The file name
+        data (bytes): The file contents
+        type (str): The Weasyl submission type
+
+    Returns:
+        tuple: The file name and contents to upload
+
+    Raises:
+        ValidationError: If Weasyl would refuse the file
+    """
+    convert = check_media(file_name, len(data), type)
+    if type != "visual" or Image is None:
+        return file_name, data
+
+    # Even images that fit are decoded, so broken ones are not uploaded
+    image = _open_image(data)
+    if not convert:
+        return file_name, data
+
+    # Shrinking every frame of an animation is not worth it
+    if getattr(image, "is_animated", False):
+        raise exceptions.ValidationError(
+            "%s is an animation Weasyl would not take" % file_name)
+
+    limits = constants.WZL_FILE_LIMITS[type]
+    ext, data = _fit_image(image, min(limits["png"], limits["jpg"]))
+    return "%s.%s" % (os.path.splitext(file_name)[0], ext), data
+
+
+def prepare_thumbnail(data):
+    """Make a custom thumbnail fit for Weasyl.
+
+    Args:
+        data (bytes): The source image, e.g. the FA thumbnail
+
+    Returns:
+        bytes: The thumbnail to upload
+
+    Raises:
+        ValidationError: If the image is unreadable or too large
+    """
+    if Image is None:
+        if len(data) > constants.WZL_THUMBNAIL_LIMIT:
+            raise exceptions.ValidationError("The thumbnail is too large")
+        return data
+
+    image = _open_image(data)
+    image.thumbnail((constants.WZL_THUMBNAIL_SIZE,
+                     constants.WZL_THUMBNAIL_SIZE), Image.LANCZOS)
+
+    return _fit_image(image, constants.WZL_THUMBNAIL_LIMIT)[1]
+
+
+def prepare_submission(file_name, file, type, thumbnail=None):
+    """Prepare all files of a submission; see prepare_media.
+
+    Args:
+        file_name (str): The file name
+        file (bytes): The file contents
+        type (str): The Weasyl submission type
+        thumbnail (bytes, optional): The custom thumbnail source
+
+    Returns:
+        tuple: The file name, the file and the thumbnail to upload
+    """
+    file_name, file = prepare_media(file_name, file, type)
+    if thumbnail is not None:
+        thumbnail = prepare_thumbnail(thumbnail)
+
+    return file_name, file, thumbnail
+
+
+class Preprocessor(object):
+    """Checks and converts files for Weasyl in a pool of processes.
+
+    Decoding and encoding images is CPU bound, so it runs in other processes
+    while the worker downloads and uploads. Without the optional Pillow
+    package, files are only checked.
+
+    Attributes:
+        workers (int): Number of processes
+    """
+
+    def __init__(self, workers=constants.PREPROCESS_WORKERS):
+        """Create a preprocessor; the processes start when first needed.
+
+        Args:
+            workers (int, optional): Number of processes
+        """
+        self.workers = workers
+
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, file_name, file, type, thumbnail=None):
+        """Start preparing a submission's files.
+
+        Args:
+            file_name (str): The file name
+            file (bytes): The file contents
+            type (str): The Weasyl submission type
+            thumbnail (bytes, optional): The custom thumbnail source
+
+        Returns:
+            Future: Resolves to the result of prepare_submission
+        """
+        with self._lock:
+            if self._executor is None:
+                # Forking a process that runs threads, e.g. Qt's, is unsafe
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"))
+
+        return self._executor.submit(prepare_submission, file_name, file,
+                                     type, thumbnail)
+
+    def close(self):
+        """Stop the processes."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+
+from PyQt5 import QtCore, QtGui
+
+from fa2wzl import constants
+from fa2wzl.logging import logger
+from fa2wzl.tasks import PRIORITY_HIGH, PRIORITY_LOW
+
+
+class PreviewService(QtCore.QObject):
+    """Loads submission previews in the background.
+
+    Thumbnail bytes come from a ThumbnailCache and are decoded off the UI
+    thread by a TaskRunner. Decoded pixmaps are kept in a small LRU, so
+    previews that were shown or prefetched recently appear immediately.
+    Requests that are no longer wanted when the selection moves on are
+    cancelled.
+    """
+
+    preview_ready = QtCore.pyqtSignal(QtGui.QPixmap, name="previewReady")
+
+    def __init__(self, cache, runner,
+                 max_pixmaps=constants.PREVIEW_PIXMAP_ITEMS, parent=None):
+        """Create a preview service.
+
+        Args:
+            cache (ThumbnailCache): Cache for the thumbnail bytes
+            runner (TaskRunner): Runs the downloads
+            max_pixmaps (int): Decoded previews to keep
+            parent (QObject, optional): The Qt parent
+        """
+        super(PreviewService, self).__init__(parent)
+
+        self.cache = cache
+        self.runner = runner
+        self.max_pixmaps = max_pixmaps
+
+        self._pixmaps = OrderedDict()
+        self._pending = {}
+        self._current = None
+
+    def show(self, url, fetch_func, neighbors=()):
+        """Request the preview for a URL, emitting preview_ready when done.
+
+        Args:
+            url (str): The thumbnail URL to show
+            fetch_func: Callable that downloads a URL and returns its bytes
+            neighbors: Pairs of URL and fetch function to prefetch
+        """
+        self._current = url
+        self._cancel_except({url} | {u for u, f in neighbors})
+
+        pixmap = self._pixmaps.get(url)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(url)
+            self.preview_ready.emit(pixmap)
+        else:
+            self._submit(url, fetch_func, PRIORITY_HIGH)
+
+        for neighbor_url, neighbor_fetch in neighbors:
+            if neighbor_url not in self._pixmaps:
+                self._submit(neighbor_url, neighbor_fetch, PRIORITY_LOW)
+
+    def clear(self):
+        """Stop showing a preview and cancel outstanding requests.
+        """
+        self._current = None
+        self._cancel_except(set())
+
+    def _cancel_except(self, wanted):
+        for url, task in list(self._pending.items()):
+            if url not in wanted:
+                task.cancel()
+                del self._pending[url]
+
+    def _submit(self, url, fetch_func, priority):
+        # Submitting again only raises the priority of a pending download
+        pending = self._pending.get(url)
+        if pending is not None and not pending.cancelled:
+            on_done = None
+        else:
+            on_done = lambda image: self._on_image_loaded(url, image)
+
+        self._pending[url] = self.runner.submit(
+            lambda: self._load(url, fetch_func),
+            key=("preview", url),
+            priority=priority,
+            on_done=on_done,
+        )
+
+    def _load(self, url, fetch_func):
+        # Runs on a task thread; QImage, unlike QPixmap, may be used here
+        try:
+            data = self.cache.fetch(url, fetch_func)
+            return QtGui.QImage.fromData(data)
+        except Exception as e:
+            logger.debug("Could not load preview %s: %s" % (url, e))
+            return QtGui.QImage()
+
+    def _on_image_loaded(self, url, image):
+        self._pending.pop(url, None)
+
+        if image.isNull():
+            pixmap = QtGui.QPixmap()
+        else:
+            pixmap = QtGui.QPixmap.fromImage(image)
+            self._pixmaps[url] = pixmap
+            self._pixmaps.move_to_end(url)
+
+            while len(self._pixmaps) > self.max_pixmaps:
+                self._pixmaps.popitem(last=False)
+
+        if url == self._current:
+            self.preview_ready.emit(pixmap)
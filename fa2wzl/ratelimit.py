@@ -0,0 +1,283 @@
+import threading
+
+import time
+
+from fa2wzl import constants
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket.
+
+    Each call to ``acquire`` takes one token, or as many as asked for,
+    blocking until they are available. Tokens are refilled continuously at
+    ``rate`` per ``per`` seconds, up to ``burst``. The server can
+    additionally ask callers to back off with ``defer``.
+
+    Attributes:
+        rate (float): Tokens added per period
+        per (float): Length of the period in seconds
+        burst (int): The maximum number of tokens held
+    """
+
+    def __init__(self, rate, per=1.0, burst=1):
+        """Create a rate limiter.
+
+        Args:
+            rate (float): Tokens added per period
+            per (float): Length of the period in seconds
+            burst (int, optional): Maximum number of stored tokens
+
+        Raises:
+            ValueError: If the rate or period is not positive
+        """
+        self._check(rate, per)
+
+        self.rate = rate
+        self.per = per
+        self.burst = burst
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+        self._calls = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait = 0.0
+        self._deferrals = 0
+
+    def _check(self, rate, per):
+        if rate is not None and rate <= 0:
+            raise ValueError("Rate must be positive, not %r" % rate)
+        if per is not None and per <= 0:
+            raise ValueError("Period must be positive, not %r" % per)
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(float(self.burst),
+                           self._tokens + elapsed * self.rate / self.per)
+
+    def acquire(self, amount=1):
+        """Take tokens, waiting until they are available.
+
+        Args:
+            amount (float, optional): The number of tokens, which may be
+                more than the burst
+
+        Returns:
+            float: The number of seconds spent waiting
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            # Reserve the tokens now so concurrent callers queue up behind
+            # each other instead of all waking at the same moment
+            self._tokens -= amount
+            wait = max(0.0, -self._tokens * self.per / self.rate,
+                       self._blocked_until - now)
+
+            self._calls += 1
+            if wait > 0:
+                self._waits += 1
+                self._wait_seconds += wait
+                self._max_wait = max(self._max_wait, wait)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+    def defer(self, seconds):
+        """Hold back all callers for a number of seconds.
+
+        Used when the server asks for a pause, e.g. with Retry-After.
+
+        Args:
+            seconds (float): How long to hold back
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self._deferrals += 1
+
+    def configure(self, rate=None, per=None, burst=None):
+        """Change the limits of a running limiter.
+
+        Args:
+            rate (float, optional): Tokens added per period
+            per (float, optional): Length of the period in seconds
+            burst (int, optional): Maximum number of stored tokens
+
+        Raises:
+            ValueError: If the rate or period is not positive
+        """
+        self._check(rate, per)
+
+        with self._lock:
+            self._refill(time.monotonic())
+
+            if rate is not None:
+                self.rate = rate
+            if per is not None:
+                self.per = per
+            if burst is not None:
+                self.burst = burst
+                self._tokens = min(self._tokens, float(burst))
+
+    @property
+    def stats(self):
+        """dict: Counters describing how much callers had to wait"""
+        with self._lock:
+            return {
+                "calls": self._calls,
+                "waits": self._waits,
+                "wait_seconds": self._wait_seconds,
+                "max_wait_seconds": self._max_wait,
+                "deferrals": self._deferrals,
+            }
+
+
+class BandwidthLimiter(RateLimiter):
+    """A token bucket counting bytes, for bandwidth limits.
+
+    Transfers call ``acquire`` with the size of each chunk they send or
+    receive. A rate of 0 lets everything through but still measures the
+    throughput, so limits can be set and lifted on a running limiter with
+    ``configure``.
+
+    Attributes:
+        rate (float): Bytes per second, 0 for no limit
+        burst (float): Bytes that can be sent at once after a pause
+    """
+
+    def __init__(self, rate=0, burst=None):
+        """Create a bandwidth limiter.
+
+        Args:
+            rate (float, optional): Bytes per second, 0 for no limit
+            burst (float, optional): Bytes that can be sent at once after a
+                pause, by default BANDWIDTH_BURST_SECONDS worth of the rate
+        """
+        super(BandwidthLimiter, self).__init__(
+            rate, burst=burst if burst is not None else
+            rate * constants.BANDWIDTH_BURST_SECONDS)
+        self._auto_burst = burst is None
+
+        self._bytes = 0
+        self._active_seconds = 0.0
+        self._last_transfer = None
+
+    def _check(self, rate, per):
+        # 0 lifts the limit, see acquire
+        if rate is not None and rate < 0:
+            raise ValueError("Rate must not be negative, not %r" % rate)
+        super(BandwidthLimiter, self)._check(None, per)
+
+    def _count(self, amount, now):
+        # Pauses between transfers, e.g. upload intervals, are not counted
+        if self._last_transfer is not None:
+            self._active_seconds += min(now - self._last_transfer,
+                                        constants.BANDWIDTH_IDLE_SECONDS)
+        self._last_transfer = now
+        self._bytes += amount
+
+    def acquire(self, amount=1):
+        """Take tokens for a number of bytes, waiting if over the limit.
+
+        Args:
+            amount (int, optional): The number of bytes
+
+        Returns:
+            float: The number of seconds spent waiting
+        """
+        if self.rate > 0:
+            wait = super(BandwidthLimiter, self).acquire(amount)
+        else:
+            wait = 0.0
+
+        with self._lock:
+            self._count(amount, time.monotonic())
+
+        return wait
+
+    def configure(self, rate=None, per=None, burst=None):
+        """Change the limit of a running limiter.
+
+        Args:
+            rate (float, optional): Bytes per second, 0 for no limit
+            per (float, optional): Length of the period in seconds
+            burst (float, optional): Bytes that can be sent at once, by
+                default BANDWIDTH_BURST_SECONDS worth of the new rate
+        """
+        if burst is None and rate is not None and self._auto_burst:
+            burst = rate * constants.BANDWIDTH_BURST_SECONDS
+        elif burst is not None:
+            self._auto_burst = False
+
+        super(BandwidthLimiter, self).configure(rate, per, burst)
+
+    @property
+    def stats(self):
+        """dict: Wait counters, bytes transferred and achieved throughput"""
+        stats = super(BandwidthLimiter, self).stats
+        with self._lock:
+            stats.update({
+                "limit_bytes_per_second": self.rate,
+                "bytes": self._bytes,
+                "bytes_per_second": self._bytes / self._active_seconds
+                if self._active_seconds else 0.0,
+            })
+        return stats
+
+
+class ThrottledReader(object):
+    """A file-like request body that is sent no faster than a limit.
+
+    It has a length, so it is sent with a Content-Length instead of in
+    chunks, and can be rewound to be sent again. A read returns at most
+    ``chunk_size`` bytes, so the limit is applied while sending.
+    """
+
+    def __init__(self, data, limiter, chunk_size=constants.UPLOAD_CHUNK_SIZE):
+        """Wrap a request body.
+
+        Args:
+            data (bytes): The body
+            limiter (BandwidthLimiter): The limiter to take bytes from
+            chunk_size (int, optional): Most bytes returned by one read
+        """
+        self.data = data
+        self.limiter = limiter
+        self.chunk_size = chunk_size
+
+        self._offset = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+
+        chunk = self.data[self._offset:self._offset + size]
+        self._offset += len(chunk)
+
+        if chunk:
+            self.limiter.acquire(len(chunk))
+        return chunk
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._offset
+        elif whence == 2:
+            offset += len(self.data)
+        self._offset = max(0, offset)
+        return self._offset
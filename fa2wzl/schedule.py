@@ -0,0 +1,373 @@
+import copy
+import datetime
+import heapq
+import re
+import threading
+
+import time
+
+from fa2wzl import constants
+
+_WINDOW_RE = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+
+
+class Policy(object):
+    """Decides when uploads may start; see UploadScheduler."""
+
+    def earliest(self, type, now):
+        """Find the earliest time an upload may start.
+
+        Args:
+            type (str): The Weasyl submission type
+            now (float): The current time in seconds since the epoch
+
+        Returns:
+            float: The time in seconds since the epoch
+        """
+        return now
+
+    def record(self, type, now):
+        """Count an upload as started.
+
+        Args:
+            type (str): The Weasyl submission type
+            now (float): The time it started
+        """
+
+    def finish(self, type, now):
+        """Count an upload as finished.
+
+        Args:
+            type (str): The Weasyl submission type, None if not known
+            now (float): The time it finished
+        """
+
+
+class FixedInterval(Policy):
+    """Waits the same time after each upload, before the next one starts.
+
+    Like the delay between uploads of earlier versions, the time is from
+    the end of an upload, so slow uploads do not shorten it.
+
+    Attributes:
+        seconds (float): Time between uploads
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._last = None
+
+    def earliest(self, type, now):
+        if self._last is None:
+            return now
+        return self._last + self.seconds
+
+    def finish(self, type, now):
+        self._last = now
+
+
+class HourlyRate(Policy):
+    """Allows a number of uploads per hour, some of them at once.
+
+    A token bucket like RateLimiter, so uploads after a pause go out in a
+    burst and the rate only holds them back after that.
+
+    Attributes:
+        per_hour (float): Uploads per hour
+        burst (int): Uploads allowed at once after a pause
+    """
+
+    def __init__(self, per_hour, burst=constants.UPLOAD_BURST):
+        """Create the policy.
+
+        Args:
+            per_hour (float): Uploads per hour
+            burst (int, optional): Uploads allowed at once after a pause
+
+        Raises:
+            ValueError: If the rate is not positive or the burst below 1
+        """
+        if per_hour <= 0:
+            raise ValueError("Uploads per hour must be positive, not %r" %
+                             per_hour)
+        if burst < 1:
+            raise ValueError("The burst must be at least 1, not %r" % burst)
+
+        self.per_hour = per_hour
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = None
+
+    def _refill(self, now):
+        if self._updated is not None:
+            self._tokens = min(float(self.burst), self._tokens + (
+                now - self._updated) * self.per_hour / 3600)
+        self._updated = now
+
+    def earliest(self, type, now):
+        self._refill(now)
+        if self._tokens >= 1:
+            return now
+        return now + (1 - self._tokens) * 3600 / self.per_hour
+
+    def record(self, type, now):
+        self._refill(now)
+        self._tokens -= 1
+
+
+class TimeWindows(Policy):
+    """Only starts uploads at certain hours of the local day.
+
+    A window ending before it starts runs past midnight, e.g. 22:00-06:00.
+
+    Attributes:
+        windows: List of (start, end) tuples of minutes after midnight
+    """
+
+    def __init__(self, windows):
+        """Create the policy.
+
+        Args:
+            windows: Tuples of minutes after midnight, or HH:MM-HH:MM
+                strings as taken by parse_window
+
+        Raises:
+            ValueError: If there are no windows or a string is invalid
+        """
+        self.windows = [parse_window(window) if isinstance(window, str)
+                        else tuple(window) for window in windows]
+        if not self.windows:
+            raise ValueError("No time windows given")
+
+    def earliest(self, type, now):
+        midnight = datetime.datetime.fromtimestamp(now).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+
+        # Windows of yesterday can still be open past midnight
+        starts = []
+        for day in range(-1, 2):
+            base = midnight + datetime.timedelta(days=day)
+            for start, end in self.windows:
+                if end <= start:
+                    end += 24 * 60
+                opens = (base + datetime.timedelta(minutes=start)).timestamp()
+                closes = (base + datetime.timedelta(minutes=end)).timestamp()
+                if closes > now:
+                    starts.append(max(opens, now))
+
+        return min(starts)
+
+
+class TypeSpacing(Policy):
+    """Spaces uploads of the same Weasyl type, e.g. only literary ones.
+
+    Attributes:
+        seconds: Dict of Weasyl submission types to the time between their
+            uploads; other types are not held back
+    """
+
+    def __init__(self, seconds):
+        self.seconds = dict(seconds)
+        self._last = {}
+
+    def earliest(self, type, now):
+        if type not in self.seconds or type not in self._last:
+            return now
+        return self._last[type] + self.seconds[type]
+
+    def record(self, type, now):
+        self._last[type] = now
+
+
+def parse_window(value):
+    """Parse a time window such as 22:00-06:00.
+
+    Args:
+        value (str): The window as HH:MM-HH:MM
+
+    Returns:
+        tuple: The start and end in minutes after midnight
+
+    Raises:
+        ValueError: If the window is not valid
+    """
+    match = _WINDOW_RE.match(value.strip())
+    if match is None:
+        raise ValueError("%r is not a window like 22:00-06:00" % value)
+
+    hours_start, minutes_start, hours_end, minutes_end = map(
+        int, match.groups())
+    start = 60 * hours_start + minutes_start
+    end = 60 * hours_end + minutes_end
+
+    # 24:00 is the only time of hour 24
+    if minutes_start > 59 or minutes_end > 59 or start > 24 * 60 or \
+            end > 24 * 60:
+        raise ValueError("%r is not a valid time window" % value)
+
+    return start, end
+
+
+class UploadScheduler(object):
+    """Decides when each upload may start.
+
+    Every policy gives the earliest time an upload of a Weasyl type may
+    start, and the upload waits for the latest of them. Waits end as soon as
+    the scheduler is cancelled, so runs stop at once rather than finishing
+    an interval first.
+
+    Uploads may also run side by side, for accounts whose watchers would not
+    mind a flood of notifications.
+
+    Attributes:
+        policies: The policies, such as FixedInterval and HourlyRate
+        concurrency (int): Uploads running at the same time
+    """
+
+    def __init__(self, policies=(), concurrency=constants.UPLOAD_CONCURRENCY,
+                 clock=time.time):
+        """Create a scheduler.
+
+        Args:
+            policies (optional): The policies; without any, uploads start
+                one after another without waiting
+            concurrency (int, optional): Uploads running at the same time
+            clock (optional): Returns the time in seconds since the epoch,
+                as time windows are by the local time of day
+        """
+        self.policies = list(policies)
+        self.concurrency = concurrency
+
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._cancelled = False
+        self._running = 0
+        self._uploads = 0
+        self._upload_seconds = 0.0
+
+    @classmethod
+    def from_interval(cls, interval_minutes):
+        """Create a scheduler waiting a fixed number of minutes.
+
+        Args:
+            interval_minutes (float): Minutes between uploads
+
+        Returns:
+            UploadScheduler: The scheduler
+        """
+        if interval_minutes > 0:
+            return cls([FixedInterval(60 * interval_minutes)])
+        return cls()
+
+    @property
+    def cancelled(self):
+        """bool: Whether the scheduler was cancelled"""
+        return self._cancelled
+
+    def cancel(self):
+        """Stop all waits at once; no more uploads are started."""
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+    def _earliest(self, policies, type, now):
+        return max([now] + [policy.earliest(type, now)
+                            for policy in policies])
+
+    def delay(self, type):
+        """Find how long an upload would wait for the policies.
+
+        Args:
+            type (str): The Weasyl submission type
+
+        Returns:
+            float: Seconds until an upload of the type may start
+        """
+        with self._condition:
+            now = self._clock()
+            return self._earliest(self.policies, type, now) - now
+
+    def acquire(self, type):
+        """Wait until an upload may start, and count it as started.
+
+        Args:
+            type (str): The Weasyl submission type
+
+        Returns:
+            bool: Whether the upload may go ahead, False if cancelled
+        """
+        with self._condition:
+            while not self._cancelled:
+                now = self._clock()
+                wait = self._earliest(self.policies, type, now) - now
+
+                if wait <= 0 and self._running < self.concurrency:
+                    for policy in self.policies:
+                        policy.record(type, now)
+                    self._running += 1
+                    return True
+
+                # A finished upload or cancel wakes this early
+                self._condition.wait(wait if wait > 0 else None)
+
+            return False
+
+    def release(self, seconds=None, type=None):
+        """Count an upload as finished.
+
+        Args:
+            seconds (float, optional): How long it took, for the ETA; None
+                if it did not run after all, so it is not waited after
+            type (str, optional): The Weasyl submission type
+        """
+        with self._condition:
+            self._running -= 1
+            if seconds is not None:
+                self._uploads += 1
+                self._upload_seconds += seconds
+                now = self._clock()
+                for policy in self.policies:
+                    policy.finish(type, now)
+            self._condition.notify_all()
+
+    def eta(self, types, upload_seconds=None):
+        """Estimate when uploads still to come are done.
+
+        Args:
+            types: The Weasyl types of the uploads, in order
+            upload_seconds (float, optional): How long an upload takes,
+                by default the average so far
+
+        Returns:
+            float: Seconds from now
+        """
+        with self._condition:
+            now = self._clock()
+            policies = copy.deepcopy(self.policies)
+            if upload_seconds is None:
+                upload_seconds = self._upload_seconds / self._uploads \
+                    if self._uploads else 0.0
+
+            # Running uploads are taken to finish after a typical upload
+            finishing = [now + upload_seconds] * min(self._running,
+                                                     self.concurrency)
+            for end in finishing:
+                for policy in policies:
+                    policy.finish(None, end)
+
+        heapq.heapify(finishing)
+        start = now
+        done = max([now] + finishing)
+        for type in types:
+            # Uploads start in order, so the time only moves forward
+            if len(finishing) >= self.concurrency:
+                start = max(start, heapq.heappop(finishing))
+            start = self._earliest(policies, type, start)
+
+            for policy in policies:
+                policy.record(type, start)
+                policy.finish(type, start + upload_seconds)
+            heapq.heappush(finishing, start + upload_seconds)
+            done = max(done, start + upload_seconds)
+
+        return done - now
@@ -0,0 +1,202 @@
+import re
+from collections import defaultdict
+
+from fa2wzl.mapping import MappedAttribute, loaded_value
+
+FIELDS = ("title", "tag", "rating", "type", "folder")
+"""tuple: Names of the fields a query term can be limited to"""
+
+FIELD_ALIASES = {"tags": "tag", "folders": "folder"}
+"""dict: Other accepted names of fields"""
+
+MAX_PREFIX = 16
+"""int: Longest token prefix kept in the prefix table"""
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _peek(obj, name, default=None):
+    # Never trigger loading, e.g. the tags of FA submissions need a page
+    # request each
+    attribute = getattr(type(obj), name, None)
+
+    if isinstance(attribute, MappedAttribute):
+        return loaded_value(obj, name, default)
+
+    return getattr(obj, name, default)
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex(object):
+    """Index for filtering submissions as the user types.
+
+    Submissions are indexed by their title, tags, rating, type and the
+    names of their folders. A query is made of terms that all have to
+    match. A term matches the start of any word, e.g. "dra" finds "Dragon
+    Sketch", through a table of word prefixes. Terms of three or more
+    characters also match anywhere in a field, e.g. "agon", through a
+    trigram index. A term can be limited to one field, as in "rating:adult".
+    """
+
+    def __init__(self):
+        self._texts = {}
+        self._folders = {}
+        self._members = {}
+        self._prefixes = {field: defaultdict(set) for field in FIELDS}
+        self._trigrams = defaultdict(set)
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __contains__(self, obj):
+        return obj in self._texts
+
+    def _keys(self, texts):
+        prefixes = {}
+        trigrams = set()
+
+        for field, text in texts.items():
+            prefixes[field] = {token[:i] for token in _TOKEN_RE.findall(text)
+                               for i in range(1, min(len(token),
+                                                     MAX_PREFIX) + 1)}
+            trigrams.update(_trigrams(text))
+
+        return prefixes, trigrams
+
+    def add(self, obj, folders=()):
+        """Index a submission, replacing an earlier entry.
+
+        Attributes that are not loaded yet are left out rather than loaded.
+
+        Args:
+            obj: The FA or Weasyl submission
+            folders: The folders it is shown in, parents before children
+        """
+        folders = list(folders)
+        tags = _peek(obj, "tags") or []
+        texts = {
+            "title": _peek(obj, "title") or "",
+            "tag": " ".join(tags),
+            "rating": _peek(obj, "rating") or "",
+            "type": _peek(obj, "type") or "",
+            "folder": " ".join(_peek(f, "title") or "" for f in folders),
+        }
+        texts = {field: text.lower() for field, text in texts.items()}
+
+        # Submissions are added again whenever more is known about them
+        if obj in self._texts:
+            if self._texts[obj] == texts and self._folders[obj] == folders:
+                return
+            self.remove(obj)
+
+        self._texts[obj] = texts
+        self._folders[obj] = folders
+
+        # Parents come first, so folders are known in that order too
+        for folder in folders:
+            self._members.setdefault(folder, set()).add(obj)
+
+        prefixes, trigrams = self._keys(texts)
+        for field, keys in prefixes.items():
+            table = self._prefixes[field]
+            for key in keys:
+                table[key].add(obj)
+        for trigram in trigrams:
+            self._trigrams[trigram].add(obj)
+
+    def remove(self, obj):
+        """Remove a submission from the index.
+
+        Args:
+            obj: The submission
+        """
+        texts = self._texts.pop(obj, None)
+        if texts is None:
+            return
+
+        for folder in self._folders.pop(obj):
+            self._members[folder].discard(obj)
+
+        prefixes, trigrams = self._keys(texts)
+        for field, keys in prefixes.items():
+            table = self._prefixes[field]
+            for key in keys:
+                objs = table[key]
+                objs.discard(obj)
+                if not objs:
+                    del table[key]
+        for trigram in trigrams:
+            objs = self._trigrams[trigram]
+            objs.discard(obj)
+            if not objs:
+                del self._trigrams[trigram]
+
+    def _match_term(self, field, term):
+        fields = FIELDS if field is None else (field,)
+
+        if len(term) <= MAX_PREFIX:
+            matches = set().union(*(self._prefixes[f].get(term, ())
+                                    for f in fields))
+        else:
+            # Only the start of long terms is in the table, check the rest
+            candidates = set().union(*(self._prefixes[f].get(
+                term[:MAX_PREFIX], ()) for f in fields))
+            matches = {obj for obj in candidates if any(
+                token.startswith(term) for f in fields
+                for token in _TOKEN_RE.findall(self._texts[obj][f]))}
+
+        if len(term) >= 3:
+            sets = [self._trigrams.get(t) for t in _trigrams(term)]
+            if all(sets):
+                sets.sort(key=len)
+                candidates = set.intersection(*sets)
+                matches.update(obj for obj in candidates - matches if any(
+                    term in self._texts[obj][f] for f in fields))
+
+        return matches
+
+    def search(self, query):
+        """Find the submissions matching a query.
+
+        Args:
+            query (str): Space separated terms, optionally prefixed with a
+                field name and a colon
+
+        Returns:
+            set: The matching submissions, None if the query is empty
+        """
+        result = None
+
+        for term in query.lower().split():
+            field = None
+            if ":" in term:
+                name, value = term.split(":", 1)
+                name = FIELD_ALIASES.get(name, name)
+                if name in FIELDS:
+                    if not value:
+                        # Still being typed
+                        continue
+                    field, term = name, value
+
+            matches = self._match_term(field, term)
+            result = matches if result is None else result & matches
+
+            if not result:
+                return set()
+
+        return result
+
+    def folders_of(self, objs):
+        """Get the folders the given submissions are shown in.
+
+        Args:
+            objs: The submissions
+
+        Returns:
+            list: The folders, parents before children
+        """
+        return [folder for folder, members in self._members.items()
+                if not members.isdisjoint(objs)]
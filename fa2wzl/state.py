@@ -0,0 +1,98 @@
+import threading
+from types import MappingProxyType
+
+
+class MigrationState(object):
+    """An immutable snapshot of what will be migrated where.
+
+    Changes are made by creating a new snapshot with replace(), so a
+    snapshot can be read from any thread without locking.
+
+    Attributes:
+        folder_mapping: Read-only dict of FA folders to Weasyl folders
+        submission_mapping: Read-only dict of FA submissions to the Weasyl
+            submissions they were already uploaded as
+        submission_folders: Read-only dict of new FA submissions to the
+            Weasyl folders they will be created in
+        excluded_submissions: Frozen set of IDs of FA submissions that will
+            not be created
+    """
+
+    __slots__ = ("folder_mapping", "submission_mapping",
+                 "submission_folders", "excluded_submissions")
+
+    def __init__(self, folder_mapping=None, submission_mapping=None,
+                 submission_folders=None, excluded_submissions=()):
+        set_ = object.__setattr__
+        set_(self, "folder_mapping",
+             MappingProxyType(dict(folder_mapping or {})))
+        set_(self, "submission_mapping",
+             MappingProxyType(dict(submission_mapping or {})))
+        set_(self, "submission_folders",
+             MappingProxyType(dict(submission_folders or {})))
+        set_(self, "excluded_submissions", frozenset(excluded_submissions))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MigrationState is immutable")
+
+    def replace(self, **changes):
+        """Create a copy with some fields replaced.
+
+        Args:
+            **changes: New values of fields
+
+        Returns:
+            MigrationState: The new snapshot
+        """
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return MigrationState(**fields)
+
+    def __repr__(self):
+        return "<MigrationState: %d folders, %d submissions mapped, " \
+               "%d excluded>" % (len(self.folder_mapping),
+                                 len(self.submission_mapping),
+                                 len(self.excluded_submissions))
+
+
+class StateStore(object):
+    """Holds the current MigrationState.
+
+    Readers take a snapshot and keep using it without locking. Writers
+    derive a new snapshot from the current one under a short lock, so
+    concurrent changes are never lost.
+    """
+
+    def __init__(self, state=None):
+        self._lock = threading.Lock()
+        self._state = state if state is not None else MigrationState()
+
+    @property
+    def snapshot(self):
+        """MigrationState: The current state"""
+        return self._state
+
+    def update(self, func):
+        """Replace the state with one derived from the current state.
+
+        Args:
+            func: Callable taking the current state, returning the new state.
+                It must be quick, as it runs while holding the lock.
+
+        Returns:
+            MigrationState: The new state
+        """
+        with self._lock:
+            self._state = func(self._state)
+            return self._state
+
+    def replace(self, **changes):
+        """Replace some fields of the state.
+
+        Args:
+            **changes: New values of fields
+
+        Returns:
+            MigrationState: The new state
+        """
+        return self.update(lambda state: state.replace(**changes))
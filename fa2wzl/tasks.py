@@ -0,0 +1,236 @@
+import heapq
+import itertools
+import threading
+
+from PyQt5 import QtCore
+
+from fa2wzl import constants
+from fa2wzl.logging import logger
+
+PRIORITY_HIGH = 0
+"""int: Priority of tasks the user is waiting on, e.g. the shown preview"""
+
+PRIORITY_NORMAL = 1
+"""int: Priority of ordinary tasks"""
+
+PRIORITY_LOW = 2
+"""int: Priority of speculative work such as prefetching"""
+
+
+class Task(object):
+    """A unit of work submitted to a TaskRunner.
+
+    Attributes:
+        key: Identifies duplicate requests, None if never coalesced
+        priority (int): Lower numbers run first
+        func: Callable doing the work
+    """
+
+    def __init__(self, key, priority, func):
+        self.key = key
+        self.priority = priority
+        self.func = func
+
+        self._callbacks = []
+        self._errbacks = []
+        self._cancelled = threading.Event()
+        self._started = False
+
+    @property
+    def cancelled(self):
+        """bool: Whether the task was cancelled"""
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Cancel the task.
+
+        A task that has not started yet is never run. A running task keeps
+        running unless it checks cancelled, but its result is discarded.
+        """
+        self._cancelled.set()
+
+    def __repr__(self):
+        return "<Task %r>" % (self.key,)
+
+
+class TaskRunner(QtCore.QObject):
+    """Runs background tasks on a fixed number of threads.
+
+    Pending tasks run in priority order. Submitting a task with the key of
+    one that is already pending or running returns the existing task rather
+    than queuing the work again. Results are delivered on the thread that
+    owns the runner, normally the UI thread.
+    """
+
+    _task_finished = QtCore.pyqtSignal(object, object, object)
+
+    def __init__(self, workers=constants.GUI_TASK_WORKERS, parent=None):
+        """Create a task runner and start its threads.
+
+        Args:
+            workers (int): Maximum number of tasks running at once
+            parent (QObject, optional): The Qt parent
+        """
+        super(TaskRunner, self).__init__(parent)
+
+        self._condition = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        self._active = {}
+        self._local = threading.local()
+        self._stopping = False
+
+        self._task_finished.connect(self._deliver)
+
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, daemon=True,
+                                      name="TaskRunner-%d" % i)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, key=None, priority=PRIORITY_NORMAL, on_done=None,
+               on_error=None):
+        """Queue a task.
+
+        Args:
+            func: Callable doing the work, called without arguments
+            key (optional): Coalesces the task with a pending or running one
+            priority (int): Lower numbers run first
+            on_done (optional): Called with the result on the runner's thread
+            on_error (optional): Called with the exception on the runner's
+                thread, otherwise the exception is logged
+
+        Returns:
+            Task: The queued task, or the existing task with the same key
+        """
+        with self._condition:
+            task = self._active.get(key) if key is not None else None
+
+            if task is None or task.cancelled:
+                task = Task(key, priority, func)
+                if key is not None:
+                    self._active[key] = task
+                self._push(task)
+            elif priority < task.priority and not task._started:
+                # Requeue ahead; the stale queue entry is skipped
+                task.priority = priority
+                self._push(task)
+
+            if on_done is not None:
+                task._callbacks.append(on_done)
+            if on_error is not None:
+                task._errbacks.append(on_error)
+
+        return task
+
+    def current_task(self):
+        """Get the task running on the calling thread.
+
+        Returns:
+            Task: The task, or None outside of a task
+        """
+        return getattr(self._local, "task", None)
+
+    def cancel(self, key):
+        """Cancel the pending or running task with a key.
+
+        Args:
+            key: The task key
+        """
+        with self._condition:
+            task = self._active.pop(key, None)
+
+        if task is not None:
+            task.cancel()
+
+    def cancel_all(self):
+        """Cancel every pending and running task.
+        """
+        with self._condition:
+            tasks = [entry[2] for entry in self._queue]
+            tasks.extend(self._active.values())
+            self._active.clear()
+
+        for task in tasks:
+            task.cancel()
+
+    def shutdown(self, wait=True):
+        """Cancel all tasks and stop the threads.
+
+        Args:
+            wait (bool): Whether to wait for running tasks to return
+        """
+        self.cancel_all()
+
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _push(self, task):
+        heapq.heappush(self._queue,
+                       (task.priority, next(self._counter), task))
+        self._condition.notify()
+
+    def _next(self):
+        with self._condition:
+            while True:
+                if self._stopping:
+                    return None
+
+                while self._queue:
+                    priority, _, task = heapq.heappop(self._queue)
+
+                    if task._started or priority != task.priority:
+                        continue
+
+                    if task.cancelled:
+                        self._forget(task)
+                        continue
+
+                    task._started = True
+                    return task
+
+                self._condition.wait()
+
+    def _forget(self, task):
+        if task.key is not None and self._active.get(task.key) is task:
+            del self._active[task.key]
+
+    def _run(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+
+            self._local.task = task
+
+            result = error = None
+            try:
+                result = task.func()
+            except Exception as e:
+                error = e
+            finally:
+                self._local.task = None
+
+            with self._condition:
+                self._forget(task)
+
+            self._task_finished.emit(task, result, error)
+
+    def _deliver(self, task, result, error):
+        if task.cancelled:
+            return
+
+        if error is not None:
+            if not task._errbacks:
+                logger.error("Task %r failed: %r" % (task.key, error))
+            for errback in task._errbacks:
+                errback(error)
+        else:
+            for callback in task._callbacks:
+                callback(result)
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from fa2wzl import constants
+from fa2wzl.logging import logger
+
+
+def default_cache_dir():
+    """Get the default directory for cached thumbnails.
+
+    Returns:
+        str: The directory path
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "fa2wzl", "thumbnails")
+
+
+class ThumbnailCache(object):
+    """A thread-safe cache of thumbnail bytes by URL.
+
+    Recently used thumbnails are kept in memory; if a directory is given,
+    every thumbnail is also kept on disk across runs.
+    """
+
+    def __init__(self, directory=None,
+                 max_items=constants.THUMBNAIL_CACHE_ITEMS):
+        """Create a thumbnail cache.
+
+        Args:
+            directory (str, optional): Where to store thumbnails on disk
+            max_items (int): Thumbnails to keep in memory
+        """
+        self.directory = directory
+        self.max_items = max_items
+
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _remember(self, url, data):
+        with self._lock:
+            self._items[url] = data
+            self._items.move_to_end(url)
+
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get(self, url):
+        """Get a cached thumbnail.
+
+        Args:
+            url (str): The thumbnail URL
+
+        Returns:
+            bytes: The thumbnail, or None if it is not cached
+        """
+        with self._lock:
+            data = self._items.get(url)
+            if data is not None:
+                self._items.move_to_end(url)
+                return data
+
+        if self.directory is None:
+            return None
+
+        try:
+            with open(self._path(url), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        self._remember(url, data)
+        return data
+
+    def put(self, url, data):
+        """Add a thumbnail to the cache.
+
+        Args:
+            url (str): The thumbnail URL
+            data (bytes): The thumbnail
+        """
+        self._remember(url, data)
+
+        if self.directory is None:
+            return
+
+        # Write to a temporary file first so readers never see half a file
+        path = self._path(url)
+        tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.debug("Could not cache thumbnail %s: %s" % (url, e))
+
+    def fetch(self, url, fetch_func):
+        """Get a thumbnail from the cache, downloading it if needed.
+
+        Args:
+            url (str): The thumbnail URL
+            fetch_func: Callable that downloads a URL and returns its bytes
+
+        Returns:
+            bytes: The thumbnail
+        """
+        data = self.get(url)
+        if data is None:
+            data = fetch_func(url)
+            self.put(url, data)
+        return data
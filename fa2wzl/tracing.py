@@ -0,0 +1,283 @@
+import cProfile
+import heapq
+import io
+import itertools
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import time
+
+from fa2wzl.logging import logger
+
+# tracemalloc is global to the process, while memory stages may run on
+# several threads and tracers at once
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_started = False
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_started
+
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_started = True
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_started
+
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        # Tracing started by someone else is left running
+        if _tracemalloc_users == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+            _tracemalloc_started = False
+
+
+class Span(object):
+    """A timed section of work.
+
+    Attributes:
+        name (str): The span name
+        path (str): Names of the enclosing spans and this one, joined by "/"
+        attrs: Dict of extra information, e.g. a submission ID
+        start (float): Monotonic start time
+        end (float): Monotonic end time, None while running
+    """
+
+    def __init__(self, name, path, attrs):
+        self.name = name
+        self.path = path
+        self.attrs = attrs
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.monotonic()
+        return end - self.start
+
+    def __repr__(self):
+        return "<Span %r: %.3fs>" % (self.path, self.duration)
+
+
+class _Aggregate(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class Tracer(object):
+    """Collects nested timing spans and optional profiles.
+
+    Spans nest per thread. Durations are aggregated by span path, so a run
+    over thousands of submissions stays small in memory.
+
+    Attributes:
+        profile_stages: Span names to run under cProfile
+        memory_stages: Span names to run under tracemalloc
+        report_path (str): Where write_report writes by default
+    """
+
+    SLOWEST = 10
+    """int: How many of the slowest individual spans to keep"""
+
+    def __init__(self, profile_stages=(), memory_stages=(), report_path=None):
+        """Create a tracer.
+
+        Args:
+            profile_stages: Span names to capture a cProfile profile for
+            memory_stages: Span names to capture allocations for
+            report_path (str, optional): Default file for the report
+        """
+        self.profile_stages = set(profile_stages)
+        self.memory_stages = set(memory_stages)
+        self.report_path = report_path
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._aggregates = {}
+        self._slowest = []
+        self._counter = itertools.count()
+        self._profiles = {}
+        self._memory = {}
+        self._profiling = False
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def current(self):
+        """Span: The innermost running span of this thread, or None"""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time a block of code.
+
+        Args:
+            name (str): The span name
+            **attrs: Extra information to keep with the span
+
+        Yields:
+            Span: The running span
+        """
+        stack = self._stack()
+        path = stack[-1].path + "/" + name if stack else name
+        span = Span(name, path, attrs)
+
+        profiler = None
+        with self._lock:
+            if name in self.profile_stages and not self._profiling:
+                # Only one profiler may be active at a time
+                self._profiling = True
+                profiler = cProfile.Profile()
+
+        memory_before = None
+        if name in self.memory_stages:
+            _start_tracemalloc()
+            memory_before = tracemalloc.take_snapshot()
+
+        stack.append(span)
+
+        if profiler is not None:
+            profiler.enable()
+
+        try:
+            yield span
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._add_profile(path, profiler)
+
+            if memory_before is not None:
+                try:
+                    self._add_memory(path, memory_before)
+                finally:
+                    _stop_tracemalloc()
+
+            span.end = time.monotonic()
+            stack.pop()
+            self._finish(span)
+
+    def _finish(self, span):
+        duration = span.duration
+
+        with self._lock:
+            aggregate = self._aggregates.get(span.path)
+            if aggregate is None:
+                aggregate = _Aggregate()
+                self._aggregates[span.path] = aggregate
+            aggregate.add(duration)
+
+            entry = (duration, next(self._counter), span)
+            if len(self._slowest) < self.SLOWEST:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+
+    def _add_profile(self, path, profiler):
+        with self._lock:
+            self._profiling = False
+
+            stats = self._profiles.get(path)
+            if stats is None:
+                self._profiles[path] = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+
+    def _add_memory(self, path, before):
+        after = tracemalloc.take_snapshot()
+        diff = after.compare_to(before, "lineno")
+        _, peak = tracemalloc.get_traced_memory()
+
+        with self._lock:
+            self._memory[path] = (diff[:10], peak)
+
+    def summary(self):
+        """Get aggregated span timings.
+
+        Returns:
+            dict: Span paths mapped to dicts with count, total, mean and max
+        """
+        with self._lock:
+            return {path: {
+                "count": a.count,
+                "total": a.total,
+                "mean": a.total / a.count,
+                "max": a.max,
+            } for path, a in self._aggregates.items()}
+
+    def report(self):
+        """Render a human-readable report of everything recorded.
+
+        Returns:
+            str: The report
+        """
+        summary = self.summary()
+        out = io.StringIO()
+
+        roots = sum(s["total"] for p, s in summary.items() if "/" not in p)
+
+        out.write("%-50s %8s %12s %10s %10s %6s\n" % (
+            "Span", "Count", "Total (s)", "Mean (s)", "Max (s)", "%"))
+
+        for path in sorted(summary):
+            s = summary[path]
+            share = 100 * s["total"] / roots if roots else 0
+            name = "  " * path.count("/") + path.rsplit("/", 1)[-1]
+            out.write("%-50s %8d %12.3f %10.3f %10.3f %6.1f\n" % (
+                name, s["count"], s["total"], s["mean"], s["max"], share))
+
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+            profiles = dict(self._profiles)
+            memory = dict(self._memory)
+
+        if slowest:
+            out.write("\nSlowest spans:\n")
+            for duration, _, span in slowest:
+                out.write("  %10.3fs  %s %r\n" % (duration, span.path,
+                                                   span.attrs))
+
+        for path, stats in sorted(profiles.items()):
+            out.write("\nProfile of %s:\n" % path)
+            stats.stream = out
+            stats.sort_stats("cumulative").print_stats(25)
+
+        for path, (diff, peak) in sorted(memory.items()):
+            out.write("\nAllocations in %s (peak %d KiB):\n" % (
+                path, peak // 1024))
+            for stat in diff:
+                out.write("  %s\n" % stat)
+
+        return out.getvalue()
+
+    def write_report(self, path=None):
+        """Write the report to a file.
+
+        Args:
+            path (str, optional): The file to write, defaults to report_path
+        """
+        path = path if path is not None else self.report_path
+        if path is None:
+            return
+
+        with open(path, "w") as f:
+            f.write(self.report())
+
+        logger.info("Wrote trace report to %s" % path)
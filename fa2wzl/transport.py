@@ -0,0 +1,283 @@
+import email.utils
+import random
+import threading
+from urllib.parse import urlparse
+
+import requests
+import time
+from requests.adapters import HTTPAdapter
+
+from fa2wzl import constants, exceptions, metrics as metrics_module
+from fa2wzl.logging import logger
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+"""frozenset: HTTP methods that are safe to send more than once"""
+
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+"""frozenset: Response codes that are treated as transient failures"""
+
+
+def retry_after(res, default):
+    """Get the delay a response asks for in its Retry-After header.
+
+    Args:
+        res: The response
+        default (float): Seconds to use if the header is missing or invalid
+
+    Returns:
+        float: The number of seconds to wait
+    """
+    value = res.headers.get("Retry-After")
+
+    if value is None:
+        return default
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+
+    if when is None:
+        return default
+
+    return max(0.0, when.timestamp() - time.time())
+
+
+class CircuitBreaker(object):
+    """Refuses requests to a host after repeated consecutive failures.
+
+    After ``threshold`` failures in a row the circuit opens and requests are
+    refused. Once ``reset_seconds`` have passed a single trial request is let
+    through; if it succeeds the circuit closes again. A request counts once,
+    however many times it was retried.
+    """
+
+    def __init__(self, threshold=constants.CIRCUIT_BREAKER_THRESHOLD,
+                 reset_seconds=constants.CIRCUIT_BREAKER_RESET_SECONDS):
+        """Create a circuit breaker.
+
+        Args:
+            threshold (int): Consecutive failures before opening
+            reset_seconds (float): Seconds to wait before a trial request
+        """
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def before_request(self):
+        """Check whether a request may be sent.
+
+        Returns:
+            bool: Whether it is the trial request of an open circuit
+
+        Raises:
+            CircuitOpenError: If the circuit is open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+
+            elapsed = time.monotonic() - self._opened_at
+
+            if elapsed < self.reset_seconds or self._trial_in_flight:
+                raise exceptions.CircuitOpenError()
+
+            self._trial_in_flight = True
+            return True
+
+    def release(self):
+        """Let another trial through after the trial request ended without
+        an outcome, e.g. with an error that says nothing about the host."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+
+            if self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+class Transport(requests.Session):
+    """A requests session with timeouts, retries and circuit breaking.
+
+    Idempotent requests that fail with a connection error, a timeout or a
+    transient server error are retried with jittered exponential backoff.
+    Every request goes through a circuit breaker for its host.
+    """
+
+    def __init__(self,
+                 connect_timeout=constants.HTTP_CONNECT_TIMEOUT,
+                 read_timeout=constants.HTTP_READ_TIMEOUT,
+                 max_retries=constants.HTTP_MAX_RETRIES,
+                 backoff_base=constants.HTTP_BACKOFF_BASE,
+                 backoff_max=constants.HTTP_BACKOFF_MAX,
+                 pool_connections=constants.HTTP_POOL_CONNECTIONS,
+                 pool_maxsize=constants.HTTP_POOL_MAXSIZE,
+                 metrics=None, adapter=None):
+        """Create a transport.
+
+        Args:
+            connect_timeout (float): Seconds to wait for a connection
+            read_timeout (float): Seconds to wait for data from the server
+            max_retries (int): Retries for failed idempotent requests
+            backoff_base (float): Base delay for exponential backoff
+            backoff_max (float): Maximum delay between two attempts
+            pool_connections (int): Number of per-host pools to keep
+            pool_maxsize (int): Maximum open connections per host
+            metrics (Metrics, optional): Where to record request metrics,
+                defaults to the shared registry
+            adapter (HTTPAdapter, optional): Adapter to share connection
+                pools with other transports, overrides the pool sizes
+        """
+        super(Transport, self).__init__()
+
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = metrics if metrics is not None \
+            else metrics_module.registry
+
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+        if adapter is None:
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def breaker(self, url):
+        """Get the circuit breaker for the host of a URL.
+
+        Args:
+            url (str): The URL
+
+        Returns:
+            CircuitBreaker: The breaker for the URL's host
+        """
+        host = urlparse(url).netloc
+
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker()
+                self._breakers[host] = breaker
+
+        return breaker
+
+    def backoff(self, attempt):
+        """Return the delay before the given retry attempt.
+
+        Args:
+            attempt (int): The zero-based retry number
+
+        Returns:
+            float: A randomized delay in seconds
+        """
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def _record(self, endpoint, res, seconds):
+        if res.request is not None and res.request.body is not None:
+            bytes_out = len(res.request.body)
+        else:
+            bytes_out = 0
+
+        if res.raw is None or res._content_consumed:
+            bytes_in = len(res.content or b"")
+        else:
+            # Streamed responses are not read here
+            bytes_in = int(res.headers.get("Content-Length", 0))
+
+        self.metrics.record_request(endpoint, res.status_code, seconds,
+                                    bytes_in, bytes_out)
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        """Send a request.
+
+        Args:
+            method (str): The HTTP method
+            url (str): The URL
+            endpoint (str, optional): Logical endpoint name for metrics,
+                defaults to the URL's host
+
+        Returns:
+            The response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+
+        if endpoint is None:
+            endpoint = urlparse(url).netloc
+
+        breaker = self.breaker(url)
+        retries = self.max_retries if method.upper() in IDEMPOTENT_METHODS \
+            else 0
+
+        # The retries are one request to the breaker, so a trial request
+        # keeps its place while retried
+        trial = breaker.before_request()
+        try:
+            return self._send(method, url, endpoint, breaker, retries,
+                              **kwargs)
+        finally:
+            if trial:
+                breaker.release()
+
+    def _send(self, method, url, endpoint, breaker, retries, **kwargs):
+        attempt = 0
+        while True:
+            start = time.monotonic()
+
+            try:
+                res = super(Transport, self).request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.metrics.record_error(endpoint, time.monotonic() - start)
+
+                if attempt >= retries:
+                    breaker.record_failure()
+                    raise
+
+                logger.debug("%s %s failed (%s), retrying" % (method, url, e))
+            else:
+                self._record(endpoint, res, time.monotonic() - start)
+
+                if res.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    return res
+
+                if attempt >= retries:
+                    breaker.record_failure()
+                    return res
+
+                logger.debug("%s %s returned %d, retrying" % (
+                    method, url, res.status_code))
+
+                # Streamed responses would keep their connection otherwise
+                res.close()
+
+            time.sleep(self.backoff(attempt))
+            attempt += 1
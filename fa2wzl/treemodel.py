@@ -0,0 +1,926 @@
+import json
+
+from PyQt5 import QtCore, QtGui
+
+from fa2wzl import constants
+from fa2wzl.fa.models import Folder as FAFolder, Submission as FASubmission
+from fa2wzl.mapping import loaded_value
+from fa2wzl.wzl.models import Folder as WZLFolder
+
+NEW_COLOR = QtGui.QColor(0, 150, 0)
+"""QColor: Text color of items that will be created"""
+
+FIXED_FLAGS = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsDropEnabled
+"""Flags of items that cannot be selected or dragged"""
+
+MOVABLE_FLAGS = FIXED_FLAGS | QtCore.Qt.ItemIsSelectable | \
+                QtCore.Qt.ItemIsDragEnabled
+"""Flags of items that can be selected and dragged"""
+
+SELECTABLE_FLAGS = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+"""Flags of read-only items that can be selected"""
+
+FOLDERS_MIME_TYPE = "application/x-fa2wzl-folders"
+SUBMISSIONS_MIME_TYPE = "application/x-fa2wzl-submissions"
+
+
+class TreeNode(object):
+    """A row in a TreeModel.
+
+    Attributes:
+        obj: The folder or submission shown in this row, may be None
+        texts: List of strings, one per column
+        flags: The Qt item flags
+        foreground (QColor): Optional text color of the first column
+        loader: Callable returning the children, until they are loaded
+        parent (TreeNode): The parent node
+        children: List of loaded child nodes
+    """
+
+    def __init__(self, obj, texts, flags, foreground=None, loader=None):
+        self.obj = obj
+        self.texts = texts
+        self.flags = flags
+        self.foreground = foreground
+        self.loader = loader
+        self.parent = None
+        self.children = []
+
+        # Rows are kept on the children, as Qt asks for them all the time;
+        # those from _stale on are renumbered when next asked for
+        self._row = 0
+        self._stale = None
+
+    def append(self, node):
+        node.parent = self
+        node._row = len(self.children)
+        self.children.append(node)
+
+    def remove(self, row):
+        """Remove a child.
+
+        Args:
+            row (int): The row of the child
+
+        Returns:
+            TreeNode: The removed child
+        """
+        node = self.children.pop(row)
+        node.parent = None
+        if row < len(self.children):
+            self._stale = row if self._stale is None \
+                else min(self._stale, row)
+        return node
+
+    def clear(self):
+        """Remove all children."""
+        self.children = []
+        self._stale = None
+
+    def row(self):
+        parent = self.parent
+        if parent._stale is not None:
+            for row in range(parent._stale, len(parent.children)):
+                parent.children[row]._row = row
+            parent._stale = None
+        return self._row
+
+
+class TreeModel(QtCore.QAbstractItemModel):
+    """A read-only tree of TreeNodes with lazily loaded children.
+
+    The folder or submission of a row is available through the UserRole.
+    """
+
+    def __init__(self, headers, parent=None):
+        super(TreeModel, self).__init__(parent)
+        self.headers = headers
+        self.root = TreeNode(None, [], QtCore.Qt.ItemIsDropEnabled)
+        self.nodes = {}
+        self._parents = {}
+
+    def _make(self, obj, texts, flags, foreground=None, loader=None):
+        node = TreeNode(obj, texts, flags, foreground, loader)
+        if obj is not None:
+            self.nodes[obj] = node
+        return node
+
+    def _reset(self, nodes):
+        self.beginResetModel()
+        self.root.clear()
+        for node in nodes:
+            self.root.append(node)
+        self.endResetModel()
+
+    def _insert(self, parent, node):
+        self._insert_many(parent, [node])
+
+    def _insert_many(self, parent, nodes):
+        if not nodes:
+            return
+
+        first = len(parent.children)
+        self.beginInsertRows(self.index_of(parent), first,
+                             first + len(nodes) - 1)
+        for node in nodes:
+            parent.append(node)
+        self.endInsertRows()
+
+    def _remove(self, node):
+        parent = node.parent
+        if parent is None:
+            return
+
+        row = node.row()
+        self.beginRemoveRows(self.index_of(parent), row, row)
+        parent.remove(row)
+        self.endRemoveRows()
+
+    def _move(self, node, parent):
+        source = node.parent
+        row = node.row()
+        self.beginMoveRows(self.index_of(source), row, row,
+                           self.index_of(parent), len(parent.children))
+        source.remove(row)
+        parent.append(node)
+        self.endMoveRows()
+
+    def _with_parents(self, folders):
+        # The folders with their parents, parents before their children
+        result = []
+        for folder in folders:
+            parent = self._parents.get(folder)
+            for f in ([folder] if parent is None else [parent, folder]):
+                if f not in result:
+                    result.append(f)
+        return result
+
+    def _loaded(self, obj):
+        """Get the node of an object if its children are loaded.
+
+        Args:
+            obj: The object, None for the root
+
+        Returns:
+            TreeNode: The node, or None if there is no loaded node
+        """
+        node = self.root if obj is None else self.nodes.get(obj)
+        if node is None or node.loader is not None:
+            return None
+        return node
+
+    def node(self, index):
+        if index.isValid():
+            return index.internalPointer()
+        return self.root
+
+    def object(self, index):
+        return self.node(index).obj
+
+    def index_of(self, node, column=0):
+        if node is None or node is self.root:
+            return QtCore.QModelIndex()
+        return self.createIndex(node.row(), column, node)
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QtCore.QModelIndex()
+
+        return self.createIndex(row, column, self.node(parent).children[row])
+
+    def parent(self, index=None):
+        if index is None:
+            return super(TreeModel, self).parent()
+
+        if not index.isValid():
+            return QtCore.QModelIndex()
+
+        return self.index_of(index.internalPointer().parent)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self.node(parent).children)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        node = index.internalPointer()
+        column = index.column()
+
+        if role == QtCore.Qt.DisplayRole:
+            if column < len(node.texts):
+                return node.texts[column]
+            return ""
+        elif role == QtCore.Qt.ForegroundRole:
+            if column == 0 and node.foreground is not None:
+                return QtGui.QBrush(node.foreground)
+        elif role == QtCore.Qt.UserRole:
+            return node.obj
+
+        return None
+
+    def flags(self, index):
+        return self.node(index).flags
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and \
+                role == QtCore.Qt.DisplayRole and section < len(self.headers):
+            return self.headers[section]
+        return None
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        node = self.node(parent)
+        return node.loader is not None or len(node.children) > 0
+
+    def canFetchMore(self, parent):
+        return self.node(parent).loader is not None
+
+    def fetchMore(self, parent):
+        node = self.node(parent)
+        if node.loader is None:
+            return
+
+        children = node.loader()
+        node.loader = None
+
+        self._insert_many(node, children)
+
+    def supportedDropActions(self):
+        return QtCore.Qt.MoveAction | QtCore.Qt.CopyAction
+
+
+class FilterProxyModel(QtCore.QSortFilterProxyModel):
+    """Shows only the rows of a TreeModel matching a search.
+
+    Rows of other objects than submissions, such as "Gallery", are always
+    shown. Folders are shown if they were given as containing matches, as
+    their children may not be loaded yet.
+
+    When a change shows or hides only a few rows, as when a search is
+    narrowed while typing, just those rows are filtered again.
+    """
+
+    def __init__(self, parent=None):
+        super(FilterProxyModel, self).__init__(parent)
+
+        self._visible = None
+
+    def set_matches(self, matches, folders=()):
+        """Change which rows are shown.
+
+        Args:
+            matches: Set of the submissions to show, None to show all rows
+            folders: The folders containing them
+        """
+        old = self._visible
+        self._visible = None if matches is None else \
+            set(matches).union(folders, [None])
+
+        if old is None and self._visible is None:
+            return
+
+        if old is None or self._visible is None:
+            self.invalidate()
+            return
+
+        source = self.sourceModel()
+        changed = [source.nodes[obj] for obj in old ^ self._visible
+                   if obj in source.nodes]
+
+        # Changing rows one at a time is only quicker for a few of them
+        if len(changed) > constants.FILTER_INCREMENTAL_ROWS:
+            self.invalidate()
+            return
+
+        by_parent = {}
+        for node in changed:
+            if node.parent is not None:
+                by_parent.setdefault(node.parent, []).append(node)
+
+        for parent, nodes in by_parent.items():
+            rows = {id(child): row for row, child in
+                    enumerate(parent.children)}
+            parent_index = source.index_of(parent)
+
+            for node in nodes:
+                index = source.index(rows[id(node)], 0, parent_index)
+                source.dataChanged.emit(index, index)
+
+    def object(self, index):
+        return self.sourceModel().object(self.mapToSource(index))
+
+    def index_of(self, node, column=0):
+        return self.mapFromSource(self.sourceModel().index_of(node, column))
+
+    def filterAcceptsRow(self, row, parent):
+        # Called for every row when refiltering, so kept to the minimum
+        visible = self._visible
+        if visible is None:
+            return True
+
+        node = parent.internalPointer() or self.sourceModel().root
+        return node.children[row].obj in visible
+
+
+class FAFolderModel(TreeModel):
+    """The FA folder structure.
+    """
+
+    def __init__(self, parent=None):
+        super(FAFolderModel, self).__init__(["Folder Name"], parent)
+
+    def populate(self, fa_folders):
+        """Replace the contents of the model.
+
+        Args:
+            fa_folders: List of FA root folders
+        """
+        self.nodes = {}
+        nodes = []
+
+        for folder in fa_folders:
+            node = self._make(folder, [folder.title], FIXED_FLAGS)
+            nodes.append(node)
+
+            for subfolder in folder.children:
+                node.append(self._make(subfolder, [subfolder.title],
+                                       FIXED_FLAGS))
+
+        self._reset(nodes)
+
+
+class WZLFolderModel(TreeModel):
+    """The resulting Weasyl folder structure.
+
+    Existing Weasyl folders show which FA folders are mapped onto them.
+    FA folders that will be created can be dropped onto Weasyl folders.
+    """
+
+    folder_dropped = QtCore.pyqtSignal(int, WZLFolder, name="folderDropped")
+
+    def __init__(self, parent=None):
+        super(WZLFolderModel, self).__init__(["Folder Name", "FA Folders"],
+                                             parent)
+
+        self._mapped_titles = {}
+
+    def populate(self, fa_folders, wzl_folders, folder_mapping):
+        """Replace the contents of the model.
+
+        Args:
+            fa_folders: List of FA root folders
+            wzl_folders: List of Weasyl root folders
+            folder_mapping: Dict of FA folders to Weasyl folders
+        """
+        self.nodes = {}
+        nodes = []
+
+        # Inverse index, so each Weasyl folder is a single lookup
+        mapped_titles = {}
+        for fa_folder, wzl_folder in folder_mapping.items():
+            mapped_titles.setdefault(wzl_folder, []).append(fa_folder.title)
+
+        self._mapped_titles = mapped_titles
+
+        def wzl_node(folder):
+            titles = ", ".join(mapped_titles.get(folder, []))
+            return self._make(folder, [folder.title, titles], FIXED_FLAGS)
+
+        def new_node(folder):
+            return self._make(folder, [folder.title + "*"], MOVABLE_FLAGS,
+                              NEW_COLOR)
+
+        for folder in wzl_folders:
+            node = wzl_node(folder)
+            nodes.append(node)
+
+            for subfolder in folder.children:
+                node.append(wzl_node(subfolder))
+
+        # Populate unmapped folders
+        for folder in fa_folders:
+            node = None
+            if folder in folder_mapping:
+                node = self.nodes.get(folder_mapping[folder])
+
+            if node is None:
+                node = new_node(folder)
+                nodes.append(node)
+
+            for subfolder in folder.children:
+                if subfolder not in folder_mapping:
+                    node.append(new_node(subfolder))
+
+        self._reset(nodes)
+
+    def map_folder(self, fa_folder, wzl_folder):
+        """Show a new FA folder as merged into a Weasyl folder.
+
+        Only the affected rows are changed.
+
+        Args:
+            fa_folder: The FA folder that will no longer be created
+            wzl_folder: The Weasyl folder it is mapped to
+        """
+        titles = self._mapped_titles.setdefault(wzl_folder, [])
+        titles.append(fa_folder.title)
+
+        target = self.nodes.get(wzl_folder)
+        if target is not None:
+            target.texts[1] = ", ".join(titles)
+            index = self.index_of(target, 1)
+            self.dataChanged.emit(index, index)
+
+        node = self.nodes.get(fa_folder)
+        if node is None or node.obj is not fa_folder:
+            return
+
+        # Unmapped subfolders are shown in the folder they are mapped into
+        if target is not None:
+            for child in list(node.children):
+                self._move(child, target)
+
+        self._remove(node)
+        del self.nodes[fa_folder]
+
+    def mimeTypes(self):
+        return [FOLDERS_MIME_TYPE]
+
+    def mimeData(self, indexes):
+        data = []
+
+        for index in indexes:
+            folder = self.object(index)
+            if index.column() == 0 and isinstance(folder, FAFolder):
+                data.append(folder.id)
+
+        md = QtCore.QMimeData()
+        md.setData(FOLDERS_MIME_TYPE, json.dumps(data).encode("utf-8"))
+
+        return md
+
+    def dropMimeData(self, mdata, action, row, column, parent):
+        text = bytes(mdata.data(FOLDERS_MIME_TYPE)).decode("utf-8")
+
+        if not text:
+            return False
+
+        folder = self.object(parent)
+        if not isinstance(folder, WZLFolder):
+            return False
+
+        data = json.loads(text)
+
+        if len(data) != 1:
+            return False
+
+        self.folder_dropped.emit(data[0], folder)
+
+        return True
+
+
+class FASubmissionModel(TreeModel):
+    """The FA gallery and scraps, with the gallery's folders.
+
+    Listings still being scanned can be added to with add_submissions.
+    """
+
+    def __init__(self, parent=None):
+        super(FASubmissionModel, self).__init__(["Submission Title"], parent)
+
+        self._listings = {}
+        self._listing_nodes = {}
+        self._memberships = {}
+
+    def _submission_node(self, submission):
+        return self._make(submission, [submission.title], SELECTABLE_FLAGS)
+
+    def _folder_node(self, folder):
+        # Folders not scanned yet start empty and are filled in later
+        self._listings[folder] = list(
+            loaded_value(folder, "submissions", []))
+
+        def load():
+            children = [self._submission_node(s) for s in
+                        self._listings[folder]]
+            children.extend(self._folder_node(f) for f in folder.children)
+            return children
+
+        return self._make(folder, [folder.title], SELECTABLE_FLAGS,
+                          loader=load)
+
+    def populate(self, fa_folders, gallery, scraps):
+        """Replace the contents of the model.
+
+        Args:
+            fa_folders: List of FA root folders
+            gallery: List of FA gallery submissions found so far
+            scraps: List of FA scraps submissions found so far
+        """
+        self.nodes = {}
+        self._listings = {"gallery": list(gallery), "scraps": list(scraps)}
+
+        self._parents = {}
+        self._memberships = {}
+        for folder in fa_folders:
+            for f in [folder] + list(folder.children):
+                if f is not folder:
+                    self._parents[f] = folder
+                self._add_memberships(f, loaded_value(f, "submissions", []))
+
+        def load_gallery():
+            children = [self._folder_node(f) for f in fa_folders]
+            children.extend(self._submission_node(s) for s in
+                            self._listings["gallery"])
+            return children
+
+        def load_scraps():
+            return [self._submission_node(s) for s in
+                    self._listings["scraps"]]
+
+        self._listing_nodes = {
+            "gallery": self._make(None, ["Gallery"], SELECTABLE_FLAGS,
+                                  loader=load_gallery),
+            "scraps": self._make(None, ["Scraps"], SELECTABLE_FLAGS,
+                                 loader=load_scraps),
+        }
+
+        self._reset([self._listing_nodes["gallery"],
+                     self._listing_nodes["scraps"]])
+
+    def add_submissions(self, listing, submissions):
+        """Add newly scanned submissions.
+
+        Args:
+            listing: "gallery", "scraps" or the FA folder scanned
+            submissions: List of the FA submissions found
+        """
+        if not isinstance(listing, str):
+            self._add_memberships(listing, submissions)
+
+        if listing not in self._listings:
+            return
+
+        # A listing may already have been read when its node was made
+        known = set(self._listings[listing])
+        submissions = [s for s in submissions if s not in known]
+
+        self._listings[listing].extend(submissions)
+
+        if isinstance(listing, str):
+            node = self._listing_nodes[listing]
+        else:
+            node = self.nodes.get(listing)
+
+        if node is not None and node.loader is None:
+            self._insert_many(node, [self._submission_node(s) for s in
+                                     submissions])
+
+    def _add_memberships(self, folder, submissions):
+        for submission in submissions:
+            folders = self._memberships.setdefault(submission, [])
+            if folder not in folders:
+                folders.append(folder)
+
+    def folders_of(self, submission):
+        """Get the folders a submission is shown in.
+
+        Args:
+            submission: The FA submission
+
+        Returns:
+            list: The folders, parents before their children
+        """
+        return self._with_parents(self._memberships.get(submission, []))
+
+
+class WZLSubmissionModel(TreeModel):
+    """The resulting Weasyl gallery.
+
+    Existing Weasyl submissions show the FA submission mapped onto them.
+    FA submissions that will be created can be dragged between folders.
+    """
+
+    submissions_dropped = QtCore.pyqtSignal(list, list,
+                                            name="submissionsDropped")
+
+    def __init__(self, parent=None):
+        super(WZLSubmissionModel, self).__init__(
+            ["Submission Title", "FA Submission"], parent)
+
+        self._fa_submissions = []
+        self._fa_known = set()
+        self._fa_by_wzl = {}
+        self._mapped = set()
+        self._excluded = set()
+        self._folders = set()
+        self._contents = {}
+        self._in_folders = {}
+        self._root_existing = set()
+        self._assigned = {None: []}
+        self._folder_of = {}
+
+    def _wzl_node(self, submission):
+        fa_submission = self._fa_by_wzl.get(submission)
+        fa_title = fa_submission.title if fa_submission is not None else ""
+        return self._make(submission, [submission.title, fa_title],
+                          FIXED_FLAGS)
+
+    def _new_node(self, submission):
+        return self._make(submission, [submission.title + "*"],
+                          MOVABLE_FLAGS, NEW_COLOR)
+
+    def _folder_node(self, folder):
+        def load():
+            children = [self._wzl_node(s) for s in self._contents[folder]]
+            children.extend(self._folder_node(f) for f in folder.children)
+            children.extend(self._new_node(s) for s in
+                            self._assigned.get(folder, []))
+            return children
+
+        return self._make(folder, [folder.title], FIXED_FLAGS, loader=load)
+
+    def populate(self, fa_submissions, wzl_folders, wzl_gallery,
+                 submission_mapping, submission_folders, excluded):
+        """Replace the contents of the model.
+
+        Folder contents are only turned into rows once they are expanded.
+        Submissions still being scanned can be added later with add_new and
+        add_existing.
+
+        Args:
+            fa_submissions: List of FA submissions found so far
+            wzl_folders: List of Weasyl root folders
+            wzl_gallery: List of Weasyl submissions found so far
+            submission_mapping: Dict of FA submissions to Weasyl submissions
+            submission_folders: Dict of new FA submissions to the Weasyl
+                folders they will be created in
+            excluded: IDs of FA submissions that will not be created
+        """
+        self.nodes = {}
+
+        self._fa_submissions = []
+        self._fa_known = set()
+        self._set_mapping(submission_mapping)
+        self._excluded = set(excluded)
+
+        # Folders not scanned yet start empty and are filled in later
+        self._folders = set()
+        self._contents = {}
+        self._parents = {}
+        for folder in wzl_folders:
+            for f in [folder] + list(folder.children):
+                if f is not folder:
+                    self._parents[f] = folder
+                self._folders.add(f)
+                self._contents[f] = list(
+                    loaded_value(f, "submissions", []))
+
+        self._in_folders = {}
+        for folder, submissions in self._contents.items():
+            for submission in submissions:
+                self._in_folders.setdefault(submission, []).append(folder)
+
+        self._root_existing = {s for s in wzl_gallery
+                               if s not in self._in_folders}
+
+        # New submissions by destination folder, None being the root
+        self._assigned = {None: []}
+        self._folder_of = {}
+        self._track_new(fa_submissions, submission_folders)
+
+        nodes = [self._folder_node(f) for f in wzl_folders]
+        nodes.extend(self._wzl_node(s) for s in wzl_gallery
+                     if s in self._root_existing)
+        nodes.extend(self._new_node(s) for s in self._assigned[None])
+
+        self._reset(nodes)
+
+    def _set_mapping(self, submission_mapping):
+        # Inverse index, so each Weasyl submission is a single lookup
+        self._fa_by_wzl = {w: f for f, w in submission_mapping.items()}
+        self._mapped = set(submission_mapping)
+
+    def _track_new(self, fa_submissions, submission_folders):
+        """Record FA submissions, assigning the new ones to folders.
+
+        Returns:
+            dict: The newly assigned submissions by folder
+        """
+        added = {}
+
+        for submission in fa_submissions:
+            if submission not in self._fa_known:
+                self._fa_known.add(submission)
+                self._fa_submissions.append(submission)
+
+            if submission in self._mapped or \
+                    submission.id in self._excluded or \
+                    submission in self._folder_of:
+                continue
+
+            folder = submission_folders.get(submission)
+            if folder not in self._folders:
+                folder = None
+
+            self._assigned.setdefault(folder, []).append(submission)
+            self._folder_of[submission] = folder
+            added.setdefault(folder, []).append(submission)
+
+        return added
+
+    def add_new(self, fa_submissions, submission_folders=None):
+        """Add newly scanned FA submissions.
+
+        Those that are not mapped to existing Weasyl submissions are shown
+        as new ones.
+
+        Args:
+            fa_submissions: List of FA submissions
+            submission_folders (optional): Dict of FA submissions to the
+                Weasyl folders they will be created in
+        """
+        added = self._track_new(fa_submissions, submission_folders or {})
+
+        for folder, submissions in added.items():
+            target = self._loaded(folder)
+            if target is not None:
+                self._insert_many(target, [self._new_node(s) for s in
+                                           submissions])
+
+    def add_existing(self, folder, wzl_submissions):
+        """Add newly scanned Weasyl submissions.
+
+        Args:
+            folder: The Weasyl folder scanned, None for the whole gallery
+            wzl_submissions: List of Weasyl submissions found
+        """
+        if folder is None:
+            submissions = [s for s in wzl_submissions if
+                           s not in self._in_folders and
+                           s not in self._root_existing]
+            self._root_existing.update(submissions)
+        elif folder in self._contents:
+            known = set(self._contents[folder])
+            submissions = [s for s in wzl_submissions if s not in known]
+            self._contents[folder].extend(submissions)
+            for submission in submissions:
+                self._in_folders.setdefault(submission, []).append(folder)
+
+            # Gallery submissions turned out to be in this folder
+            for submission in submissions:
+                if submission in self._root_existing:
+                    self._root_existing.discard(submission)
+                    node = self.nodes.pop(submission, None)
+                    if node is not None:
+                        self._remove(node)
+        else:
+            return
+
+        target = self._loaded(folder)
+        if target is not None:
+            self._insert_many(target, [self._wzl_node(s) for s in
+                                       submissions])
+
+    def update_mapping(self, submission_mapping):
+        """Apply a new mapping of FA submissions to Weasyl submissions.
+
+        Annotations of existing submissions are updated, newly mapped FA
+        submissions stop being shown as new and unmapped ones are added.
+
+        Args:
+            submission_mapping: Dict of FA submissions to Weasyl submissions
+        """
+        old_fa_by_wzl = self._fa_by_wzl
+        self._set_mapping(submission_mapping)
+
+        for wzl_sub in set(old_fa_by_wzl) | set(self._fa_by_wzl):
+            fa_sub = self._fa_by_wzl.get(wzl_sub)
+            if fa_sub is old_fa_by_wzl.get(wzl_sub):
+                continue
+
+            node = self.nodes.get(wzl_sub)
+            if node is not None and node.parent is not None:
+                node.texts[1] = fa_sub.title if fa_sub is not None else ""
+                index = self.index_of(node, 1)
+                self.dataChanged.emit(index, index)
+
+        for fa_sub in list(self._folder_of):
+            if fa_sub in self._mapped:
+                self._untrack(fa_sub)
+
+        self.add_new([s for s in self._fa_submissions
+                      if s not in self._mapped])
+
+    def new_submissions(self):
+        """Get the FA submissions that will be created.
+
+        Returns:
+            list: The FA submissions
+        """
+        return list(self._folder_of)
+
+    def folders_of(self, submission):
+        """Get the folders a submission is shown in.
+
+        Args:
+            submission: A Weasyl submission or a new FA submission
+
+        Returns:
+            list: The folders, parents before their children
+        """
+        if submission in self._folder_of:
+            folder = self._folder_of[submission]
+            return [] if folder is None else self._with_parents([folder])
+
+        return self._with_parents(self._in_folders.get(submission, []))
+
+    def _untrack(self, submission):
+        folder = self._folder_of.pop(submission)
+        self._assigned[folder].remove(submission)
+
+        node = self.nodes.pop(submission, None)
+        if node is not None:
+            self._remove(node)
+
+    def move_submission(self, submission, folder):
+        """Move a new submission to another destination folder.
+
+        Only the affected rows are changed. Rows inside folders that have
+        not been expanded yet are created when they are.
+
+        Args:
+            submission: The FA submission
+            folder: The Weasyl folder, or None for the root
+        """
+        if submission not in self._folder_of:
+            return
+
+        old_folder = self._folder_of[submission]
+        if old_folder is folder:
+            return
+
+        self._assigned[old_folder].remove(submission)
+        self._assigned.setdefault(folder, []).append(submission)
+        self._folder_of[submission] = folder
+
+        node = self.nodes.get(submission)
+        if node is not None and node.parent is None:
+            node = None
+        target = self._loaded(folder)
+
+        if node is not None and target is not None:
+            self._move(node, target)
+        elif node is not None:
+            self._remove(node)
+            del self.nodes[submission]
+        elif target is not None:
+            self._insert(target, self._new_node(submission))
+
+    def exclude_submission(self, submission):
+        """Remove a new submission from the tree.
+
+        Args:
+            submission: The FA submission
+        """
+        self._excluded.add(submission.id)
+
+        if submission in self._folder_of:
+            self._untrack(submission)
+
+    def mimeTypes(self):
+        return [SUBMISSIONS_MIME_TYPE]
+
+    def mimeData(self, indexes):
+        data = []
+
+        for index in indexes:
+            sub = self.object(index)
+            if index.column() == 0 and isinstance(sub, FASubmission):
+                data.append(sub.id)
+
+        mdata = QtCore.QMimeData()
+        mdata.setData(SUBMISSIONS_MIME_TYPE, json.dumps(data).encode("utf-8"))
+
+        return mdata
+
+    def dropMimeData(self, mdata, action, row, column, parent):
+        text = bytes(mdata.data(SUBMISSIONS_MIME_TYPE)).decode("utf-8")
+
+        if not text:
+            return False
+
+        data = json.loads(text)
+
+        folder = self.object(parent)
+        if folder is not None and not isinstance(folder, WZLFolder):
+            return False
+
+        self.submissions_dropped.emit(data, [folder])
+
+        return True
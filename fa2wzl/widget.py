@@ -1,87 +1,158 @@
-import json
+import logging
+from collections import deque
 
-from PyQt5 import QtCore, QtWidgets, QtGui
+from PyQt5 import QtCore, QtWidgets
+
+from fa2wzl import constants
 
-from fa2wzl.fa.models import Folder as FAFolder, Submission as FASubmission
-from fa2wzl.wzl.models import Folder as WZLFolder, Submission as WZLSubmission
 
+class ObjectTree(QtWidgets.QTreeView):
+    """Tree view over a TreeModel.
+    """
+
+    def selected_objects(self):
+        """Get the folders or submissions of the selected rows.
 
-class FolderTree(QtWidgets.QTreeWidget):
-    folder_dropped = QtCore.pyqtSignal(int, WZLFolder, name="folderDropped")
+        Returns:
+            list: The selected objects
+        """
+        return [index.data(QtCore.Qt.UserRole) for index in
+                self.selectionModel().selectedRows()]
 
-    def mimeTypes(self):
-        return ["application/x-fa2wzl-folders"]
+    def expanded_objects(self):
+        """Get the folders of the expanded rows.
 
-    def mimeData(self, Iterable, QTreeWidgetItem=None):
-        data = []
+        Returns:
+            list: The objects, parents before their children
+        """
+        model = self.model()
+        objects = []
 
-        for item in Iterable:
-            folder = item.data(0, QtCore.Qt.UserRole)
+        def visit(parent):
+            for row in range(model.rowCount(parent)):
+                index = model.index(row, 0, parent)
+                if self.isExpanded(index):
+                    obj = model.object(index)
+                    if obj is not None:
+                        objects.append(obj)
+                    visit(index)
 
-            if isinstance(folder, FAFolder):
-                data.append(folder.id)
+        visit(QtCore.QModelIndex())
+        return objects
 
-        md = QtCore.QMimeData()
-        md.setData("application/x-fa2wzl-folders",
-                   json.dumps(data).encode("utf-8"))
+    def expand_objects(self, objects):
+        """Expand the rows of folders, loading their children.
 
-        return md
+        Args:
+            objects: The objects, parents before their children
+        """
+        model = self.model()
 
-    def dropMimeData(self, parent_item, child_idx, mdata, action):
-        text = bytes(mdata.data("application/x-fa2wzl-folders")).decode("utf-8")
+        # Rows of a filtered model are looked up in the model it filters
+        source = model
+        if isinstance(model, QtCore.QAbstractProxyModel):
+            source = model.sourceModel()
 
-        if not text:
-            return False
+        # Children of expanded top level rows are otherwise loaded later
+        for node in source.root.children:
+            if node.loader is not None:
+                index = model.index_of(node)
+                if index.isValid() and self.isExpanded(index):
+                    model.fetchMore(index)
 
-        folder = parent_item.data(0, QtCore.Qt.UserRole)
-        if not isinstance(folder, WZLFolder):
-            return False
+        for obj in objects:
+            node = source.nodes.get(obj)
+            if node is None or node.parent is None:
+                continue
 
-        data = json.loads(text)
+            index = model.index_of(node)
+            if not index.isValid():
+                continue
+            if model.canFetchMore(index):
+                model.fetchMore(index)
+            self.expand(index)
 
-        if len(data) != 1:
-            return False
 
-        self.folder_dropped.emit(data[0], folder)
+class FolderTree(ObjectTree):
+    """Tree of Weasyl folders that FA folders can be dropped onto.
+    """
+    pass
 
-        return True
 
+class SubmissionTree(ObjectTree):
+    """Tree of Weasyl submissions that FA submissions can be moved in.
+    """
+    pass
 
-class SubmissionTree(QtWidgets.QTreeWidget):
-    submissions_dropped = QtCore.pyqtSignal(list, list,
-                                            name="submissionsDropped")
 
-    def mimeTypes(self):
-        return ["application/x-fa2wzl-submissions"]
+class LogBuffer(logging.Handler):
+    """Logging handler that collects formatted lines for a LogView.
 
-    def mimeData(self, Iterable, QTreeWidgetItem=None):
-        data = []
+    Records may be emitted from any thread. Only the most recent lines are
+    kept, so a burst of logging cannot outgrow the panel.
+    """
 
-        for item in Iterable:
-            sub = item.data(0, QtCore.Qt.UserRole)
-            if isinstance(sub, FASubmission):
-                data.append(sub.id)
+    def __init__(self, max_lines=constants.LOG_MAX_LINES,
+                 level=logging.NOTSET):
+        super(LogBuffer, self).__init__(level)
+        self._lines = deque(maxlen=max_lines)
 
-        mdata = QtCore.QMimeData()
-        mdata.setData("application/x-fa2wzl-submissions",
-                      json.dumps(data).encode("utf-8"))
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
 
-        return mdata
+        # Handler.handle already holds self.lock here
+        self._lines.append(line)
+
+    def drain(self):
+        """Take the collected lines.
 
-    def dropMimeData(self, parent_item, child_idx, mdata, action):
-        text = bytes(mdata.data("application/x-fa2wzl-submissions")).decode(
-            "utf-8")
+        Returns:
+            list: The lines logged since the last drain, oldest first
+        """
+        with self.lock:
+            lines = list(self._lines)
+            self._lines.clear()
+        return lines
 
-        data = json.loads(text)
 
+class LogView(QtWidgets.QPlainTextEdit):
+    """Read-only log panel showing the most recent lines.
 
-        if parent_item is None:
-            folder = None
-        else:
-            folder = parent_item.data(0, QtCore.Qt.UserRole)
-            if not isinstance(folder, WZLFolder):
-                return False
+    Lines logged to its buffer are appended in batches on a timer, rather
+    than one repaint per line.
+
+    Attributes:
+        buffer (LogBuffer): Handler to add to loggers that should show here
+    """
+
+    def __init__(self, parent=None):
+        super(LogView, self).__init__(parent)
 
-        self.submissions_dropped.emit(data, [folder])
+        self.setMaximumBlockCount(constants.LOG_MAX_LINES)
 
-        return True
+        self.buffer = LogBuffer()
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(constants.LOG_FLUSH_INTERVAL)
+        self._timer.timeout.connect(self.flush)
+        self._timer.start()
+
+    def flush(self):
+        """Append the lines collected by the buffer.
+        """
+        lines = self.buffer.drain()
+        if not lines:
+            return
+
+        scroll_bar = self.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+
+        self.appendPlainText("\n".join(lines))
+
+        # Keep following new lines unless the user scrolled up
+        if at_bottom:
+            scroll_bar.setValue(scroll_bar.maximum())
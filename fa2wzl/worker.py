@@ -1,31 +1,263 @@
+import collections
 import datetime
 import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import time
 
-from fa2wzl import compare
+from fa2wzl import compare, constants, events, exceptions
+from fa2wzl.logging import logger
+from fa2wzl.schedule import UploadScheduler
+from fa2wzl.tracing import Tracer
 
 
 class Worker(object):
-    def __init__(self, fa_sess, wzl_sess):
+    """Runs the migration stages, for the GUI and headless runs alike.
+
+    Uploading can be paused, resumed and cancelled from other threads. These
+    take effect between submissions, and cancelling also ends a wait for the
+    schedule at once.
+
+    Attributes:
+        folder_mapping: Dict of FA folders to Weasyl folders
+        submission_fa_folders: Dict of new FA submissions to the FA folder
+            they are placed by
+        submission_folder_mapping: Dict of new FA submissions to the Weasyl
+            folders they will be created in
+        submissions_to_create: List of FA submissions to upload
+        subscribers: Callables called with each event of fa2wzl.events as
+            the stages run
+        listeners: Callables called with the name and the data of each
+            event instead, e.g. "submission_finished" and a dict with the
+            submission, its index and the total
+        preprocessor (Preprocessor): Checks and converts files before they
+            are uploaded, None to upload them as they are
+        thumbnail_cache (ThumbnailCache): Where custom thumbnails are looked
+            up before downloading them, None to always download
+    """
+
+    def __init__(self, fa_sess, wzl_sess, tracer=None, preprocessor=None,
+                 thumbnail_cache=None):
         self.fa_sess = fa_sess
         self.wzl_sess = wzl_sess
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.preprocessor = preprocessor
+        self.thumbnail_cache = thumbnail_cache
 
         self.folder_mapping = {}
+        self.submission_fa_folders = {}
         self.submission_folder_mapping = {}
         self.submissions_to_create = []
 
-    def _upload_one_submission(self, sub):
-        # Download the file
-        # TODO: use a non protected attribute
-        res = self.fa_sess._requests.get(sub.media_url)
-        file = res.content
+        self.subscribers = []
+        self.listeners = []
+
+        self._control = threading.Condition()
+        self._paused = False
+        self._cancelled = False
+        self._scheduler = None
+        self._excluded = set()
+        self._reported_error = None
+
+    def _notify(self, event):
+        """Tell the subscribers and listeners about progress.
+
+        Args:
+            event (Event): What happened
+        """
+        for subscriber in list(self.subscribers):
+            subscriber(event)
+        for listener in list(self.listeners):
+            listener(event.name, event.data)
+
+    @property
+    def paused(self):
+        """bool: Whether uploading is paused"""
+        return self._paused
+
+    @property
+    def cancelled(self):
+        """bool: Whether uploading was cancelled"""
+        return self._cancelled
+
+    def pause(self):
+        """Stop starting uploads until resumed."""
+        with self._control:
+            if self._paused or self._cancelled:
+                return
+            self._paused = True
+
+        self._notify(events.Paused())
+
+    def resume(self):
+        """Go on with uploading after pause."""
+        with self._control:
+            if not self._paused:
+                return
+            self._paused = False
+            self._control.notify_all()
+
+        self._notify(events.Resumed())
 
+    def cancel(self):
+        """Stop uploading; uploads in progress still finish."""
+        with self._control:
+            self._cancelled = True
+            self._control.notify_all()
+            scheduler = self._scheduler
+
+        if scheduler is not None:
+            scheduler.cancel()
+
+    def exclude(self, submissions):
+        """Leave out submissions, also while uploading.
+
+        Args:
+            submissions: The FA submissions
+        """
+        with self._control:
+            self._excluded.update(sub.id for sub in submissions)
+
+    def move(self, submissions, folder):
+        """Put submissions into another Weasyl folder, also while uploading.
+
+        Args:
+            submissions: The FA submissions
+            folder: The Weasyl folder, or None for the root
+        """
+        with self._control:
+            for sub in submissions:
+                if folder is None:
+                    self.submission_folder_mapping.pop(sub, None)
+                else:
+                    self.submission_folder_mapping[sub] = folder
+
+    def _is_excluded(self, sub):
+        with self._control:
+            return sub.id in self._excluded
+
+    def _checkpoint(self):
+        """Wait while paused.
+
+        Returns:
+            bool: Whether to go on, False once cancelled
+        """
+        with self._control:
+            while self._paused and not self._cancelled:
+                self._control.wait()
+            return not self._cancelled
+
+    def media_file_name(self, sub):
+        """Get the name a submission's file is uploaded with.
+
+        Args:
+            sub: The FA submission
+
+        Returns:
+            str: The file name
+        """
         # TODO: not exactly the right way
         file_name_info = sub.media_url.split("/")
 
-        file_name = file_name_info[-1]
+        return file_name_info[-1]
+
+    def _needs_thumbnail(self, sub):
+        # Non-visual submissions use a custom thumbnail
+        return compare.convert_submission_type(sub.type) != "visual"
+
+    def _fetch_thumbnail(self, url):
+        # The GUI's previews may have fetched it already
+        if self.thumbnail_cache is not None:
+            return self.thumbnail_cache.fetch(url,
+                                              self.fa_sess.fetch_thumbnail)
+        return self.fa_sess.fetch_thumbnail(url)
 
+    def fetch_submission_media(self, sub):
+        """Download the files of a submission.
+
+        Args:
+            sub: The FA submission
+
+        Returns:
+            tuple: The file name, the file contents and the contents of the
+            custom thumbnail, None for visual submissions
+        """
+        # Download the file
+        with self.tracer.span("download"):
+            file = self.fa_sess.fetch_media(sub.media_url)
+
+        if self._needs_thumbnail(sub):
+            with self.tracer.span("download_thumbnail"):
+                thumb_file = self._fetch_thumbnail(sub.thumbnail_url)
+        else:
+            thumb_file = None
+
+        return self.media_file_name(sub), file, thumb_file
+
+    def prepare_submission_media(self, sub):
+        """Download the files of a submission and prepare them for Weasyl.
+
+        Args:
+            sub: The FA submission
+
+        Returns:
+            tuple: The file name, the file contents and the custom
+            thumbnail, as for fetch_submission_media
+
+        Raises:
+            ValidationError: If Weasyl would refuse the files
+        """
+        file_name, file, thumb_file = self.fetch_submission_media(sub)
+        if self.preprocessor is None:
+            return file_name, file, thumb_file
+
+        with self.tracer.span("preprocess"):
+            prepared = self.preprocessor.submit(
+                file_name, file, compare.convert_submission_type(sub.type),
+                thumb_file).result()
+
+        if prepared[0] != file_name:
+            logger.info("Converted %s to %s" % (file_name, prepared[0]))
+        return prepared
+
+    def download_submission_media(self, sub, path, thumbnail_path):
+        """Download the files of a submission to disk.
+
+        Partial files left by an earlier attempt are resumed.
+
+        Args:
+            sub: The FA submission
+            path (str): Where to save the file
+            thumbnail_path (str): Where to save the custom thumbnail
+
+        Returns:
+            tuple: The file name, and the length and SHA-256 hex digest of
+            the file and of the thumbnail, None for visual submissions
+        """
+        with self.tracer.span("download"):
+            media = self.fa_sess.download_media(sub.media_url, path)
+
+        if self._needs_thumbnail(sub):
+            with self.tracer.span("download_thumbnail"):
+                thumbnail = self.fa_sess.download_media(sub.thumbnail_url,
+                                                        thumbnail_path)
+        else:
+            thumbnail = None
+
+        return self.media_file_name(sub), media, thumbnail
+
+    def upload_submission(self, sub, file_name, file, thumb_file,
+                          folder_id=0):
+        """Create a submission on Weasyl from a downloaded FA submission.
+
+        Args:
+            sub: The FA submission
+            file_name (str): The file name
+            file (bytes): The file contents
+            thumb_file (bytes): The custom thumbnail, or None
+            folder_id (int, optional): The Weasyl folder to create it in
+        """
         title = sub.title
         type = compare.convert_submission_type(sub.type)
 
@@ -38,70 +270,300 @@ class Worker(object):
         description = sub.description
         tags = sub.tags
 
-        if sub in self.submission_folder_mapping:
-            folder_id = self.submission_folder_mapping[sub].id
-        else:
-            folder_id = 0
+        # Upload the submission
 
-        if type != "visual":
-            # Use custom thumbnail
-            res = self.fa_sess._requests.get(sub.thumbnail_url)
-            thumb_file = res.content
-        else:
-            thumb_file = None
+        with self.tracer.span("upload"):
+            self.wzl_sess.create_submission(
+                file_name,
+                file,
+                title,
+                type,
+                category,
+                rating,
+                description,
+                tags,
+                folder_id,
+                thumb_file,
+            )
 
-        # Upload the submission
+    def _upload_one_submission(self, sub, file_name, file, thumb_file):
+        with self._control:
+            folder = self.submission_folder_mapping.get(sub)
+        folder_id = folder.id if folder is not None else 0
 
-        self.wzl_sess.create_submission(
-            file_name,
-            file,
-            title,
-            type,
-            category,
-            rating,
-            description,
-            tags,
-            folder_id,
-            thumb_file,
-        )
+        self.upload_submission(sub, file_name, file, thumb_file, folder_id)
 
     def map_folders(self):
-        mapping = compare.map_folders(self.fa_sess.folders,
-                                      self.wzl_sess.folders)
-        self.folder_mapping = {fa_folder: wzl_folder for fa_folder, wzl_folder
-                               in mapping}
+        self._notify(events.StageStarted(stage="map_folders"))
+
+        with self.tracer.span("map_folders"):
+            with self.tracer.span("crawl"):
+                fa_folders = self.fa_sess.folders
+                wzl_folders = self.wzl_sess.folders
+
+            with self.tracer.span("match"):
+                mapping = compare.map_folders(fa_folders, wzl_folders)
+
+            self.folder_mapping = {fa_folder: wzl_folder for
+                                   fa_folder, wzl_folder in mapping}
+            self._associate()
+
+        self._notify(events.StageFinished(stage="map_folders"))
 
     def create_folders(self):
-        compare.create_unmapped_folders(self.fa_sess, self.wzl_sess, list(
-            (k, v) for k, v in self.folder_mapping.items()))
+        self._notify(events.StageStarted(stage="create_folders"))
+
+        with self.tracer.span("create_folders"):
+            compare.create_unmapped_folders(self.fa_sess, self.wzl_sess, list(
+                (k, v) for k, v in self.folder_mapping.items()))
+
+        self._notify(events.StageFinished(stage="create_folders"))
+
+        # The new folders have to be mapped before anything is put in them
+        self.map_folders()
+
+    def _associate(self):
+        # Submissions in folders that are not created yet stay in the root
+        # until they are
+        mapping = {
+            sub: self.folder_mapping[folder] for sub, folder
+            in self.submission_fa_folders.items()
+            if folder in self.folder_mapping}
+
+        with self._control:
+            self.submission_folder_mapping = mapping
 
     def map_submissions(self):
-        submission_mapping = compare.map_submissions(
-            self.fa_sess.gallery + self.fa_sess.scraps,
-            self.wzl_sess.gallery,
-        )
+        self._notify(events.StageStarted(stage="map_submissions"))
+
+        with self.tracer.span("map_submissions"):
+            with self.tracer.span("crawl"):
+                fa_submissions = self.fa_sess.gallery + self.fa_sess.scraps
+                wzl_submissions = self.wzl_sess.gallery
+
+            with self.tracer.span("match"):
+                submission_mapping = compare.map_submissions(
+                    fa_submissions,
+                    wzl_submissions,
+                )
+
+                unmapped = compare.get_unmapped_submissions(
+                    fa_submissions,
+                    submission_mapping,
+                )
+
+            if unmapped:
+                # Associating reads the contents of every folder, so scan
+                # them here to count the time as crawling; reading the
+                # contents scans a folder
+                with self.tracer.span("crawl"):
+                    for folder in self.fa_sess.folders:
+                        for scanned in [folder] + folder.children:
+                            scanned.submissions
+
+            with self.tracer.span("associate"):
+                self.submission_fa_folders = dict(compare.first_folders(
+                    self.fa_sess, unmapped))
+                self._associate()
+
+            self.submissions_to_create = sorted(unmapped, key=lambda x: x.id)
+
+        self._notify(events.StageFinished(stage="map_submissions"))
+
+    def _prepared_media(self, submissions):
+        """Prepare the files of submissions ahead of their upload.
+
+        Yields:
+            For each submission, a callable returning the result of
+            prepare_submission_media or raising its error
+        """
+        def prepare(sub):
+            # Downloads and conversions count towards the submission like
+            # its upload, also on the lookahead thread
+            with self.tracer.span("submission", id=sub.id):
+                return self.prepare_submission_media(sub)
+
+        if self.preprocessor is None:
+            for sub in submissions:
+                yield lambda sub=sub: prepare(sub)
+            return
+
+        # Downloading and converting the next files overlaps the upload
+        # and the wait before it
+        downloads = ThreadPoolExecutor(max_workers=1)
+        pending = collections.deque()
+        remaining = iter(submissions)
+
+        def queue_next():
+            sub = next(remaining, None)
+            if sub is not None:
+                pending.append(downloads.submit(prepare, sub))
+
+        try:
+            for _ in range(constants.PREPROCESS_LOOKAHEAD):
+                queue_next()
 
-        unmapped = compare.get_unmapped_submissions(
-            self.fa_sess.gallery + self.fa_sess.scraps,
-            submission_mapping,
-        )
+            while pending:
+                future = pending.popleft()
+                queue_next()
+                yield future.result
+        finally:
+            for future in pending:
+                future.cancel()
+            downloads.shutdown()
 
-        folder_assoc = compare.associate_submissions_with_folders(
-            self.fa_sess, unmapped,
-            list((k, v) for k, v in self.folder_mapping.items()))
+    def _weasyl_type(self, sub):
+        try:
+            return compare.convert_submission_type(sub.type)
+        except KeyError:
+            return None
+
+    def _scheduled_upload(self, scheduler, sub, index, total, file_name,
+                          file, thumb_file):
+        start = time.monotonic()
+        try:
+            self._notify(events.ItemStarted(submission=sub, index=index,
+                                            total=total))
+            with self.tracer.span("submission", id=sub.id):
+                self._upload_one_submission(sub, file_name, file,
+                                            thumb_file)
+        except Exception as e:
+            self._report_error(e, sub, index, total)
+            raise
+        finally:
+            scheduler.release(time.monotonic() - start,
+                              self._weasyl_type(sub))
+
+        self._notify(events.ItemUploaded(submission=sub, index=index,
+                                         total=total,
+                                         seconds=time.monotonic() - start))
+
+    def _report_error(self, error, sub=None, index=None, total=None):
+        # Errors are reported where they are best known, and only once
+        with self._control:
+            if error is self._reported_error:
+                return
+            self._reported_error = error
+
+        self._notify(events.Error(submission=sub, index=index, total=total,
+                                  error=error))
+
+    def _skip(self, sub, index, total, error=None):
+        if error is not None:
+            logger.warning("Skipping %s: %s" % (sub.title, error))
+        self._notify(events.ItemSkipped(submission=sub, index=index,
+                                        total=total, error=error))
+
+    def _create_all_worker(self, scheduler):
+        submissions = self.submissions_to_create
+        total = len(submissions)
+        media = self._prepared_media(submissions)
+
+        # Uploads only run on threads when several may run at once
+        executor = ThreadPoolExecutor(max_workers=scheduler.concurrency) \
+            if scheduler.concurrency > 1 else None
+        uploads = []
+
+        try:
+            for index, sub in enumerate(submissions):
+                # Files queued ahead are taken in order, even if unused
+                prepare = next(media)
+
+                if not self._checkpoint():
+                    break
+                if self._is_excluded(sub):
+                    self._skip(sub, index, total)
+                    continue
 
-        self.submission_folder_mapping = {fa_submission: wzl_folder for
-                                          fa_submission, wzl_folder in
-                                          folder_assoc}
+                # Files Weasyl would refuse are found before waiting to
+                # upload
+                try:
+                    file_name, file, thumb_file = prepare()
+                except exceptions.ValidationError as e:
+                    self._skip(sub, index, total, e)
+                    continue
+                except Exception as e:
+                    self._report_error(e, sub, index, total)
+                    raise
 
-        self.submissions_to_create = sorted(unmapped, key=lambda x: x.id)
+                self._notify(events.ItemDownloaded(
+                    submission=sub, index=index, total=total,
+                    file_name=file_name, size=len(file)))
 
-    def _create_all_worker(self, interval_minutes):
-        for sub in self.submissions_to_create:
-            if sub != self.submissions_to_create[0]:
-                time.sleep(60 * interval_minutes)
+                # Stop at the first failed upload, as without threads
+                for future in uploads:
+                    if future.done():
+                        future.result()
 
-            self._upload_one_submission(sub)
+                type = self._weasyl_type(sub)
+                seconds = scheduler.delay(type)
+                if seconds > 0:
+                    self._notify(events.Waiting(
+                        seconds=seconds, index=index, total=total,
+                        eta=scheduler.eta(self._weasyl_type(s)
+                                          for s in submissions[index:])))
+
+                with self.tracer.span("wait"):
+                    if not scheduler.acquire(type):
+                        break
+
+                # Pausing or excluding while waiting still counts
+                if not self._checkpoint() or self._is_excluded(sub):
+                    scheduler.release()
+                    if self._cancelled:
+                        break
+                    self._skip(sub, index, total)
+                    continue
+
+                args = (scheduler, sub, index, total, file_name, file,
+                        thumb_file)
+                if executor is None:
+                    self._scheduled_upload(*args)
+                else:
+                    uploads.append(executor.submit(self._scheduled_upload,
+                                                   *args))
+            else:
+                index = total
+        finally:
+            media.close()
+            if executor is not None:
+                executor.shutdown()
+
+        for future in uploads:
+            future.result()
+
+        if index < total:
+            logger.info("Uploads cancelled")
+            self._notify(events.Cancelled(index=index, total=total))
+
+        return None
+
+    def create_all(self, interval_minutes=0, scheduler=None):
+        """Upload the submissions to create.
+
+        Args:
+            interval_minutes (float, optional): Minutes between uploads
+            scheduler (UploadScheduler, optional): Decides when uploads
+                start instead of the interval
+        """
+        if scheduler is None:
+            scheduler = UploadScheduler.from_interval(interval_minutes)
+
+        with self._control:
+            self._scheduler = scheduler
+            if self._cancelled:
+                scheduler.cancel()
+
+        self._notify(events.StageStarted(stage="create_all"))
+
+        try:
+            with self.tracer.span("create_all"):
+                self._create_all_worker(scheduler)
+        except Exception as e:
+            # Subscribers learn the run is over, whatever stopped it
+            self._report_error(e)
+            raise
+        finally:
+            self.tracer.write_report()
 
-    def create_all(self, interval_minutes):
-        self._create_all_worker(interval_minutes)
+        self._notify(events.StageFinished(stage="create_all"))
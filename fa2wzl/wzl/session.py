@@ -1,10 +1,12 @@
 import json
 import re
+import threading
 
 import requests
 from lxml import html
 
-from fa2wzl import constants, exceptions
+from fa2wzl import constants, exceptions, transport
+from fa2wzl.ratelimit import BandwidthLimiter, RateLimiter, ThrottledReader
 from fa2wzl.logging import logger
 from fa2wzl.wzl.models import Folder, Submission
 
@@ -14,12 +16,52 @@ class WZLSession(object):
 
     Attributes:
         username (str): The username logged in as
+        listeners: Callables called with an event name and a dict of details
+            as folders and submissions are scanned, like
+            FASession.listeners. Listings are "gallery" or a folder.
     """
 
-    def __init__(self, api_key):
-        self._requests = requests.Session()
+    def __init__(self, api_key, read_limiter=None, write_limiter=None,
+                 metrics=None, root=constants.WZL_ROOT, adapter=None,
+                 upload_limiter=None):
+        """Construct a new Weasyl session.
+
+        Args:
+            api_key (str): The API key to authenticate with
+            read_limiter (RateLimiter, optional): Limiter for API reads
+            write_limiter (RateLimiter, optional): Limiter for folder and
+                submission creation
+            metrics (Metrics, optional): Where to record request metrics
+            root (str, optional): The URL base of the site
+            adapter (HTTPAdapter, optional): Connection pools shared with
+                other sessions
+            upload_limiter (BandwidthLimiter, optional): Bandwidth limit for
+                submission uploads
+        """
+        self.root = root
+
+        self._requests = transport.Transport(metrics=metrics,
+                                             adapter=adapter)
+        self.metrics = self._requests.metrics
         self._requests.headers["X-Weasyl-API-Key"] = api_key
 
+        if read_limiter is None:
+            read_limiter = RateLimiter(constants.WZL_API_READS_PER_SECOND,
+                                       burst=constants.WZL_API_READ_BURST)
+
+        if write_limiter is None:
+            write_limiter = RateLimiter(constants.WZL_API_WRITES_PER_MINUTE,
+                                        per=60,
+                                        burst=constants.WZL_API_WRITE_BURST)
+
+        if upload_limiter is None:
+            upload_limiter = BandwidthLimiter(
+                constants.UPLOAD_BYTES_PER_SECOND)
+
+        self.read_limiter = read_limiter
+        self.write_limiter = write_limiter
+        self.upload_limiter = upload_limiter
+
         self._folders = {}
         self._submissions = {}
 
@@ -28,11 +70,85 @@ class WZLSession(object):
         self._root_folders = None
         self._gallery_submissions = None
 
+        # Guards the folder and submission registries, only held briefly
+        self.lock = threading.RLock()
+
+        # Each listing scans under its own lock, so it is loaded once and
+        # other listings load meanwhile
+        self._folders_lock = threading.RLock()
+        self._gallery_lock = threading.RLock()
+
+        self.listeners = []
+
+    def _limited_request(self, limiter, endpoint, method, url, **kwargs):
+        """Send a rate limited request, honoring 429 responses.
+
+        Args:
+            limiter (RateLimiter): The limiter to take a token from
+            endpoint (str): Logical endpoint name for metrics
+            method (str): The HTTP method
+            url (str): The URL
+
+        Returns:
+            The response
+
+        Raises:
+            requests.HTTPError: If Weasyl still throttles after
+                WZL_THROTTLE_RETRIES retries
+        """
+        for attempt in range(constants.WZL_THROTTLE_RETRIES + 1):
+            # A streamed body is sent again from the start
+            body = kwargs.get("data")
+            if hasattr(body, "seek"):
+                body.seek(0)
+
+            self.metrics.record_wait(endpoint, limiter.acquire())
+            res = self._requests.request(method, url, endpoint=endpoint,
+                                         **kwargs)
+
+            if res.status_code != 429:
+                return res
+
+            delay = transport.retry_after(res,
+                                          constants.WZL_RETRY_AFTER_DEFAULT)
+            logger.info("Throttled by Weasyl, waiting %d seconds" % delay)
+            # Later requests wait too, also once this gives up
+            limiter.defer(delay)
+
+        res.raise_for_status()
+
+    def _notify(self, event, **data):
+        """Tell the listeners about scan progress.
+
+        Args:
+            event (str): The event name
+            **data: Event details
+        """
+        for listener in list(self.listeners):
+            listener(event, data)
+
+    def _api_get(self, endpoint, url, **kwargs):
+        return self._limited_request(self.read_limiter, endpoint, "GET", url,
+                                     **kwargs)
+
+    def _api_post(self, endpoint, url, **kwargs):
+        return self._limited_request(self.write_limiter, endpoint, "POST",
+                                     url, **kwargs)
+
+    @property
+    def rate_limit_stats(self):
+        """dict: Wait statistics of the read, write and upload limiters"""
+        return {
+            "read": self.read_limiter.stats,
+            "write": self.write_limiter.stats,
+            "upload": self.upload_limiter.stats,
+        }
+
     @property
     def username(self):
         if self._username is None:
             try:
-                res = self._requests.get(constants.WZL_ROOT + "/api/whoami")
+                res = self._api_get("wzl.whoami", self.root + "/api/whoami")
                 self._username = res.json()["login"]
             except json.JSONDecodeError:
                 raise exceptions.AuthenticationError()
@@ -40,50 +156,61 @@ class WZLSession(object):
         return self._username
 
     def _load_folders(self):
+        with self._folders_lock:
+            self._read_folders()
+
+    def _read_folders(self):
         logger.debug("Loading folders")
 
-        self._root_folders = []
+        root_folders = []
 
-        url = constants.WZL_ROOT + "/api/users/%s/view" % self.username
-        res = self._requests.get(url)
+        url = self.root + "/api/users/%s/view" % self.username
+        res = self._api_get("wzl.user_view", url)
         folders = res.json()["folders"]
 
         for folder_struct in folders:
-            folder = self._folders.get(folder_struct["folder_id"])
-            if folder is None:
-                folder = Folder()
-                folder._session = self
-                folder.id = folder_struct["folder_id"]
-                self._folders[folder.id] = folder
+            folder = self._folder(folder_struct["folder_id"])
 
             folder.title = folder_struct["title"]
             folder.children = []
 
-            self._root_folders.append(folder)
+            root_folders.append(folder)
 
             if "subfolders" in folder_struct:
                 for subfolder_struct in folder_struct["subfolders"]:
-                    subfolder = self._folders.get(subfolder_struct["folder_id"])
-                    if subfolder is None:
-                        subfolder = Folder()
-                        subfolder._session = self
-                        subfolder.id = subfolder_struct["folder_id"]
-                        self._folders[subfolder.id] = subfolder
+                    subfolder = self._folder(subfolder_struct["folder_id"])
 
                     subfolder.title = subfolder_struct["title"]
                     subfolder.children = []
 
                     folder.children.append(subfolder)
 
+        # Only publish the folders once complete
+        self._root_folders = root_folders
+
+        self._notify("folders_loaded", folders=list(root_folders))
+
+    def _folder(self, id):
+        with self.lock:
+            folder = self._folders.get(id)
+            if folder is None:
+                folder = Folder()
+                folder._session = self
+                folder.id = id
+                self._folders[id] = folder
+
+        return folder
+
     def _load_submission_from_struct(self, sub_struct):
         id = sub_struct["submitid"]
 
-        sub = self._submissions.get(id)
-        if sub is None:
-            sub = Submission()
-            sub._session = self
-            sub.id = id
-            self._submissions[id] = sub
+        with self.lock:
+            sub = self._submissions.get(id)
+            if sub is None:
+                sub = Submission()
+                sub._session = self
+                sub.id = id
+                self._submissions[id] = sub
 
         sub.title = sub_struct["title"]
         sub.type = sub_struct["subtype"]
@@ -94,10 +221,16 @@ class WZLSession(object):
     def _scan_gallery(self, folder_id=None):
 
         next_id = None
-        url = constants.WZL_ROOT + "/api/users/%s/gallery" % self.username
+        url = self.root + "/api/users/%s/gallery" % self.username
 
         submissions = []
 
+        if folder_id is None:
+            listing = "gallery"
+        else:
+            with self.lock:
+                listing = self._folders.get(folder_id)
+
         logger.debug("Scanning gallery folder %r" % folder_id)
 
         while True:
@@ -109,15 +242,18 @@ class WZLSession(object):
             if folder_id is not None:
                 params["folderid"] = folder_id
 
-            res = self._requests.get(url, params=params)
+            res = self._api_get("wzl.gallery", url, params=params)
             data = res.json()
 
             next_id = data["nextid"]
 
-            for sub_struct in data["submissions"]:
-                sub = self._load_submission_from_struct(sub_struct)
+            found = [self._load_submission_from_struct(sub_struct) for
+                     sub_struct in data["submissions"]]
 
-                submissions.append(sub)
+            submissions.extend(found)
+
+            self._notify("submissions_page", listing=listing,
+                         submissions=found, total=len(submissions))
 
             if next_id is None:
                 break
@@ -127,32 +263,51 @@ class WZLSession(object):
         if folder_id is None:
             self._gallery_submissions = submissions
 
+        self._notify("submissions_done", listing=listing,
+                     submissions=list(submissions))
+
         return submissions
 
+    def fetch_media(self, url):
+        """Download a file such as a thumbnail.
+
+        Args:
+            url (str): The URL of the file
+
+        Returns:
+            bytes: The file contents
+        """
+        res = self._requests.get(url, endpoint="wzl.media")
+        return res.content
+
     def reload_folders(self):
         """Reload the root folders.
 
         Use after creating new folders.
         """
-        self._root_folders = None
         self._load_folders()
 
     @property
     def folders(self):
+        # Only lock when loading, so reads never wait behind a scan
         if self._root_folders is None:
-            self._load_folders()
+            with self._folders_lock:
+                if self._root_folders is None:
+                    self._load_folders()
 
         return list(self._root_folders)
 
     @property
     def gallery(self):
         if self._gallery_submissions is None:
-            self._scan_gallery()
+            with self._gallery_lock:
+                if self._gallery_submissions is None:
+                    self._scan_gallery()
 
         return list(self._gallery_submissions)
 
     def create_folder(self, title, parent_id=None):
-        url = constants.WZL_ROOT + "/control/createfolder"
+        url = self.root + "/control/createfolder"
 
         data = {
             "title": title,
@@ -161,11 +316,13 @@ class WZLSession(object):
 
         logger.info("Creating folder \"%s\" (Parent %r)" % (title, parent_id))
 
-        self._requests.post(url, data=data)
+        self._api_post("wzl.create_folder", url, data=data)
 
-        old_ids = set(self._folders.keys())
-        self.reload_folders()
-        new_ids = set(self._folders.keys())
+        # Holding the folders lock, no other load adds folders meanwhile
+        with self._folders_lock:
+            old_ids = set(self._folders.keys())
+            self.reload_folders()
+            new_ids = set(self._folders.keys())
 
         new_id = list(new_ids - old_ids)[0]
         return self._folders[new_id]
@@ -189,7 +346,7 @@ class WZLSession(object):
         """
 
         if type == "visual":
-            url = constants.WZL_ROOT + "/submit/visual"
+            url = self.root + "/submit/visual"
             files = {
                 "submitfile": (file_name, file_obj),
                 "thumbfile": ("thumb", b""),
@@ -205,7 +362,7 @@ class WZLSession(object):
             }
 
         elif type == "literary":
-            url = constants.WZL_ROOT + "/submit/literary"
+            url = self.root + "/submit/literary"
             files = {
                 "submitfile": (file_name, file_obj),
                 "coverfile": ("cover", b""),
@@ -225,7 +382,7 @@ class WZLSession(object):
             }
 
         elif type == "multimedia":
-            url = constants.WZL_ROOT + "/submit/multimedia"
+            url = self.root + "/submit/multimedia"
             files = {
                 "submitfile": (file_name, file_obj),
                 "coverfile": ("cover", b""),
@@ -246,7 +403,13 @@ class WZLSession(object):
 
         logger.info("Uploading file %s as \"%s\"" % (file_name, title))
 
-        res = self._requests.post(url, files=files, data=data)
+        # Encode the form up front so the body can be sent at a limited
+        # rate
+        form = requests.Request("POST", url, files=files, data=data).prepare()
+        body = ThrottledReader(form.body, self.upload_limiter)
+
+        res = self._api_post("wzl.upload", url, data=body, headers={
+            "Content-Type": form.headers["Content-Type"]})
 
         # Workaround for literary submissions
 
@@ -259,4 +422,4 @@ class WZLSession(object):
                 "y2": 0,
             }
 
-            self._requests.post(res.url, data=data)
+            self._api_post("wzl.upload_thumbnail", res.url, data=data)
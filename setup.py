@@ -12,4 +12,19 @@ setup(
     packages=find_packages(),
 
     install_requires=install_reqs,
+    extras_require={
+        # Keeping logins between runs
+        "logins": ["cryptography"],
+        # Converting images Weasyl would refuse
+        "images": ["Pillow"],
+    },
+
+    entry_points={
+        "console_scripts": [
+            "fa2wzl=fa2wzl.cli:main",
+        ],
+        "gui_scripts": [
+            "fa2wzl-gui=fa2wzl.gui:main",
+        ],
+    },
 )